@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time queries run by ``execution.Executor`` against SQLAlchemy and the
+raw ``sqlite3`` connection alone.
+
+A tree of ``DIRECTORIES * FILES`` empty files is written to a temporary
+directory and scanned, then each query is read in full through:
+
+* ``sqlite3``, the compiled SQL on the raw connection, the time SQLite takes
+* ``Executor``, the statement of ``Database.query`` as it runs it
+* ``SQLAlchemy``, the same statement run on the SQLAlchemy connection
+
+and the ``relations`` table is listed by ``Database.relations`` and by an
+ORM session. Run with ifsql installed, or from the repository root::
+
+    PYTHONPATH=. python benchmarks/execution.py
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import sqlalchemy.orm
+
+from ifsql import analyse
+from ifsql import database
+from ifsql import parser
+
+DIRECTORIES = 20
+FILES = 1000
+QUERIES = [
+    "SELECT file_name, file_size FROM . WHERE file_type = 'F'",
+    "SELECT * FROM .",
+    "SELECT file_name FROM d3 WHERE file_name = 'f10'",
+]
+# the best of as many runs is kept
+REPEAT = 5
+
+
+def make_tree(root):
+    for i in range(DIRECTORIES):
+        directory = os.path.join(root, "d{}".format(i))
+        os.mkdir(directory)
+        for j in range(FILES):
+            open(os.path.join(directory, "f{}".format(j)), "w").close()
+
+
+def best(function):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        rows = function()
+        timings.append(time.perf_counter() - start)
+    return len(rows), min(timings)
+
+
+def report(label, count, seconds):
+    print(
+        "{:<12}{:>8} rows{:>10.2f} ms{:>8.2f} us/row".format(
+            label, count, seconds * 1e3, seconds / count * 1e6
+        )
+    )
+
+
+def main():
+    root = tempfile.mkdtemp()
+    try:
+        make_tree(root)
+        db, path_id_cache = database.Database(), {}
+        analyse.walk(root, db, path_id_cache)
+    finally:
+        shutil.rmtree(root)
+
+    queries = parser.Parser()
+    raw = db.connection.connection.connection
+    for text in QUERIES:
+        select = queries.parse(text)
+        build, values, key = db._statement(select, path_id_cache)
+        sql, params = db._executor.compile(build, values, key)
+        statement = build() if callable(build) else build
+
+        print(text)
+        report("sqlite3", *best(lambda: raw.execute(sql, params).fetchall()))
+        report(
+            "Executor",
+            *best(lambda: db._executor.execute(build, values, key).fetchall())
+        )
+        report(
+            "SQLAlchemy",
+            *best(lambda: db.connection.execute(statement, values).fetchall())
+        )
+
+    print("relations")
+    session = sqlalchemy.orm.Session(bind=db.connection)
+    report("Executor", *best(lambda: db.relations.all()))
+    report("ORM", *best(lambda: session.query(database.Relation).all()))
+
+
+if __name__ == "__main__":
+    main()
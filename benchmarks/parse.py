@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the Earley and LALR parsers of ``ifsql.parser.GRAMMAR``.
+
+Both parsers are built from the same grammar and parse the shapes
+``Parser.parse`` gives them, with the literals lifted. Run with ifsql
+installed, or from the repository root::
+
+    PYTHONPATH=. python benchmarks/parse.py
+"""
+
+import time
+
+import lark
+
+from ifsql import parser
+
+QUERIES = [
+    ("simple", "SELECT file_name, file_size FROM . WHERE file_size > 10"),
+    (
+        "GROUP BY",
+        "SELECT dirname, count(*), sum(file_size) AS total FROM . "
+        "WHERE file_type = 'F' AND depth <= 3 "
+        "AND (file_name LIKE '%.py' OR file_name LIKE '%.c') "
+        "GROUP BY dirname HAVING total > 1000 ORDER BY total DESC LIMIT 10",
+    ),
+    (
+        "20 ORs",
+        "SELECT full_path FROM . WHERE "
+        + " OR ".join("file_name = 'f{}'".format(i) for i in range(20)),
+    ),
+    (
+        "100 IN",
+        "SELECT full_path FROM . WHERE file_name IN ("
+        + ", ".join("'f{}'".format(i) for i in range(100))
+        + ")",
+    ),
+    (
+        "50 ANDs",
+        "SELECT full_path FROM . WHERE "
+        + " AND ".join("file_size > {}".format(i) for i in range(50)),
+    ),
+]
+
+# each query is parsed for at least this long
+DURATION = 0.5
+
+
+def build(algorithm):
+    start = time.perf_counter()
+    built = lark.Lark(
+        parser.GRAMMAR,
+        start="simple_select",
+        parser=algorithm,
+        maybe_placeholders=False,
+    )
+    return built, time.perf_counter() - start
+
+
+def per_parse(built, shape):
+    count, elapsed = 0, 0
+    start = time.perf_counter()
+    while elapsed < DURATION:
+        built.parse(shape)
+        count += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / count
+
+
+def main():
+    earley, earley_build = build("earley")
+    lalr, lalr_build = build("lalr")
+    print("{:<10}{:>12}{:>12}".format("ms", "Earley", "LALR"))
+    print(
+        "{:<10}{:>12.2f}{:>12.2f}".format("build", earley_build * 1e3, lalr_build * 1e3)
+    )
+    for name, text in QUERIES:
+        shape, _ = parser._lift(text)
+        assert earley.parse(shape) == lalr.parse(shape)
+        print(
+            "{:<10}{:>12.2f}{:>12.2f}".format(
+                name, per_parse(earley, shape) * 1e3, per_parse(lalr, shape) * 1e3
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
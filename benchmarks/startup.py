@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Time the start of the ``ifsql`` command line.
+
+Each command runs in a fresh interpreter and the best of ``REPEAT`` runs
+is kept: a bare Python start, ``import ifsql.main`` as reported by
+``-X importtime``, ``ifsql --version`` and a one-shot ``ifsql -e`` query
+streamed over a small temporary directory. The commands import ifsql
+from this checkout::
+
+    python benchmarks/startup.py
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# the best of as many runs is kept
+REPEAT = 10
+
+
+def python(*args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+        + [env.get("PYTHONPATH", "")]
+    )
+    return subprocess.run(
+        [sys.executable] + list(args),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+
+def best(*args):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        python(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def import_time(module):
+    """The cumulative ``-X importtime`` of ``module``, in seconds."""
+    timings = []
+    for _ in range(REPEAT):
+        # the lines are "import time: self [us] | cumulative | name"
+        stderr = python("-X", "importtime", "-c", "import " + module).stderr
+        for fields in (line.split("|") for line in stderr.splitlines()):
+            if len(fields) == 3 and fields[2].strip() == module:
+                timings.append(int(fields[1]) / 1e6)
+    return min(timings)
+
+
+def main():
+    root = tempfile.mkdtemp()
+    try:
+        for i in range(10):
+            open(os.path.join(root, "file{}".format(i)), "w").close()
+        print("{:<24}{:>8.1f} ms".format("python", best("-c", "pass") * 1e3))
+        print(
+            "{:<24}{:>8.1f} ms".format(
+                "import ifsql.main", import_time("ifsql.main") * 1e3
+            )
+        )
+        print(
+            "{:<24}{:>8.1f} ms".format(
+                "ifsql --version", best("-m", "ifsql", "--version") * 1e3
+            )
+        )
+        query = "SELECT file_name FROM . WHERE file_size = 0"
+        print(
+            "{:<24}{:>8.1f} ms".format(
+                "ifsql -e", best("-m", "ifsql", root, "-e", query) * 1e3
+            )
+        )
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
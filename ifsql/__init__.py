@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
-import pkg_resources
 
-try:
-    __version__ = pkg_resources.get_distribution(__name__).version
-except:
-    __version__ = "unknown"
+
+def __getattr__(name):
+    # importlib.metadata takes longer to import than the rest of the command
+    # line, only look the version up when asked for it
+    if name != "__version__":
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    import importlib.metadata
+
+    try:
+        version = importlib.metadata.version(__name__)
+    except importlib.metadata.PackageNotFoundError:
+        version = "unknown"
+    globals()["__version__"] = version
+    return version
@@ -0,0 +1,113 @@
+import logging
+import os
+import os.path
+import re
+import sqlite3
+
+from ifsql import database
+from ifsql import parser
+
+logger = logging.getLogger(__name__)
+
+# queries a column has to be filtered on without an index before it gets one
+MIN_QUERIES = 3
+# indexes built at most after each scan
+MAX_INDEXES = 4
+
+# the table of the files, or under the files view of the compact layout
+_FILE_TABLES = ("files", "files_compact")
+# the columns an index search uses, "(file_size>? AND ...)"
+_INDEX_SEARCH = re.compile(r"USING (?:COVERING )?INDEX \w+ \(([^)]*)\)")
+_COLUMN = re.compile(r"\w+")
+
+
+def default_log_path():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "ifsql", "workload.sqlite")
+
+
+def indexed_columns(plan):
+    """The columns of the ``files`` table searched through an index in the
+    ``EXPLAIN QUERY PLAN`` details ``plan``."""
+    columns = set()
+    for detail in plan:
+        if detail.split()[:2] not in (["SEARCH", table] for table in _FILE_TABLES):
+            continue
+        match = _INDEX_SEARCH.search(detail)
+        if match is not None:
+            for term in match.group(1).split(" AND "):
+                columns.add(_COLUMN.match(term).group())
+    return columns
+
+
+class IndexAdvisor:
+    """Count, across sessions, the queries filtering on a ``files`` column
+    that no index serves, and index the most filtered columns.
+
+    Without ``path`` the counts only last as long as the object.
+    """
+
+    def __init__(self, path=None):
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(
+            path if path is not None else ":memory:", check_same_thread=False
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS unindexed_filters ("
+            "column TEXT PRIMARY KEY, queries INTEGER)"
+        )
+
+    def observe(self, db, select, path_id_cache):
+        """Record the columns the WHERE clause of ``select`` filters on that
+        the query plan doesn't search through an index. Returns them."""
+        conjuncts = parser.where_conjuncts(select)
+        if not conjuncts:
+            # nothing to filter on, or a top level OR no single index serves
+            return set()
+        columns = set(database.File.__table__.c.keys())
+        filtered = {name for _, names in conjuncts for name in names} & columns
+        if not filtered:
+            return set()
+        plan = db.explain(select, path_id_cache)
+        if not any(detail.split()[1] in _FILE_TABLES for detail in plan):
+            # answered from dir_stats
+            return set()
+        unindexed = filtered - indexed_columns(plan)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO unindexed_filters VALUES (?, 1) ON CONFLICT (column) "
+                "DO UPDATE SET queries = queries + 1",
+                [(column,) for column in sorted(unindexed)],
+            )
+        return unindexed
+
+    def advice(self):
+        """The columns worth an index, the most filtered first."""
+        rows = self.connection.execute(
+            "SELECT column FROM unindexed_filters WHERE queries >= ? "
+            "ORDER BY queries DESC, column LIMIT ?",
+            (MIN_QUERIES, MAX_INDEXES),
+        )
+        return [column for (column,) in rows]
+
+    def apply(self, db):
+        """Index the advised columns in ``db``, after a scan. Their counts
+        start over, so a column is only indexed again if still needed."""
+        columns = self.advice()
+        if not columns:
+            return []
+        with db.lock:
+            created = db.create_indexes([(column,) for column in columns])
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM unindexed_filters WHERE column = ?",
+                [(column,) for column in columns],
+            )
+        if created:
+            logger.info("created indexes %s", ", ".join(created))
+        return created
+
+    def close(self):
+        self.connection.close()
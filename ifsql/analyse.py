@@ -1,7 +1,21 @@
+import collections
+import concurrent.futures
 import datetime
+import functools
+import logging
+import queue
 import stat
 import os
 import os.path
+import threading
+import time
+
+from ifsql import computed
+from ifsql import exclude
+from ifsql import hashing
+from ifsql import metrics as scan_metrics
+
+logger = logging.getLogger(__name__)
 
 
 def file_type(mode):
@@ -21,46 +35,1288 @@ def file_type(mode):
         return "S"
 
 
-def analyse_file(root, path, name):
-    result = os.stat(os.path.join(path, name), follow_symlinks=False)
+# columns that only a stat call can fill
+STAT_FIELDS = frozenset(
+    [
+        "file_size",
+        "access_time",
+        "modification_time",
+        "creation_time",
+        "owner_id",
+        "group_id",
+        "mtime_ns",
+        "ctime_ns",
+        "atime_ns",
+        "device",
+        "inode",
+    ]
+)
 
-    return {
-        "file_name": name,
-        "dirname": os.path.join(
-            ".", os.path.dirname(os.path.relpath(os.path.join(path, name), root))
-        ),
-        "full_path": os.path.join(path, name),
-        "file_type": file_type(result.st_mode),
+
+def stat_data(result):
+    data = {
         "file_size": result.st_size,
         "access_time": datetime.datetime.fromtimestamp(result.st_atime),
         "modification_time": datetime.datetime.fromtimestamp(result.st_mtime),
         "creation_time": datetime.datetime.fromtimestamp(result.st_ctime),
         "owner_id": result.st_uid,
         "group_id": result.st_gid,
+        "mtime_ns": result.st_mtime_ns,
+        "ctime_ns": result.st_ctime_ns,
+        "atime_ns": result.st_atime_ns,
+        "device": result.st_dev,
+        "inode": result.st_ino,
+        "content_hash": None,
+        "sha256": None,
+        "stat_pending": False,
     }
+    data.update(computed.UNSET)
+    return data
 
 
-def walk(root, database, path_id_cache):
-    database.begin()
+PENDING_STAT_DATA = {
+    "file_size": None,
+    "access_time": None,
+    "modification_time": None,
+    "creation_time": None,
+    "owner_id": None,
+    "group_id": None,
+    "mtime_ns": None,
+    "ctime_ns": None,
+    "atime_ns": None,
+    "device": None,
+    "inode": None,
+    "content_hash": None,
+    "sha256": None,
+    "stat_pending": True,
+}
+
+
+def file_data(name, dirname, full_path, result):
+    data = {
+        "file_name": name,
+        "dirname": dirname,
+        "full_path": full_path,
+        "file_type": file_type(result.st_mode),
+        "excluded": None,
+    }
+    data.update(stat_data(result))
+    return data
+
+
+def listing_data(name, dirname, full_path, file_type):
+    """Row of an entry known from its directory listing only, see
+    :func:`fill_stats`."""
+    data = {
+        "file_name": name,
+        "dirname": dirname,
+        "full_path": full_path,
+        "file_type": file_type,
+        "excluded": None,
+    }
+    data.update(PENDING_STAT_DATA)
+    data.update(computed.UNSET)
+    return data
+
+
+def needs_stat(scope):
+    """Whether the query of a :class:`parser.ScanScope` reads stat columns,
+    or hashes or computed file contents, which are cached by stat columns."""
+    return (
+        "*" in scope.columns
+        or not STAT_FIELDS.isdisjoint(scope.columns)
+        or not hashing.COLUMNS.isdisjoint(scope.columns)
+        or any(
+            computed.COLUMNS[name].reads != computed.NAME
+            for name in computed.needed(scope)
+        )
+    )
+
+
+STAT_BATCH_SIZE = 2000
+
+
+def fill_stats(database, path_id, max_depth=None):
+    """Stat the entries of a stat-free scan a query is about to read.
+
+    Only the rows below ``path_id``, down to ``max_depth``, that are still
+    missing their stat columns are stat'd, and they are updated in batches of
+    ``STAT_BATCH_SIZE``. Returns the number of filled rows.
+    """
+    with database.lock:
+        pending = database.pending_stats(path_id, max_depth)
+        if not pending:
+            return 0
+
+        database.begin()
+        for start in range(0, len(pending), STAT_BATCH_SIZE):
+            rows = []
+            for file_id, full_path in pending[start : start + STAT_BATCH_SIZE]:
+                try:
+                    data = stat_data(os.stat(full_path, follow_symlinks=False))
+                except OSError:
+                    # gone since the listing, a refresh removes it
+                    data = dict(PENDING_STAT_DATA, stat_pending=False, **computed.UNSET)
+                data["file_id"] = file_id
+                rows.append(data)
+            database.update_files(rows)
+        database.commit()
+        database.create_session()
+
+    logger.info("filled the stat columns of %d entries", len(pending))
+    return len(pending)
+
+
+def analyse_file(root, path, name):
+    full_path = os.path.join(path, name)
+    result = os.stat(full_path, follow_symlinks=False)
+    dirname = os.path.join(".", os.path.dirname(os.path.relpath(full_path, root)))
+    return file_data(name, dirname, full_path, result)
+
+
+def child_relpath(relpath, name):
+    """Key of ``name`` inside ``relpath`` in a ``path_id_cache``."""
+    if relpath == ".":
+        return name
+    return relpath + os.sep + name
+
+
+def ancestor_ids(path_id_cache, relpath):
+    """Ids of the directory ``relpath`` and of its ancestors, nearest first."""
+    ancestors = []
+    while relpath != ".":
+        ancestors.append(path_id_cache[relpath])
+        relpath = os.path.dirname(relpath) or "."
+    ancestors.append(path_id_cache["."])
+    return ancestors
+
+
+def add_listing(relpath, ancestors, files, directories, add, path_id_cache):
+    """Record the ``files`` and ``directories`` :func:`scan_directory` listed
+    in the directory ``relpath``; ``ancestors`` are the ids of the directory
+    itself and of its ancestors, nearest first.
+
+    ``add(data, ancestors, is_directory)`` numbers and records one entry and
+    returns its id. The directories to descend into get their id in
+    ``path_id_cache`` and are returned as ``(path, relpath, ancestors)``
+    items in listing order: excluded directories are recorded but never
+    listed and, like ``os.walk``, symlinked directories are not descended
+    into.
+    """
+    for name, data in files:
+        add(data, ancestors)
+
+    subdirectories = []
+    for name, data in directories:
+        directory_id = add(data, ancestors, is_directory=True)
+        if data["excluded"] is not None:
+            continue  # recorded but never listed
+        subdirectory = child_relpath(relpath, name)
+        path_id_cache[subdirectory] = directory_id
+        if data["file_type"] != "L":
+            subdirectories.append(
+                (data["full_path"], subdirectory, [directory_id] + ancestors)
+            )
+    return subdirectories
+
+
+class Batch:
+    """``files`` rows and ``(ancestor_id, descendant_id, depth)`` closure
+    tuples waiting to be inserted together.
+    """
+
+    def __init__(self, closure=True):
+        self.closure = closure
+        self.files = []
+        self.relations = []
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, data, file_id, ancestors, is_directory=False):
+        """Add an entry whose ancestor ids, nearest first, are ``ancestors``."""
+        data["file_id"] = file_id
+        data["is_directory"] = is_directory
+        data["parent_id"] = ancestors[0] if ancestors else None
+        data["level"] = len(ancestors)
+        self.files.append(data)
+        if not self.closure:
+            return
+        if is_directory:
+            self.relations.append((file_id, file_id, 0))
+        self.relations.extend(
+            (ancestor_id, file_id, depth)
+            for depth, ancestor_id in enumerate(ancestors, 1)
+        )
+
+
+# number of batches the scanner may get ahead of the writer in a pipeline
+QUEUE_SIZE = 8
+PIPELINE_BATCH_SIZE = 2000
+
+
+class Inserter:
+    """Numbers scanned entries and writes them to ``database`` in batches.
+
+    The ancestor chain of every directory is kept by the walker, so the
+    closure rows of an entry are built in memory instead of being copied
+    from the parent rows already in the database.
+    """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, database, batch_size=BATCH_SIZE, metrics=None):
+        self.database = database
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.batch = Batch(database.uses_closure)
+
+    def directory_timing(self):
+        """A :class:`metrics.DirectoryTiming` for :func:`scan_directory`, or
+        None when no metrics are collected."""
+        if self.metrics is None:
+            return None
+        return scan_metrics.DirectoryTiming()
+
+    def directory_scanned(self, relpath, entries, timing):
+        if self.metrics is not None:
+            self.metrics.directory_scanned(relpath, entries, timing)
+
+    def add(self, data, ancestors, is_directory=False):
+        file_id = self.database.reserve_file_ids(1)
+        self.batch.add(data, file_id, ancestors, is_directory)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return file_id
+
+    def flush(self):
+        start = time.perf_counter()
+        self.database.insert_files(self.batch.files)
+        self.database.insert_relations(self.batch.relations)
+        if self.metrics is not None and self.batch:
+            self.metrics.batch_inserted(len(self.batch), time.perf_counter() - start)
+        self.batch = Batch(self.database.uses_closure)
+
+
+def walk(
+    root,
+    database,
+    path_id_cache,
+    jobs=None,
+    processes=None,
+    pipeline=False,
+    with_stat=True,
+    metrics=None,
+    exclusions=None,
+):
+    """Scan ``root`` into ``database``, leaving out what the
+    :class:`exclude.Exclusions` ``exclusions`` exclude and reporting to the
+    :class:`metrics.ScanMetrics` ``metrics`` if given."""
+    if jobs is not None and jobs > 1:
+        traverse = functools.partial(
+            parallel_scan_tree, jobs=jobs, with_stat=with_stat, exclusions=exclusions
+        )
+    else:
+        traverse = functools.partial(
+            scan_tree, with_stat=with_stat, exclusions=exclusions
+        )
+
+    result = None
+    if processes is not None and processes > 1:
+        sharded_walk(
+            root, database, path_id_cache, processes, with_stat, metrics, exclusions
+        )
+    elif pipeline:
+        result = pipelined_walk(
+            root, database, path_id_cache, traverse, metrics=metrics
+        )
+    else:
+        database.begin()
+        inserter = Inserter(database, metrics=metrics)
+        traverse(root, inserter, path_id_cache)
+        inserter.flush()
+        database.commit()
+        database.create_session()
+
+    if metrics is not None:
+        metrics.finish()
+    return result
+
+
+def scan_tree(root, inserter, path_id_cache, with_stat=True, exclusions=None):
+    data = analyse_file(root, root, ".")
+    root_id = inserter.add(data, [], is_directory=True)
+    path_id_cache["."] = root_id
+    scan_subdirectories(
+        [(root, ".", [root_id])], inserter, path_id_cache, with_stat, exclusions
+    )
+
+
+def scan_subdirectories(
+    stack, inserter, path_id_cache, with_stat=True, exclusions=None
+):
+    """Scan the directories on ``stack`` and everything below them.
+
+    The stack holds ``(path, relpath, ancestors)`` items, where ``ancestors``
+    are the ids of the directory itself and of its ancestors, nearest first.
+    """
+    # depth-first, visiting subdirectories in listing order like os.walk
+    while stack:
+        path, relpath, ancestors = stack.pop()
+        timing = inserter.directory_timing()
+        files, directories, _, _ = scan_directory(
+            path, relpath, with_stat, timing, exclusions
+        )
+        inserter.directory_scanned(relpath, len(files) + len(directories), timing)
+        subdirectories = add_listing(
+            relpath, ancestors, files, directories, inserter.add, path_id_cache
+        )
+        stack.extend(reversed(subdirectories))
+
+
+def dirname_may_match(dirname, value, exact):
+    """Whether entries with ``dirname``, or below it, may match ``value``."""
+    below = dirname if dirname.endswith("/") else dirname + "/"
+    if value.startswith(below):
+        return True
+    if exact:
+        return dirname == value
+    return dirname.startswith(value)
+
+
+def in_dirname_scope(relpath, dirnames):
+    """Whether the directory ``relpath`` has to be listed for the ``dirname``
+    constraints of a :class:`parser.ScanScope`."""
+    dirname = os.path.join(".", relpath) if relpath != "." else "./"
+    for value, exact, case_sensitive in dirnames:
+        if case_sensitive:
+            matches = dirname_may_match(dirname, value, exact)
+        else:
+            matches = dirname_may_match(dirname.lower(), value.lower(), exact)
+        if not matches:
+            return False
+    return True
+
+
+class ScopedScan:
+    """Scans a tree on demand, only as far as the queries need it.
+
+    :meth:`ensure` lists the directories of a :class:`parser.ScanScope` that
+    haven't been listed yet, so the first query on a subtree scans it and
+    later queries on the same part of the tree reuse the rows. Entries are
+    only stat'd when the query reads stat columns, see :func:`fill_stats`.
+    """
+
+    def __init__(self, root, database, path_id_cache, exclusions=None):
+        self.root = root
+        self.database = database
+        self.path_id_cache = path_id_cache
+        self.exclusions = exclusions
+        # relpath -> relpaths of the subdirectories to descend into, for
+        # every directory listed so far
+        self.listed = {}
+
+    def ensure(self, scope):
+        """Scan what ``scope`` needs, return the number of listed directories.
+
+        The ``files`` indexes are created after the first listing, no scan
+        gets recorded, and kept up to date by the later ones."""
+        with self.database.lock:
+            first = not self.listed
+            self.database.begin()
+            inserter = Inserter(self.database)
+            count = self._ensure(scope, inserter, needs_stat(scope))
+            inserter.flush()
+            self.database.commit()
+            if first:
+                self.database.create_indexes()
+            self.database.create_session()
+
+        logger.info("listed %d directories for %s", count, scope)
+        return count
+
+    def _ensure(self, scope, inserter, with_stat):
+        if "." not in self.path_id_cache:
+            data = analyse_file(self.root, self.root, ".")
+            self.path_id_cache["."] = inserter.add(data, [], is_directory=True)
+
+        # the ancestors of the FROM directory are listed to find it
+        relpath, count = ".", 0
+        for name in scope.path.split(os.sep) if scope.path != "." else ():
+            if relpath not in self.listed:
+                self._list(relpath, inserter, with_stat)
+                count += 1
+            relpath = child_relpath(relpath, name)
+            if relpath not in self.listed[os.path.dirname(relpath) or "."]:
+                return count  # not a directory, the query reports it
+
+        stack = [(relpath, 0)]
+        while stack:
+            relpath, depth = stack.pop()
+            if scope.max_depth is not None and depth >= scope.max_depth:
+                continue
+            if not in_dirname_scope(relpath, scope.dirnames):
+                continue
+            if relpath not in self.listed:
+                self._list(relpath, inserter, with_stat)
+                count += 1
+            stack.extend(
+                (subdirectory, depth + 1)
+                for subdirectory in reversed(self.listed[relpath])
+            )
+        return count
+
+    def _list(self, relpath, inserter, with_stat):
+        path = self.root if relpath == "." else os.path.join(self.root, relpath)
+        ancestors = ancestor_ids(self.path_id_cache, relpath)
+        files, directories, _, _ = scan_directory(
+            path, relpath, with_stat, exclusions=self.exclusions
+        )
+        subdirectories = add_listing(
+            relpath, ancestors, files, directories, inserter.add, self.path_id_cache
+        )
+        self.listed[relpath] = [subdirectory for _, subdirectory, _ in subdirectories]
+
+
+def is_related(relpath, other):
+    """Whether one of the directories ``relpath`` and ``other`` contains the
+    other one, or they are the same directory."""
+    if relpath == "." or other == "." or relpath == other:
+        return True
+    return other.startswith(relpath + os.sep) or relpath.startswith(other + os.sep)
+
+
+class BackgroundScan(threading.Thread):
+    """Scans a tree breadth-first on a background thread.
+
+    Listed entries are committed every ``COMMIT_INTERVAL`` seconds, or every
+    ``BATCH_SIZE`` entries, while holding ``database.lock``, so queries see
+    the tree as far as it has been indexed. Going breadth-first, shallow
+    entries are complete early: :meth:`status` tells down to which depth.
+    ``on_done`` is called from the thread once the whole tree is committed.
+    The scan reports to the :class:`metrics.ScanMetrics` ``metrics`` and
+    leaves out what the :class:`exclude.Exclusions` ``exclusions`` exclude.
+    """
+
+    BATCH_SIZE = 10000
+    COMMIT_INTERVAL = 0.5
+
+    def __init__(
+        self,
+        root,
+        database,
+        path_id_cache,
+        with_stat=True,
+        on_done=None,
+        metrics=None,
+        exclusions=None,
+    ):
+        super().__init__(name="ifsql-background-scanner", daemon=True)
+        self.root = root
+        self.database = database
+        self.path_id_cache = path_id_cache
+        self.with_stat = with_stat
+        self.on_done = on_done
+        self.metrics = metrics
+        self.exclusions = exclusions
+        self.error = None
+        self.finished = False
+        # committed counts
+        self.entries = 0
+        self.directories = 0
+
+        self._stopped = threading.Event()
+        # guards everything below, notified after every commit
+        self._condition = threading.Condition()
+        # (path, relpath, ancestors) of the directories left to list, the
+        # root is queued from the start so that it is waited for
+        self._queue = collections.deque([(root, ".", None)])
+        # relpaths of the directories listed since the last commit
+        self._uncommitted = []
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        try:
+            self._scan()
+            if self.metrics is not None:
+                self.metrics.finish()
+            if not self._stopped.is_set() and self.on_done is not None:
+                self.on_done()
+        except Exception as e:
+            logger.exception("background scan failed")
+            self.error = e
+        finally:
+            with self._condition:
+                self.finished = True
+                self._condition.notify_all()
+
+    def _scan(self):
+        batch, directories = Batch(self.database.uses_closure), {}
+
+        def add(data, ancestors, is_directory=False):
+            file_id = self.database.reserve_file_ids(1)
+            batch.add(data, file_id, ancestors, is_directory)
+            return file_id
+
+        # the root listing is committed right away
+        committed = time.monotonic() - self.COMMIT_INTERVAL
+        while not self._stopped.is_set():
+            with self._condition:
+                if not self._queue:
+                    break
+                path, relpath, ancestors = self._queue.popleft()
+                self._uncommitted.append(relpath)
+
+            if ancestors is None:
+                data = analyse_file(self.root, self.root, ".")
+                directories["."] = add(data, [], is_directory=True)
+                ancestors = [directories["."]]
+
+            timing = (
+                scan_metrics.DirectoryTiming() if self.metrics is not None else None
+            )
+            files, subdirectories, _, _ = scan_directory(
+                path, relpath, self.with_stat, timing, self.exclusions
+            )
+            if timing is not None:
+                self.metrics.directory_scanned(
+                    relpath, len(files) + len(subdirectories), timing
+                )
+            queued = add_listing(
+                relpath, ancestors, files, subdirectories, add, directories
+            )
+            with self._condition:
+                self._queue.extend(queued)
+
+            if (
+                len(batch) >= self.BATCH_SIZE
+                or time.monotonic() - committed >= self.COMMIT_INTERVAL
+            ):
+                self._commit(batch, directories)
+                batch, directories = Batch(self.database.uses_closure), {}
+                committed = time.monotonic()
+
+        self._commit(batch, directories)
+
+    def _commit(self, batch, directories):
+        with self.database.lock:
+            started = time.monotonic()
+            self.database.begin()
+            self.database.insert_files(batch.files)
+            self.database.insert_relations(batch.relations)
+            self.database.commit()
+            if self.metrics is not None and len(batch):
+                self.metrics.batch_inserted(len(batch), time.monotonic() - started)
+            # directories become known to queries together with their rows
+            self.path_id_cache.update(directories)
+            self.database.create_session()
+
+        with self._condition:
+            self.entries += len(batch)
+            self.directories += len(self._uncommitted)
+            self._uncommitted = []
+            self._condition.notify_all()
+
+    def _pending(self, relpath):
+        return any(is_related(relpath, other) for other in self._uncommitted) or any(
+            is_related(relpath, other) for _, other, _ in self._queue
+        )
+
+    def wait(self, relpath=".", timeout=None):
+        """Block until everything below ``relpath`` is committed, return
+        whether it is."""
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.finished or not self._pending(relpath), timeout
+            )
+
+    def status(self):
+        """The "partial: ..." progress line, None once the scan is over."""
+        with self._condition:
+            if self.finished or not (self._queue or self._uncommitted):
+                return None
+            known = self.directories + len(self._uncommitted) + len(self._queue)
+            # every entry down to the shallowest directory still to be listed
+            # or committed is in the database
+            if self._uncommitted:
+                shallowest = self._uncommitted[0]
+            elif self._queue:
+                shallowest = self._queue[0][1]
+            else:
+                shallowest = "."
+            depth = 0 if shallowest == "." else shallowest.count(os.sep) + 1
+            return (
+                "partial: {} entries, {}% of directories, complete to depth {}".format(
+                    self.entries, 100 * self.directories // max(known, 1), depth
+                )
+            )
+
+
+class RefreshStats:
+    """What :func:`refresh` had to do to bring a scan up to date."""
+
+    def __init__(self):
+        self.checked = 0
+        self.changed = 0
+        self.added = 0
+        self.updated = 0
+        self.removed = 0
+
+    def __str__(self):
+        return (
+            "{} directories checked, {} changed: "
+            "{} entries added, {} updated, {} removed"
+        ).format(self.checked, self.changed, self.added, self.updated, self.removed)
+
+
+def refresh(root, database, path_id_cache, subdir=".", exclusions=None):
+    """Bring the stored scan of ``subdir`` in line with the filesystem.
+
+    Every known directory is stat'd once and only those whose mtime or ctime
+    differ from the ones stored at scan time are listed again, with their
+    rows updated, added or removed in place. Changes that don't touch any
+    directory, like a file being rewritten in place, are not noticed.
+    """
+    subdir = os.path.normpath(subdir)
+    # a Watcher changes path_id_cache under the lock
+    with database.lock:
+        known = [
+            relpath
+            for relpath in list(path_id_cache)
+            if subdir == "." or relpath == subdir or relpath.startswith(subdir + os.sep)
+        ]
+    return _refresh(root, database, path_id_cache, known, False, exclusions)
+
+
+def refresh_directories(root, database, path_id_cache, relpaths, exclusions=None):
+    """List the directories ``relpaths`` again whether they changed or not,
+    without looking at their subdirectories."""
+    return _refresh(root, database, path_id_cache, relpaths, True, exclusions)
+
+
+def _refresh(root, database, path_id_cache, relpaths, force, exclusions):
+    stats = RefreshStats()
+    # parents first, so removed subtrees are never visited
+    relpaths = sorted(
+        relpaths,
+        key=lambda relpath: (relpath != ".", relpath.count(os.sep), relpath),
+    )
+
+    with database.lock:
+        stamps = database.directory_stamps()
+        database.begin()
+        inserter = Inserter(database)
+        first_new_id = database.file_count + 1
+
+        for relpath in relpaths:
+            directory_id = path_id_cache.get(relpath)
+            if directory_id is None or directory_id not in stamps:
+                continue  # removed or added by this refresh
+
+            path = root if relpath == "." else os.path.join(root, relpath)
+            try:
+                result = os.stat(path, follow_symlinks=False)
+            except OSError:
+                continue  # gone, the change shows up in its parent
+            stats.checked += 1
+
+            stamp = (result.st_mtime_ns, result.st_ctime_ns)
+            if not force and stamp == stamps[directory_id]:
+                continue
+            if not stat.S_ISDIR(result.st_mode):
+                continue  # symlinks are not listed, their parent handles them
+
+            stats.changed += 1
+            refresh_directory(
+                root, relpath, database, inserter, path_id_cache, stats, exclusions
+            )
+
+        inserter.flush()
+        stats.added = database.file_count - first_new_id + 1
+        database.commit()
+        database.create_session()
+
+    return stats
+
+
+def refresh_directory(
+    root, relpath, database, inserter, path_id_cache, stats, exclusions=None
+):
+    """List a directory again and patch its rows and the rows of its entries."""
+    directory_id = path_id_cache[relpath]
+    ancestors = ancestor_ids(path_id_cache, relpath)
+
+    if relpath == ".":
+        path = root
+        data = analyse_file(root, root, ".")
+    else:
+        path = os.path.join(root, relpath)
+        data = analyse_file(root, os.path.dirname(path), os.path.basename(path))
+    data["file_id"] = directory_id
+    updated = [data]
+
+    stored = {
+        name: (file_id, is_directory, file_type, excluded)
+        for name, file_id, is_directory, file_type, excluded in database.children(
+            directory_id
+        )
+    }
+    files, directories, _, _ = scan_directory(path, relpath, exclusions=exclusions)
+
+    removed = []
+    for entries, is_directory in ((files, False), (directories, True)):
+        for name, data in entries:
+            old = stored.pop(name, None)
+            if old is not None:
+                file_id, was_directory, old_type, was_excluded = old
+                if (
+                    was_directory == is_directory
+                    and old_type == data["file_type"]
+                    and was_excluded == data["excluded"]
+                ):
+                    data["file_id"] = file_id
+                    updated.append(data)
+                    continue
+                removed.append((name, file_id, was_directory))
+
+            new_id = inserter.add(data, ancestors, is_directory)
+            if is_directory and data["excluded"] is None:
+                subdirectory = child_relpath(relpath, name)
+                path_id_cache[subdirectory] = new_id
+                if data["file_type"] != "L":
+                    stack = [(data["full_path"], subdirectory, [new_id] + ancestors)]
+                    scan_subdirectories(
+                        stack, inserter, path_id_cache, exclusions=exclusions
+                    )
+
+    removed.extend(
+        (name, file_id, was_directory)
+        for name, (file_id, was_directory, _, _) in stored.items()
+    )
+    for name, file_id, was_directory in removed:
+        stats.removed += database.delete_subtree(file_id)
+        if was_directory:
+            subdirectory = child_relpath(relpath, name)
+            for key in [
+                key
+                for key in path_id_cache
+                if key == subdirectory or key.startswith(subdirectory + os.sep)
+            ]:
+                del path_id_cache[key]
+
+    database.update_files(updated)
+    stats.updated += len(updated) - 1
+
+
+class StatLatencyTuner:
+    """Chooses how many directories are scanned concurrently.
+
+    Each scanned directory reports how long its ``stat`` calls took. The
+    number of directories kept in flight is the ratio between the measured
+    per-call latency and the latency of a cached local ``stat``, so a fast
+    local disk is scanned by one or two threads while a high-latency network
+    mount gets up to ``max_workers`` requests in flight.
+    """
+
+    # roughly the cost of a stat() answered from the dentry cache
+    LOCAL_STAT_LATENCY = 20e-6
+    # weight of the newest sample in the moving average
+    SMOOTHING = 0.2
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.latency = None
+
+    def record(self, elapsed, calls):
+        if calls == 0:
+            return
+        sample = elapsed / calls
+        if self.latency is None:
+            self.latency = sample
+        else:
+            self.latency += self.SMOOTHING * (sample - self.latency)
+
+    @property
+    def concurrency(self):
+        if self.latency is None:
+            return 1
+        wanted = int(round(self.latency / self.LOCAL_STAT_LATENCY))
+        return max(1, min(self.max_workers, wanted))
+
+
+def scan_directory(path, relpath, with_stat=True, timing=None, exclusions=None):
+    """List ``path`` and stat its entries.
+
+    ``relpath`` is the location of ``path`` relative to the scanned root. The
+    ``stat`` result cached on each ``os.DirEntry`` is reused and the
+    ``dirname`` string is built once for the whole directory. Without
+    ``with_stat`` the entries are typed from the listing alone and their stat
+    columns are left to :func:`fill_stats`. The latency of every stat call
+    and the device of the entries are recorded in the
+    :class:`metrics.DirectoryTiming` ``timing`` if given.
+
+    Entries left out by the :class:`exclude.Exclusions` ``exclusions`` are
+    dropped before being stat'd, except directories, which are kept with the
+    reason in their ``excluded`` column so that walks don't descend into them.
+
+    Returns ``(files, directories, elapsed, calls)`` where ``files`` and
+    ``directories`` hold ``(name, data)`` pairs split the same way ``os.walk``
+    splits them, and ``elapsed`` is the time spent in ``calls`` stat calls.
+    """
+    files, directories = [], []
+    elapsed, calls = 0.0, 0
+    dirname = os.path.join(".", relpath) if relpath != "." else "./"
+    rules = exclusions.rules(relpath) if exclusions is not None else ()
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                excluded = None
+                if exclusions is not None:
+                    is_directory = entry.is_dir(follow_symlinks=False)
+                    excluded = exclusions.excluded(
+                        rules, relpath, entry.name, is_directory
+                    )
+                    if excluded is not None and not is_directory:
+                        continue
+
+                if not with_stat:
+                    listed = listing_entry(entry, dirname)
+                    if listed is not None:
+                        is_directory, data = listed
+                        if data["file_type"] == "D" and excluded is None:
+                            excluded = mount_point(exclusions, entry)
+                        data["excluded"] = excluded
+                        (directories if is_directory else files).append(
+                            (entry.name, data)
+                        )
+                        continue
+
+                start = time.perf_counter()
+                try:
+                    result = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue  # removed since the directory was listed
+                except OSError as e:
+                    # the entry is kept without its stat columns, the other
+                    # entries of the directory are still listed
+                    logger.debug("cannot stat %s: %s", entry.path, e)
+                    result = None
+                finally:
+                    latency = time.perf_counter() - start
+                    elapsed += latency
+                    calls += 1
+                    if timing is not None:
+                        timing.latencies.append(latency)
+
+                if result is None:
+                    listed = unstatable_entry(entry, dirname)
+                    if listed is not None:
+                        is_directory, data = listed
+                        data["excluded"] = excluded
+                        (directories if is_directory else files).append(
+                            (entry.name, data)
+                        )
+                    continue
+
+                if timing is not None and timing.device is None:
+                    timing.device = result.st_dev
+                data = file_data(entry.name, dirname, entry.path, result)
+                if stat.S_ISDIR(result.st_mode) and excluded is None:
+                    excluded = mount_point(exclusions, entry, result)
+                data["excluded"] = excluded
+                # d_type answers is_dir() for everything but symlinks, which
+                # os.walk reports as directories when they point to one
+                if stat.S_ISDIR(result.st_mode) or (
+                    stat.S_ISLNK(result.st_mode) and entry.is_dir()
+                ):
+                    directories.append((entry.name, data))
+                else:
+                    files.append((entry.name, data))
+    except OSError as e:
+        # os.walk silently skips directories it cannot list, so do we
+        logger.debug("cannot list %s: %s", path, e)
+
+    return files, directories, elapsed, calls
+
+
+def mount_point(exclusions, entry, result=None):
+    """The excluded reason of a directory entry on another filesystem than
+    the root of a walk that stays on one, or None."""
+    if exclusions is None or exclusions.device is None:
+        return None
+    if result is None:
+        try:
+            result = entry.stat(follow_symlinks=False)
+        except OSError:
+            return None
+    if exclusions.is_mount_point(result.st_dev):
+        return exclude.MOUNT_POINT
+    return None
+
+
+def listing_entry(entry, dirname):
+    """``(is_directory, data)`` of an entry typed by its ``d_type``, or None
+    for the entries only a stat call can tell apart, like devices."""
+    if entry.is_symlink():
+        return entry.is_dir(), listing_data(entry.name, dirname, entry.path, "L")
+    if entry.is_dir(follow_symlinks=False):
+        return True, listing_data(entry.name, dirname, entry.path, "D")
+    if entry.is_file(follow_symlinks=False):
+        return False, listing_data(entry.name, dirname, entry.path, "F")
+    return None
+
+
+def unstatable_entry(entry, dirname):
+    """:func:`listing_entry` of an entry that cannot be stat'd, whose stat
+    columns stay empty instead of waiting for :func:`fill_stats`."""
+    try:
+        listed = listing_entry(entry, dirname)
+    except OSError:
+        return None
+    if listed is not None:
+        listed[1]["stat_pending"] = False
+    return listed
+
+
+def parallel_scan_tree(
+    root, inserter, path_id_cache, jobs, with_stat=True, exclusions=None
+):
+    """Scan the tree listing and stating directories on a pool of threads.
+
+    Produces the same entries and ``path_id_cache`` as :func:`scan_tree`.
+    Only the calling thread feeds ``inserter``; the workers return the
+    analysed entries of a single directory.
+    """
+    tuner = StatLatencyTuner(jobs)
 
     data = analyse_file(root, root, ".")
-    parent_id = database.insert_file(data, None, is_directory=True)
-    path_id_cache["."] = parent_id
+    root_id = inserter.add(data, [], is_directory=True)
+    path_id_cache["."] = root_id
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque([(root, ".", [root_id])])
+        in_flight = {}
+
+        while pending or in_flight:
+            while pending and len(in_flight) < tuner.concurrency:
+                path, relpath, ancestors = pending.popleft()
+                timing = inserter.directory_timing()
+                future = pool.submit(
+                    scan_directory, path, relpath, with_stat, timing, exclusions
+                )
+                in_flight[future] = (relpath, ancestors, timing)
+
+            done, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                relpath, ancestors, timing = in_flight.pop(future)
+                files, directories, elapsed, calls = future.result()
+                tuner.record(elapsed, calls)
+                inserter.directory_scanned(
+                    relpath, len(files) + len(directories), timing
+                )
+
+                pending.extend(
+                    add_listing(
+                        relpath,
+                        ancestors,
+                        files,
+                        directories,
+                        inserter.add,
+                        path_id_cache,
+                    )
+                )
+
+    logger.info(
+        "parallel scan finished, stat latency %.1f us, concurrency %d",
+        (tuner.latency or 0) * 1e6,
+        tuner.concurrency,
+    )
+
+
+class StageCounter:
+    """Throughput of one stage of :func:`pipelined_walk`.
+
+    ``busy`` is the time the stage spent working and ``waiting`` the time it
+    spent blocked on the queue between the stages: a scanner that waits is
+    held back by the writer, a writer that waits is starved by the scanner.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    @property
+    def throughput(self):
+        """Entries per second of busy time."""
+        if self.busy == 0:
+            return 0.0
+        return self.entries / self.busy
+
+    def __str__(self):
+        return (
+            "{}: {} entries in {} batches, {:.0f} entries/s, "
+            "{:.2f}s busy, {:.2f}s waiting"
+        ).format(
+            self.name,
+            self.entries,
+            self.batches,
+            self.throughput,
+            self.busy,
+            self.waiting,
+        )
+
+
+class ScanCancelled(Exception):
+    pass
+
+
+class QueueInserter(Inserter):
+    """Hands full batches over to the writer of :func:`pipelined_walk`."""
+
+    def __init__(self, database, batches, counter, cancelled, batch_size, metrics):
+        super().__init__(database, batch_size, metrics)
+        self.batches = batches
+        self.counter = counter
+        self.cancelled = cancelled
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        self.put(self.batch)
+        self.counter.entries += len(self.batch)
+        self.counter.batches += 1
+        self.batch = Batch(self.database.uses_closure)
+
+    def put(self, item):
+        start = time.perf_counter()
+        while True:
+            if self.cancelled.is_set():
+                raise ScanCancelled()
+            try:
+                self.batches.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.counter.waiting += time.perf_counter() - start
+
+
+def pipelined_walk(
+    root,
+    database,
+    path_id_cache,
+    traverse=scan_tree,
+    queue_size=QUEUE_SIZE,
+    batch_size=PIPELINE_BATCH_SIZE,
+    metrics=None,
+):
+    """Scan the tree on a background thread while inserting in this one.
+
+    ``traverse`` (:func:`scan_tree` or :func:`parallel_scan_tree`) runs as
+    the producer and the calling thread, which owns the SQLite connection,
+    writes the batches it produces. The bounded queue between them makes the
+    scanner wait whenever the writer falls behind.
+
+    Returns the ``(scanner, writer)`` :class:`StageCounter` pair.
+    """
+    batches = queue.Queue(maxsize=queue_size)
+    cancelled = threading.Event()
+    scanner, writer = StageCounter("scanner"), StageCounter("writer")
+
+    def produce():
+        start = time.perf_counter()
+        inserter = QueueInserter(
+            database, batches, scanner, cancelled, batch_size, metrics
+        )
+        try:
+            try:
+                traverse(root, inserter, path_id_cache)
+                inserter.flush()
+            except ScanCancelled:
+                raise
+            except BaseException as e:
+                inserter.put(e)
+            else:
+                inserter.put(None)
+        except ScanCancelled:
+            pass
+        finally:
+            scanner.busy = time.perf_counter() - start - scanner.waiting
 
-    for path, directories, files in os.walk(root):
-        parent_id = path_id_cache[os.path.relpath(path, root)]
+    database.begin()
+    producer = threading.Thread(target=produce, name="ifsql-scanner", daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            start = time.perf_counter()
+            batch = batches.get()
+            writer.waiting += time.perf_counter() - start
+            if batch is None:
+                break
+            if isinstance(batch, BaseException):
+                raise batch
+
+            start = time.perf_counter()
+            database.insert_files(batch.files)
+            database.insert_relations(batch.relations)
+            elapsed = time.perf_counter() - start
+            writer.busy += elapsed
+            if metrics is not None:
+                metrics.batch_inserted(len(batch), elapsed)
+            writer.entries += len(batch)
+            writer.batches += 1
+    except BaseException:
+        cancelled.set()
+        raise
+    finally:
+        producer.join()
+
+    database.commit()
+    database.create_session()
+
+    logger.info("%s", scanner)
+    logger.info("%s", writer)
+    return scanner, writer
+
+
+def scan_subtree(
+    path, relpath, closure=True, with_stat=True, timed=False, exclusions=None
+):
+    """Scan everything below ``path`` independently of the database.
+
+    This is the unit of work of :func:`sharded_walk` and runs in a worker
+    process. Entries are numbered from 1 in traversal order, with 0 standing
+    for ``path`` itself, and the closure rows only reach up to ``path``.
+
+    Returns ``(files, relations, directories, timings)``: ``files`` rows
+    carrying the local ``file_id``, ``(ancestor_id, descendant_id, depth)``
+    tuples, a mapping from ``path_id_cache`` keys to local ids and, if
+    ``timed`` is set, the ``(relpath, entries, timing)`` arguments of
+    :meth:`metrics.ScanMetrics.directory_scanned` for every directory. No
+    closure tuples are built unless ``closure`` is set.
+    """
+    batch, directories, timings = Batch(closure), {}, []
+
+    def add(data, ancestors, is_directory=False):
+        file_id = len(batch) + 1
+        batch.add(data, file_id, ancestors, is_directory)
+        return file_id
+
+    # every stack item carries its local ancestor ids, nearest first
+    stack = [(path, relpath, [0])]
+    while stack:
+        path, relpath, ancestors = stack.pop()
+        timing = scan_metrics.DirectoryTiming() if timed else None
+        files, subdirectory_entries, _, _ = scan_directory(
+            path, relpath, with_stat, timing, exclusions
+        )
+        if timed:
+            timings.append((relpath, len(files) + len(subdirectory_entries), timing))
 
-        for name in files:
-            data = analyse_file(root, path, name)
-            database.insert_file(data, parent_id)
+        subdirectories = add_listing(
+            relpath, ancestors, files, subdirectory_entries, add, directories
+        )
+        stack.extend(reversed(subdirectories))
 
-        for name in directories:
-            data = analyse_file(root, path, name)
-            directory_id = database.insert_file(data, parent_id, is_directory=True)
+    return batch.files, batch.relations, directories, timings
 
-            path_id_cache[
-                os.path.relpath(os.path.join(path, name), root)
-            ] = directory_id
 
+def sharded_walk(
+    root,
+    database,
+    path_id_cache,
+    processes,
+    with_stat=True,
+    metrics=None,
+    exclusions=None,
+):
+    """Scan each top-level subtree of ``root`` in a separate process.
+
+    The root directory itself is listed here, its subdirectories are handed
+    to :func:`scan_subtree` on a process pool and the returned shards are
+    merged into ``database`` as they complete, remapping the local ids past
+    the ones already used. The result is the same as the one of :func:`walk`.
+    """
+    database.begin()
+    inserter = Inserter(database, metrics=metrics)
+
+    data = analyse_file(root, root, ".")
+    root_id = inserter.add(data, [], is_directory=True)
+    path_id_cache["."] = root_id
+
+    timing = inserter.directory_timing()
+    files, directories, _, _ = scan_directory(root, ".", with_stat, timing, exclusions)
+    inserter.directory_scanned(".", len(files) + len(directories), timing)
+    shards = add_listing(
+        ".", [root_id], files, directories, inserter.add, path_id_cache
+    )
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {
+            pool.submit(
+                scan_subtree,
+                path,
+                relpath,
+                database.uses_closure,
+                with_stat,
+                metrics is not None,
+                exclusions,
+            ): ancestors
+            for path, relpath, ancestors in shards
+        }
+        for future in concurrent.futures.as_completed(futures):
+            ancestors = futures[future]
+            *shard, timings = future.result()
+            for relpath, entries, timing in timings:
+                inserter.directory_scanned(relpath, entries, timing)
+            start = time.perf_counter()
+            merge_shard(database, path_id_cache, shard, ancestors)
+            if metrics is not None:
+                metrics.batch_inserted(len(shard[0]), time.perf_counter() - start)
+
+    inserter.flush()
     database.commit()
     database.create_session()
+
+
+def merge_shard(database, path_id_cache, shard, ancestors):
+    """Insert a :func:`scan_subtree` result below the directory whose id is
+    ``ancestors[0]``; ``ancestors`` lists its ancestor chain, nearest first.
+    """
+    files, relations, directories = shard
+    offset = database.reserve_file_ids(len(files)) - 1
+
+    for data in files:
+        data["file_id"] += offset
+        if data["parent_id"] == 0:
+            data["parent_id"] = ancestors[0]
+        else:
+            data["parent_id"] += offset
+        data["level"] += len(ancestors) - 1
+
+    remapped = []
+    for ancestor_id, descendant_id, depth in relations:
+        descendant_id += offset
+        if ancestor_id == 0:
+            # the subtree root stands for its whole chain in the database
+            remapped.extend(
+                (chain_id, descendant_id, depth + distance)
+                for distance, chain_id in enumerate(ancestors)
+            )
+        else:
+            remapped.append((ancestor_id + offset, descendant_id, depth))
+
+    database.insert_files(files)
+    database.insert_relations(remapped)
+    for relpath, file_id in directories.items():
+        path_id_cache[relpath] = file_id + offset
@@ -1,146 +1,411 @@
+import inspect
 import logging
+import os.path
 
+import sqlalchemy.exc
+
+from ifsql import advisor
 from ifsql import analyse
+from ifsql import computed
 from ifsql import database
+from ifsql import dupes
+from ifsql import hashing
+from ifsql import metrics
 from ifsql import parser
+from ifsql import watch
 
-from pygments.lexers.sql import SqlLexer
-from pygments.token import Token
-from pygments.style import Style as PygmentsStyle
-from pygments.lexers.sql import SqlLexer
+logger = logging.getLogger(__name__)
 
-from prompt_toolkit import PromptSession
-from prompt_toolkit.lexers import PygmentsLexer
-from prompt_toolkit.styles.pygments import style_from_pygments_cls
-from prompt_toolkit.styles import merge_styles
-from prompt_toolkit.completion import WordCompleter, merge_completers
-from prompt_toolkit.styles import Style as PromptToolkitStyle
+KEYWORDS = [
+    "select",
+    "distinct",
+    "all",
+    "from",
+    "collate",
+    "asc",
+    "desc",
+    "order",
+    "by",
+    "limit",
+    "offset",
+    "where",
+    "group",
+    "having" "as",
+    "not",
+    "like",
+    "glob",
+    "regexp",
+    "match",
+    "escape",
+    "isnull",
+    "notnull",
+    "not null",
+    "not",
+    "and",
+    "or",
+    "is",
+    "in",
+    "between",
+    "case",
+    "when",
+    "then",
+    "else",
+    "end",
+    "raise",
+    "ignore",
+    "rollback",
+    "abort",
+    "fail",
+    "null",
+]
 
-import tabulate
+CompletionMenuStyle = {
+    "completion-menu.completion": "bg:#008888 #ffffff",
+    "completion-menu.completion.current": "bg:#00aaaa #000000",
+    "scrollbar.background": "bg:#88aaaa",
+    "scrollbar.button": "bg:#222222",
+}
 
-import sqlalchemy.exc
 
-ColumnToken = Token.ColumnToken
-PathToken = Token.PathToken
+def _prompt_session():
+    """The prompt of :meth:`Cmd.run`, with syntax highlighting and completion.
 
-logger = logging.getLogger(__name__)
+    prompt_toolkit and Pygments are only imported here, one-shot queries and
+    scripts using :class:`Cmd` never load them."""
+    from pygments.lexers.sql import SqlLexer
+    from pygments.style import Style as PygmentsStyle
+    from pygments.token import Token
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.completion import WordCompleter, merge_completers
+    from prompt_toolkit.lexers import PygmentsLexer
+    from prompt_toolkit.styles import Style as PromptToolkitStyle
+    from prompt_toolkit.styles import merge_styles
+    from prompt_toolkit.styles.pygments import style_from_pygments_cls
 
+    columns = database.fields() + list(computed.COLUMNS)
+    ColumnToken = Token.ColumnToken
+    PathToken = Token.PathToken
 
-class SQLSyntaxStyle(PygmentsStyle):
-    default_style = ""
-    styles = {ColumnToken: "italic #808", PathToken: "bold #AA0"}
+    class SQLSyntaxStyle(PygmentsStyle):
+        default_style = ""
+        styles = {ColumnToken: "italic #808", PathToken: "bold #AA0"}
 
+    class IfsqlLexer(SqlLexer):
+        name = "IfsqlLexer"
+        aliases = ["IfsqlLexer"]
 
-CompletionMenuStyle = PromptToolkitStyle.from_dict(
-    {
-        "completion-menu.completion": "bg:#008888 #ffffff",
-        "completion-menu.completion.current": "bg:#00aaaa #000000",
-        "scrollbar.background": "bg:#88aaaa",
-        "scrollbar.button": "bg:#222222",
-    }
-)
+        def get_tokens_unprocessed(self, text):
+            for index, token, value in SqlLexer.get_tokens_unprocessed(self, text):
+                if value in columns:
+                    yield index, ColumnToken, value
+                else:
+                    yield index, token, value
 
+    return PromptSession(
+        lexer=PygmentsLexer(IfsqlLexer),
+        completer=merge_completers(
+            [
+                WordCompleter(KEYWORDS, ignore_case=True),
+                WordCompleter(columns, ignore_case=True),
+            ]
+        ),
+        style=merge_styles(
+            [
+                PromptToolkitStyle.from_dict(CompletionMenuStyle),
+                style_from_pygments_cls(SQLSyntaxStyle),
+            ]
+        ),
+    )
 
-class IfsqlLexer(SqlLexer):
-    name = "IfsqlLexer"
-    aliases = ["IfsqlLexer"]
-
-    def get_tokens_unprocessed(self, text):
-        for index, token, value in SqlLexer.get_tokens_unprocessed(self, text):
-            if value in database.fields():
-                yield index, ColumnToken, value
-            else:
-                yield index, token, value
 
+def _tabulate(rows, headers):
+    import tabulate
 
-IfsqlCompleter = merge_completers(
-    [
-        WordCompleter(
-            [
-                "select",
-                "distinct",
-                "all",
-                "from",
-                "collate",
-                "asc",
-                "desc",
-                "order",
-                "by",
-                "limit",
-                "offset",
-                "where",
-                "group",
-                "having" "as",
-                "not",
-                "like",
-                "glob",
-                "regexp",
-                "match",
-                "escape",
-                "isnull",
-                "notnull",
-                "not null",
-                "not",
-                "and",
-                "or",
-                "is",
-                "in",
-                "between",
-                "case",
-                "when",
-                "then",
-                "else",
-                "end",
-                "raise",
-                "ignore",
-                "rollback",
-                "abort",
-                "fail",
-                "null",
-            ],
-            ignore_case=True,
-        ),
-        WordCompleter(database.fields(), ignore_case=True),
-    ]
-)
+    return tabulate.tabulate(rows, headers=headers)
 
 
 class Cmd:
-    def __init__(self, root):
-        self._database = database.Database()
-        self._parser = parser.Parser()
+    def __init__(
+        self,
+        root,
+        hierarchy=database.CLOSURE,
+        catalog=None,
+        refresh=False,
+        watch=False,
+        lazy=False,
+        background=False,
+        progress=False,
+        scan_stats=None,
+        exclusions=None,
+        hash_cache=None,
+        parser_cache=None,
+        index_advisor=None,
+        compact=False,
+        **scan_options
+    ):
+        self._root = root
+        self._database = database.Database(hierarchy, catalog, compact)
+        self._parser = parser.Parser(parser_cache)
         self._path_id_cache = {}
         self._last_error = ""
-
-        self.prompt_session = PromptSession(
-            lexer=PygmentsLexer(IfsqlLexer),
-            completer=IfsqlCompleter,
-            style=merge_styles(
-                [CompletionMenuStyle, style_from_pygments_cls(SQLSyntaxStyle)]
-            ),
+        self._commands = {
+            ".refresh": self.refresh,
+            ".wait": self.wait,
+            ".dupes": self.dupes,
+            ".du": self.du,
+        }
+        self._scoped_scan = None
+        self._background_scan = None
+        self._watcher = None
+        self._scan_stats = scan_stats
+        self._exclusions = exclusions
+        # opened by the first query reading hashes, in memory without a path
+        self._hash_cache_path = hash_cache
+        self._hash_cache = None
+        self._advisor = (
+            advisor.IndexAdvisor(index_advisor) if index_advisor is not None else None
         )
+        # reported to by full scans only
+        self._metrics = None
+        if progress or scan_stats is not None:
+            self._metrics = metrics.ScanMetrics(progress=progress)
+        # whether rows may be waiting for analyse.fill_stats
+        self._stat_free = lazy or not scan_options.get("with_stat", True)
+
+        scan_info = self._database.scan_info
+        if lazy:
+            # directories are listed as queries reach them, see execute
+            self._scoped_scan = analyse.ScopedScan(
+                root, self._database, self._path_id_cache, exclusions
+            )
+            del self._commands[".refresh"]
+        elif scan_info is None and background:
+            # the prompt shows up right away, queries see what's indexed so far
+            self._database.create_session()
+            self._background_scan = analyse.BackgroundScan(
+                root,
+                self._database,
+                self._path_id_cache,
+                with_stat=scan_options.get("with_stat", True),
+                on_done=lambda: self._scan_done(watch),
+                metrics=self._metrics,
+                exclusions=exclusions,
+            )
+            self._background_scan.start()
+        elif scan_info is None:
+            analyse.walk(
+                root,
+                self._database,
+                self._path_id_cache,
+                metrics=self._metrics,
+                exclusions=exclusions,
+                **scan_options
+            )
+            self._database.record_scan(root)
+        elif scan_info.root != os.path.abspath(root):
+            raise database.DatabaseException(
+                "catalog {} holds a scan of {}".format(catalog, scan_info.root)
+            )
+        else:
+            logger.info(
+                "using the scan of %s from %s", scan_info.root, scan_info.scan_time
+            )
+            self._path_id_cache = self._database.load_path_id_cache()
+            self._database.create_session()
+            self._stat_free = self._database.has_pending_stats()
+            if refresh:
+                self.refresh()
+
+        if self._background_scan is None:
+            self._scan_done(watch)
+
+    def _scan_done(self, watch_changes):
+        """Called once the scan is complete, from the background scan thread
+        if there is one."""
+        if self._background_scan is not None:
+            with self._database.lock:
+                self._database.record_scan(self._root)
+        if self._advisor is not None:
+            self._advisor.apply(self._database)
+        if self._metrics is not None and self._metrics.finished is not None:
+            logger.info("scan: %s", self._metrics.summary())
+            if self._scan_stats is not None:
+                self._metrics.write(self._scan_stats)
+        if watch_changes:
+            self._watcher = watch.Watcher(
+                self._root,
+                self._database,
+                self._path_id_cache,
+                exclusions=self._exclusions,
+            )
+            self._watcher.start()
+
+    def _scanning(self):
+        return self._background_scan is not None and not self._background_scan.finished
 
-        analyse.walk(root, self._database, self._path_id_cache)
+    def wait(self, subdir="."):
+        """Block until the background scan has indexed ``subdir``."""
+        if not self._scanning():
+            return
+        subdir = os.path.normpath(subdir)
+        try:
+            while not self._background_scan.wait(subdir, timeout=0.1):
+                pass
+        except KeyboardInterrupt:
+            print("interrupted")
+        status = self._background_scan.status()
+        if status is not None:
+            print(status)
+
+    def refresh(self, subdir="."):
+        """Re-list the directories below ``subdir`` changed since the scan."""
+        subdir = os.path.normpath(subdir)
+        if self._scanning():
+            print("The scan is still running, see .wait")
+            return
+        if subdir not in self._path_id_cache:
+            print("Unknown directory")
+            return
+
+        stats = analyse.refresh(
+            self._root, self._database, self._path_id_cache, subdir, self._exclusions
+        )
+        if subdir == ".":
+            self._database.record_scan(self._root)
+        print("refreshed: {}".format(stats))
 
     def run(self):
-        while True:
-            try:
-                text = self.prompt_session.prompt("> ")
-            except KeyboardInterrupt:
-                continue  # Control-C pressed. Try again.
-            except EOFError:
-                break  # Control-D pressed.
-
-            if text.strip() == "?":
-                print(self._last_error)
-            else:
+        # only the interactive prompt needs a terminal
+        self.prompt_session = _prompt_session()
+        try:
+            while True:
                 try:
-                    query = self._parser.parse(text)
-                    result = self._database.query(query, self._path_id_cache)
-                    print(tabulate.tabulate(result, headers=result.keys()))
-                except (database.DatabaseException, parser.ParserException) as e:
-                    print(e)
-                except sqlalchemy.exc.SQLAlchemyError as e:
-                    self._last_error = e
-                    logger.info(e)
-                    print("database error")
+                    text = self.prompt_session.prompt("> ")
+                except KeyboardInterrupt:
+                    continue  # Control-C pressed. Try again.
+                except EOFError:
+                    break  # Control-D pressed.
+
+                self.execute(text)
+        finally:
+            if self._background_scan is not None:
+                self._background_scan.stop()
+            if self._watcher is not None:
+                self._watcher.stop()
+
+    def _hashes(self):
+        if self._hash_cache is None:
+            self._hash_cache = hashing.HashCache(self._hash_cache_path)
+        return self._hash_cache
+
+    def _subtree(self, args, usage, default):
+        """Parse the ``[FROM path] [number]`` arguments of a command and make
+        sure the subtree is scanned and stat'd. Returns ``(path, number)``, or
+        None after printing why."""
+        args = list(args)
+        path, number = ".", default
+        if args and args[0].lower() == "from" and len(args) > 1:
+            path = os.path.normpath(args[1].strip("'\""))
+            del args[:2]
+        if len(args) > 1 or (args and not args[0].isdigit()):
+            print(usage)
+            return None
+        if args:
+            number = int(args[0])
+
+        scope = parser.ScanScope(path, None, (), frozenset(["file_size"]))
+        if self._scoped_scan is not None:
+            self._scoped_scan.ensure(scope)
+        path_id = self._path_id_cache.get(path)
+        if path_id is None:
+            print("Unknown FROM path")
+            return None
+        if self._stat_free:
+            analyse.fill_stats(self._database, path_id)
+        return path, number
+
+    def dupes(self, *args):
+        """Print the groups of files with the same content, see
+        :func:`dupes.find_duplicates`: ``.dupes [FROM path] [min_size]``."""
+        subtree = self._subtree(args, "Usage: .dupes [FROM path] [min_size]", 1)
+        if subtree is None:
+            return
+        path, min_size = subtree
+
+        groups, stats = dupes.find_duplicates(
+            self._database, self._path_id_cache, path, min_size, self._hashes()
+        )
+        rows = [
+            (number, size, path)
+            for number, (size, paths) in enumerate(groups, 1)
+            for path in paths
+        ]
+        print(_tabulate(rows, headers=["group", "file_size", "full_path"]))
+        print(stats)
+
+    def du(self, *args):
+        """Print the largest directories of a subtree by the size of all they
+        hold, from ``dir_stats``: ``.du [FROM path] [count]``."""
+        subtree = self._subtree(args, "Usage: .du [FROM path] [count]", 10)
+        if subtree is None:
+            return
+        path, count = subtree
+
+        with self._database.lock:
+            rows = self._database.largest_directories(self._path_id_cache[path], count)
+        print(_tabulate(rows, headers=["total_size", "file_count", "full_path"]))
+
+    def query(self, text):
+        """Run the query ``text``, returning its column names and rows."""
+        query = self._parser.parse(text)
+        scope = parser.scan_scope(query)
+        if self._scoped_scan is not None:
+            self._scoped_scan.ensure(scope)
+        if self._stat_free and analyse.needs_stat(scope):
+            path_id = self._path_id_cache.get(scope.path)
+            if path_id is not None:
+                analyse.fill_stats(self._database, path_id, scope.max_depth)
+        if computed.needed(scope) and scope.path in self._path_id_cache:
+            computed.fill_columns(self._database, self._path_id_cache, query)
+        if hashing.needs_hash(scope) and scope.path in self._path_id_cache:
+            hashing.fill_hashes(
+                self._database, self._path_id_cache, query, self._hashes()
+            )
+        with self._database.lock:
+            if self._advisor is not None:
+                # the query below consumes its select
+                self._advisor.observe(
+                    self._database, self._parser.parse(text), self._path_id_cache
+                )
+            result = self._database.query(query, self._path_id_cache)
+            return result.keys(), result.fetchall()
+
+    def execute(self, text):
+        if text.strip() == "?":
+            print(self._last_error)
+        elif text.strip().startswith("."):
+            name, *args = text.split()
+            command = self._commands.get(name)
+            if command is None:
+                print("Unknown command")
+                return
+            try:
+                inspect.signature(command).bind(*args)
+            except TypeError:
+                print("Wrong number of arguments")
+                return
+            command(*args)
+        else:
+            try:
+                headers, rows = self.query(text)
+                print(_tabulate(rows, headers=headers))
+            except (database.DatabaseException, parser.ParserException) as e:
+                print(e)
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                self._last_error = e
+                logger.info(e)
+                print("database error")
+            if self._background_scan is not None:
+                status = self._background_scan.status()
+                if status is not None:
+                    print(status)
@@ -0,0 +1,248 @@
+import collections
+import concurrent.futures
+import functools
+import logging
+import os.path
+
+import sqlalchemy
+
+from ifsql import hashing
+from ifsql import parser
+
+logger = logging.getLogger(__name__)
+
+# what a computed column reads, the cheapest first
+NAME = "name"
+HEAD = "head"
+CONTENT = "content"
+_READS = (NAME, HEAD, CONTENT)
+
+# bytes read at the start of a file by mime_type and is_binary
+SNIFF_SIZE = 8192
+# files evaluated together by a worker
+BATCH_SIZE = 64
+# threads reading the start of files, which waits on the disk
+SNIFF_JOBS = 16
+
+
+class ComputedColumn:
+    """A column of the ``files`` table filled on demand by
+    :func:`fill_columns`.
+
+    ``compute(path)`` returns the value of the column for ``path``, it has to
+    be a module level function for worker processes to call it. ``reads``
+    tells what it looks at: the ``NAME`` of any entry, or the ``HEAD`` or the
+    whole ``CONTENT`` of regular files.
+    """
+
+    def __init__(self, name, type, compute, reads=CONTENT):
+        self.name = name
+        self.type = type
+        self.compute = compute
+        self.reads = reads
+
+
+# computed columns by name, "select *" leaves them out
+COLUMNS = collections.OrderedDict()
+# what resets the computed columns of a row whose stat changed
+UNSET = {}
+
+
+def register(column):
+    """Add a :class:`ComputedColumn`. Columns have to be registered before the
+    first :class:`database.Database` is created."""
+    COLUMNS[column.name] = column
+    UNSET[column.name] = None
+
+
+def _head(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(SNIFF_SIZE)
+    except OSError as e:
+        logger.debug("cannot read %s: %s", path, e)
+        return None
+
+
+def extension(path):
+    """The lower case extension of a file name, without the dot."""
+    return os.path.splitext(os.path.basename(path))[1][1:].lower()
+
+
+def is_binary(path):
+    """Whether the start of a file has a NUL byte, as git decides it."""
+    head = _head(path)
+    if head is None:
+        return None
+    return b"\0" in head
+
+
+# (offset, magic bytes, mime type), the first match wins
+MAGIC = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"BM", "image/bmp"),
+    (0, b"II*\0", "image/tiff"),
+    (0, b"MM\0*", "image/tiff"),
+    (8, b"WEBP", "image/webp"),
+    (8, b"WAVE", "audio/x-wav"),
+    (8, b"AVI ", "video/x-msvideo"),
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"%!PS", "application/postscript"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"BZh", "application/x-bzip2"),
+    (0, b"\xfd7zXZ\0", "application/x-xz"),
+    (0, b"\x28\xb5\x2f\xfd", "application/zstd"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (257, b"ustar", "application/x-tar"),
+    (0, b"SQLite format 3\0", "application/vnd.sqlite3"),
+    (0, b"\x7fELF", "application/x-executable"),
+    (0, b"MZ", "application/vnd.microsoft.portable-executable"),
+    (0, b"\0asm", "application/wasm"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"ID3", "audio/mpeg"),
+    (4, b"ftyp", "video/mp4"),
+    (0, b"\x1aE\xdf\xa3", "video/webm"),
+)
+
+
+def mime_type(path):
+    """The mime type of a file told by its first ``SNIFF_SIZE`` bytes."""
+    head = _head(path)
+    if head is None:
+        return None
+    if not head:
+        return "inode/x-empty"
+    for offset, magic, mime in MAGIC:
+        if head.startswith(magic, offset):
+            return mime
+    if b"\0" in head:
+        return "application/octet-stream"
+    start = head.lstrip()[:15].lower()
+    if start.startswith(b"#!"):
+        return "text/x-shellscript"
+    if start.startswith((b"<!doctype html", b"<html")):
+        return "text/html"
+    if start.startswith(b"<?xml"):
+        return "text/xml"
+    return "text/plain"
+
+
+def line_count(path):
+    """The number of lines of a file, counting a last one without a
+    newline."""
+    count, last = 0, b"\n"
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(functools.partial(f.read, hashing.CHUNK_SIZE), b""):
+                count += chunk.count(b"\n")
+                last = chunk[-1:]
+    except OSError as e:
+        logger.debug("cannot read %s: %s", path, e)
+        return None
+    return count if last == b"\n" else count + 1
+
+
+register(ComputedColumn("extension", sqlalchemy.String(), extension, reads=NAME))
+register(ComputedColumn("mime_type", sqlalchemy.String(), mime_type, reads=HEAD))
+register(ComputedColumn("is_binary", sqlalchemy.Boolean(), is_binary, reads=HEAD))
+register(ComputedColumn("line_count", sqlalchemy.Integer(), line_count))
+
+
+def needed(scope):
+    """The computed columns the query of a :class:`parser.ScanScope` reads."""
+    return [name for name in COLUMNS if name in scope.columns]
+
+
+def _evaluate_batch(compute, paths):
+    return [compute(path) for path in paths]
+
+
+def evaluate(column, paths, total_size, processes=None):
+    """The values of ``column`` for ``paths``, in order, computed in batches of
+    ``BATCH_SIZE``: by threads when reading the start of files, by processes
+    when reading more than ``hashing.PARALLEL_THRESHOLD`` bytes of content."""
+    batches = [
+        paths[start : start + BATCH_SIZE] for start in range(0, len(paths), BATCH_SIZE)
+    ]
+    evaluate_batch = functools.partial(_evaluate_batch, column.compute)
+    if len(batches) < 2 or column.reads == NAME:
+        results = map(evaluate_batch, batches)
+    elif column.reads == HEAD:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SNIFF_JOBS) as pool:
+            results = list(pool.map(evaluate_batch, batches))
+    elif processes == 1 or total_size < hashing.PARALLEL_THRESHOLD:
+        results = map(evaluate_batch, batches)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(evaluate_batch, batches))
+    return [value for batch in results for value in batch]
+
+
+def _fill(database, column, rows, processes):
+    keys = [(device, inode, mtime_ns) for _, _, device, inode, _, mtime_ns in rows]
+    known = {}
+    if column.reads != NAME:
+        with database.lock:
+            known = database.computed_values(
+                column.name, [key for key in keys if key[0] is not None]
+            )
+    missing = [index for index, key in enumerate(keys) if key not in known]
+    results = evaluate(
+        column,
+        [rows[index][1] for index in missing],
+        sum(rows[index][4] or 0 for index in missing),
+        processes=processes,
+    )
+    values = [known.get(key) for key in keys]
+    computed = {}
+    for index, value in zip(missing, results):
+        values[index] = value
+        # None is kept too, so that unreadable files aren't opened again
+        if keys[index][0] is not None:
+            computed[keys[index]] = value
+
+    updates = [
+        {"file_id": row[0], column.name: value}
+        for row, value in zip(rows, values)
+        if value is not None
+    ]
+    with database.lock:
+        database.begin()
+        if column.reads != NAME:
+            database.store_computed_values(column.name, computed)
+        database.update_files(updates)
+        database.commit()
+        database.create_session()
+    return len(missing)
+
+
+def fill_columns(database, path_id_cache, select, processes=None):
+    """Fill the computed columns ``select`` reads for the rows it may return.
+
+    Columns are evaluated the cheapest first, each only for the rows kept by
+    the conjuncts of the WHERE clause on stored columns and on the computed
+    columns filled before it, looking values up in the catalog first. Returns
+    the number of values computed.
+    """
+    names = needed(parser.scan_scope(select))
+    pending = set(names)
+    count = 0
+    for name in sorted(names, key=lambda name: _READS.index(COLUMNS[name].reads)):
+        column = COLUMNS[name]
+        filters = ["{} IS NULL".format(name)]
+        if column.reads != NAME:
+            filters.append("file_type = 'F'")
+        with database.lock:
+            rows = hashing.candidates(
+                database, path_id_cache, select, filters, hashing.COLUMNS | pending
+            )
+        pending.discard(name)
+        if rows:
+            count += _fill(database, column, rows, processes)
+    logger.info("computed %d values of %s", count, ", ".join(names))
+    return count
@@ -1,11 +1,40 @@
+import collections
+import datetime
+import functools
+import logging
+import os.path
+import threading
+
 import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.exc
 import sqlalchemy.ext.declarative
 import sqlalchemy.sql
 import sqlalchemy.orm
+import sqlalchemy.pool
 
+from ifsql import computed
+from ifsql import execution
+from ifsql import parser
 
 Base = sqlalchemy.ext.declarative.declarative_base()
 
+logger = logging.getLogger(__name__)
+
+# bump whenever the tables change, catalogs with another version are rescanned
+SCHEMA_VERSION = 9
+
+# applied to every connection of an on-disk catalog
+CATALOG_PRAGMAS = (
+    # only effective before the first table is created
+    "PRAGMA page_size = 8192",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+)
+
 
 def fields():
     return list(File._field_names) + ["depth"]
@@ -39,6 +68,29 @@ class File(Base):
     group_id = sqlalchemy.Column(sqlalchemy.Integer())
     owner_id = sqlalchemy.Column(sqlalchemy.Integer())
 
+    # exact stat times, compared by incremental refreshes
+    mtime_ns = sqlalchemy.Column(sqlalchemy.Integer())
+    ctime_ns = sqlalchemy.Column(sqlalchemy.Integer())
+    atime_ns = sqlalchemy.Column(sqlalchemy.Integer())
+    device = sqlalchemy.Column(sqlalchemy.Integer())
+    inode = sqlalchemy.Column(sqlalchemy.Integer())
+    # filled on demand by hashing.fill_hashes, reset whenever stat changes
+    content_hash = sqlalchemy.Column(sqlalchemy.String())
+    sha256 = sqlalchemy.Column(sqlalchemy.String())
+    # set by stat-free scans until the stat columns are filled
+    stat_pending = sqlalchemy.Column(sqlalchemy.Boolean(), default=False)
+    # why a walk left a directory unlisted, see exclude.Exclusions
+    excluded = sqlalchemy.Column(sqlalchemy.String())
+
+    # hierarchy, the interval bounds are only filled with INTERVAL encoding
+    is_directory = sqlalchemy.Column(sqlalchemy.Boolean(), default=False)
+    parent_id = sqlalchemy.Column(
+        sqlalchemy.Integer(), sqlalchemy.ForeignKey("files.file_id")
+    )
+    level = sqlalchemy.Column(sqlalchemy.Integer())
+    lft = sqlalchemy.Column(sqlalchemy.Integer())
+    rgt = sqlalchemy.Column(sqlalchemy.Integer())
+
     def __eq__(self, other):
         if isinstance(other, File):
             return self._fields == other._fields
@@ -62,18 +114,39 @@ class File(Base):
         return "File({})".format(", ".join(args))
 
 
+def _add_computed_columns():
+    """Give ``File`` a column for every registered computed column."""
+    for column in computed.COLUMNS.values():
+        if column.name not in File.__table__.c:
+            setattr(File, column.name, sqlalchemy.Column(column.type))
+
+
+_add_computed_columns()
+
+
 class Relation(Base):
     __tablename__ = "relations"
 
     relation_id = sqlalchemy.Column(sqlalchemy.Integer(), primary_key=True)
     ancestor_id = sqlalchemy.Column(
-        sqlalchemy.Integer(), sqlalchemy.ForeignKey("files.file_id"), index=True
+        sqlalchemy.Integer(), sqlalchemy.ForeignKey("files.file_id")
     )
     descendant_id = sqlalchemy.Column(
-        sqlalchemy.Integer(), sqlalchemy.ForeignKey("files.file_id"), index=True
+        sqlalchemy.Integer(), sqlalchemy.ForeignKey("files.file_id")
     )
     depth = sqlalchemy.Column(sqlalchemy.Integer())
 
+    # cover a FROM subtree with or without depth bounds, and the ancestors of
+    # a row, without reading the table
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_relations_ancestor_depth", "ancestor_id", "depth", "descendant_id"
+        ),
+        sqlalchemy.Index(
+            "ix_relations_descendant", "descendant_id", "ancestor_id", "depth"
+        ),
+    )
+
     ancestor = sqlalchemy.orm.relationship(
         "File", uselist=False, foreign_keys=[ancestor_id]
     )
@@ -105,17 +178,490 @@ class Relation(Base):
         return "Relation({})".format(", ".join(args))
 
 
+class ScanInfo(Base):
+    """The single row describing the scan stored in a catalog."""
+
+    __tablename__ = "scan_info"
+
+    scan_info_id = sqlalchemy.Column(sqlalchemy.Integer(), primary_key=True)
+    root = sqlalchemy.Column(sqlalchemy.String())
+    scan_time = sqlalchemy.Column(sqlalchemy.DateTime())
+    schema_version = sqlalchemy.Column(sqlalchemy.Integer())
+    hierarchy = sqlalchemy.Column(sqlalchemy.String())
+    compact = sqlalchemy.Column(sqlalchemy.Boolean(), default=False)
+
+    def __repr__(self):
+        return "ScanInfo(root={!r}, scan_time={!r}, schema_version={!r})".format(
+            self.root, self.scan_time, self.schema_version
+        )
+
+
+class ComputedValue(Base):
+    """A value of a computed column, kept for the file it was computed from,
+    see :func:`computed.fill_columns`."""
+
+    __tablename__ = "computed_values"
+
+    device = sqlalchemy.Column(sqlalchemy.Integer(), primary_key=True)
+    inode = sqlalchemy.Column(sqlalchemy.Integer(), primary_key=True)
+    mtime_ns = sqlalchemy.Column(sqlalchemy.Integer(), primary_key=True)
+    name = sqlalchemy.Column(sqlalchemy.String(), primary_key=True)
+    # no type affinity, values are stored as computed
+    value = sqlalchemy.Column(sqlalchemy.LargeBinary())
+
+
+class DirStats(Base):
+    """Aggregates of the subtree of a directory, itself included, kept up to
+    date by :meth:`Database.build_dir_stats`."""
+
+    __tablename__ = "dir_stats"
+
+    dir_id = sqlalchemy.Column(
+        sqlalchemy.Integer(), sqlalchemy.ForeignKey("files.file_id"), primary_key=True
+    )
+    entry_count = sqlalchemy.Column(sqlalchemy.Integer())
+    total_size = sqlalchemy.Column(sqlalchemy.Integer(), index=True)
+    file_count = sqlalchemy.Column(sqlalchemy.Integer())
+    file_size = sqlalchemy.Column(sqlalchemy.Integer())
+    directory_count = sqlalchemy.Column(sqlalchemy.Integer())
+    max_modification_time = sqlalchemy.Column(sqlalchemy.DateTime())
+    max_depth = sqlalchemy.Column(sqlalchemy.Integer())
+
+
+# indexes of files built once a scan completed, cheaper than keeping them
+# up to date during the scan; after the columns searched come the columns
+# the queries filtering on them usually return, so the index covers them
+FILE_INDEXES = (
+    ("parent_id",),
+    ("file_type", "file_size", "file_name", "full_path"),
+    ("modification_time", "file_name", "full_path"),
+    ("file_name", "full_path"),
+)
+# rows sampled per index by ANALYZE
+ANALYSIS_LIMIT = 1000
+
+# columns whose change makes dir_stats stale
+ROLLUP_FIELDS = frozenset(["file_type", "file_size", "modification_time"])
+
+# aggregates of a whole FROM subtree answered by dir_stats, by WHERE clause;
+# keys are the aggregates and WHERE clauses without spaces, in lower case
+# except for string literals
+ROLLUPS = {
+    None: {
+        "count(*)": "entry_count",
+        "sum(file_size)": "total_size",
+        "max(modification_time)": "max_modification_time",
+        "max(depth)": "max_depth",
+    },
+    "file_type='F'": {"count(*)": "file_count", "sum(file_size)": "file_size"},
+    "file_type='D'": {"count(*)": "directory_count"},
+}
+
+
+def _add(total, value):
+    """``SUM`` of SQL, which ignores NULL."""
+    if value is None:
+        return total
+    return value if total is None else total + value
+
+
+def _max(maximum, value):
+    if value is None:
+        return maximum
+    return value if maximum is None or value > maximum else maximum
+
+
+def _normalize(text):
+    parts = text.split("'")
+    parts[::2] = ["".join(part.split()).lower() for part in parts[::2]]
+    return "'".join(parts)
+
+
+# file_type letters, stored as their 1-based position by the compact layout
+FILE_TYPES = "DFCBNLS"
+
+
+def _timestamp(column):
+    """The text of the DateTime columns from a ``*_ns`` column, rounded to
+    the nearest microsecond. The row layout stores ``datetime.fromtimestamp``
+    of the float ``st_mtime``, which already lost precision, so the two can
+    differ by a microsecond."""
+    return (
+        "datetime(({0} + 500) / 1000000000, 'unixepoch', 'localtime') "
+        "|| printf('.%06d', ({0} + 500) / 1000 % 1000000)".format(column)
+    )
+
+
+# columns of the files view of the compact layout computed from the
+# files_compact and directories tables
+COMPACT_EXPRESSIONS = {
+    "dirname": "directories.dirname",
+    "full_path": "directories.path || '/' || files_compact.file_name",
+    "file_type": "substr('{}', files_compact.file_type, 1)".format(FILE_TYPES),
+    "access_time": _timestamp("files_compact.atime_ns"),
+    "creation_time": _timestamp("files_compact.ctime_ns"),
+    "modification_time": _timestamp("files_compact.mtime_ns"),
+}
+
+# the stored columns the computed ones of the compact layout are made from
+COMPACT_SOURCES = {
+    "dirname": "parent_id",
+    "full_path": "parent_id",
+    "access_time": "atime_ns",
+    "creation_time": "ctime_ns",
+    "modification_time": "mtime_ns",
+}
+
+
+def _create_compact_files(connection):
+    """Create the ``files`` view of the compact layout.
+
+    Rows live in ``files_compact`` without their path strings and DateTime
+    columns, and with a coded ``file_type``. The ``dirname`` of the entries of
+    a directory and the path their ``full_path`` is joined to are stored once
+    in ``directories``, keyed by the directory id, or 0 for the root. Triggers
+    turn the writes to the view into writes to both tables.
+    """
+    dialect = connection.dialect
+    stored = [
+        column
+        for column in File.__table__.columns
+        if column.name not in COMPACT_EXPRESSIONS or column.name == "file_type"
+    ]
+    definitions = []
+    for column in stored:
+        if column.primary_key:
+            definitions.append("{} INTEGER PRIMARY KEY".format(column.name))
+        elif column.name == "file_type":
+            definitions.append("file_type INTEGER")
+        else:
+            definitions.append(
+                "{} {}".format(column.name, column.type.compile(dialect=dialect))
+            )
+    names = [column.name for column in stored]
+    values = [
+        (
+            "instr('{}', NEW.file_type)".format(FILE_TYPES)
+            if name == "file_type"
+            else "NEW." + name
+        )
+        for name in names
+    ]
+    view_columns = [
+        (
+            "{} AS {}".format(COMPACT_EXPRESSIONS[column.name], column.name)
+            if column.name in COMPACT_EXPRESSIONS
+            else "files_compact." + column.name
+        )
+        for column in File.__table__.columns
+    ]
+    statements = [
+        "CREATE TABLE files_compact ({})".format(", ".join(definitions)),
+        "CREATE TABLE directories "
+        "(dir_id INTEGER PRIMARY KEY, dirname VARCHAR, path VARCHAR)",
+        "CREATE VIEW files AS SELECT {} FROM files_compact JOIN directories "
+        "ON directories.dir_id = coalesce(files_compact.parent_id, 0)".format(
+            ", ".join(view_columns)
+        ),
+        "CREATE TRIGGER files_insert INSTEAD OF INSERT ON files BEGIN "
+        "INSERT OR IGNORE INTO directories VALUES (coalesce(NEW.parent_id, 0), "
+        "NEW.dirname, "
+        "substr(NEW.full_path, 1, length(NEW.full_path) - length(NEW.file_name) - 1)); "
+        "INSERT INTO files_compact ({}) VALUES ({}); END".format(
+            ", ".join(names), ", ".join(values)
+        ),
+        "CREATE TRIGGER files_update INSTEAD OF UPDATE ON files BEGIN "
+        "UPDATE files_compact SET {} WHERE file_id = OLD.file_id; END".format(
+            ", ".join(
+                "{} = {}".format(name, value)
+                for name, value in zip(names, values)
+                if name != "file_id"
+            )
+        ),
+        "CREATE TRIGGER files_delete INSTEAD OF DELETE ON files BEGIN "
+        "DELETE FROM files_compact WHERE file_id = OLD.file_id; "
+        "DELETE FROM directories WHERE dir_id = OLD.file_id; END",
+    ]
+    for statement in statements:
+        connection.execute(statement)
+
+
+def _drop_compact_files(connection):
+    kind = connection.execute(
+        "SELECT type FROM sqlite_master WHERE name = 'files'"
+    ).scalar()
+    if kind == "view":
+        connection.execute("DROP VIEW files")
+        connection.execute("DROP TABLE IF EXISTS files_compact")
+        connection.execute("DROP TABLE IF EXISTS directories")
+
+
 class DatabaseException(Exception):
     pass
 
 
+# encodings of the directory hierarchy
+CLOSURE = "closure"
+INTERVAL = "interval"
+HIERARCHIES = (CLOSURE, INTERVAL)
+
+
 class Database:
-    def __init__(self):
-        engine = sqlalchemy.create_engine("sqlite:///:memory:")
-        Base.metadata.create_all(engine)
-        self.SessionMaker = sqlalchemy.orm.sessionmaker(engine)
-        self.file_count = 0
+    """Files metadata, kept in memory or in the on-disk ``catalog`` file.
+
+    A catalog that already holds a complete scan is reopened as it is:
+    ``scan_info`` describes that scan and ``hierarchy`` is taken from it.
+    Otherwise ``scan_info`` is ``None`` and the tables are empty.
+
+    The database may be updated from a background thread, which holds
+    ``lock`` for the whole update; readers take it while running a query.
+    """
+
+    def __init__(self, hierarchy=CLOSURE, catalog=None, compact=False):
+        if hierarchy not in HIERARCHIES:
+            raise DatabaseException("Unknown hierarchy {}".format(hierarchy))
+        self.hierarchy = hierarchy
+        self.catalog = catalog
+        self.compact = compact
+
+        self.lock = threading.RLock()
+        _add_computed_columns()
+
+        # connections are shared with the threads updating the database
+        connect_args = {"check_same_thread": False}
+        if catalog is None:
+            # a single connection, otherwise every thread has its own database
+            engine = sqlalchemy.create_engine(
+                "sqlite:///:memory:",
+                connect_args=connect_args,
+                poolclass=sqlalchemy.pool.StaticPool,
+            )
+        else:
+            engine = sqlalchemy.create_engine(
+                "sqlite:///" + catalog, connect_args=connect_args
+            )
+            sqlalchemy.event.listen(engine, "connect", _set_catalog_pragmas)
+
         self.connection = engine.connect()
+        # compiled queries, kept across sessions
+        self._statements = execution.StatementCache()
+        self.create_session()
+        self.scan_info = self._open_catalog(engine)
+        self.file_count = 0
+        # dir_stats is emptied by any change to the files, see build_dir_stats
+        self._dir_stats_ready = False
+        # whether rows were added since the interval numbering, which is only
+        # done once something reads it, see _number_intervals
+        self._intervals_stale = False
+        if self.scan_info is not None:
+            self.hierarchy = self.scan_info.hierarchy
+            self.compact = bool(self.scan_info.compact)
+            self.file_count = self.connection.execute(
+                sqlalchemy.sql.select([sqlalchemy.func.max(File.file_id)])
+            ).scalar()
+            self._dir_stats_ready = (
+                self.connection.execute(DirStats.__table__.select().limit(1)).first()
+                is not None
+            )
+            # rows may have been added after the scan was recorded
+            self._intervals_stale = True
+        self._relation_insert = str(
+            Relation.__table__.insert().compile(
+                dialect=engine.dialect,
+                column_keys=["ancestor_id", "descendant_id", "depth"],
+            )
+        )
+
+    def _open_catalog(self, engine):
+        if self.catalog is not None and os.path.exists(self.catalog):
+            try:
+                scan_info = self.connection.execute(ScanInfo.__table__.select()).first()
+            except sqlalchemy.exc.OperationalError:
+                scan_info = None
+
+            if scan_info is not None and scan_info.schema_version == SCHEMA_VERSION:
+                return scan_info
+
+            # an interrupted scan or an older schema, start from scratch
+            logger.info("discarding the content of catalog %s", self.catalog)
+            _drop_compact_files(self.connection)
+            Base.metadata.drop_all(engine)
+
+        if self.compact:
+            _create_compact_files(self.connection)
+            Base.metadata.create_all(
+                engine,
+                tables=[
+                    t for t in Base.metadata.sorted_tables if t is not File.__table__
+                ],
+            )
+        else:
+            Base.metadata.create_all(engine)
+        return None
+
+    def record_scan(self, root):
+        """Store the root and time of the scan that has just completed."""
+        self.connection.execute(ScanInfo.__table__.delete())
+        self.connection.execute(
+            ScanInfo.__table__.insert(),
+            {
+                "root": os.path.abspath(root),
+                "scan_time": datetime.datetime.now(),
+                "schema_version": SCHEMA_VERSION,
+                "hierarchy": self.hierarchy,
+                "compact": self.compact,
+            },
+        )
+        self.scan_info = self.connection.execute(ScanInfo.__table__.select()).first()
+        self._renumber()
+        self.create_indexes()
+        self.build_dir_stats()
+
+    def create_indexes(self, indexes=FILE_INDEXES):
+        """Create the missing ``files`` indexes on each tuple of column names
+        of ``indexes`` and refresh the statistics the query planner chooses
+        indexes from. Returns the names of the created indexes."""
+        existing = {index.name for index in File.__table__.indexes}
+        cursor = self.connection.connection.cursor()
+        existing.update(
+            name
+            for (name,) in cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+            )
+        )
+        created = []
+        for columns in indexes:
+            name = "ix_files_" + "_".join(columns)
+            if name not in existing and self._create_index(cursor, name, columns):
+                created.append(name)
+        cursor.execute("PRAGMA analysis_limit = {:d}".format(ANALYSIS_LIMIT))
+        cursor.execute("ANALYZE")
+        cursor.close()
+        return created
+
+    def _create_index(self, cursor, name, columns):
+        """Index ``files`` on ``columns``, or the table under the view of the
+        compact layout, where only stored columns and ``file_type`` can be
+        searched: the columns the view computes are only covered, through the
+        stored columns they are computed from. Returns whether the index
+        exists.
+
+        With the ``INTERVAL`` hierarchy every index covers ``lft`` too, which
+        bounds the FROM subtree of every query."""
+        table, expressions = "files", list(columns)
+        if self.hierarchy == INTERVAL and "lft" not in columns:
+            expressions.append("lft")
+        if self.compact:
+            table = "files_compact"
+            for index, column in enumerate(columns):
+                if column == "file_type":
+                    expressions[index] = "substr('{}', file_type, 1)".format(FILE_TYPES)
+                    # SQLite only takes the index for covering with the column
+                    # its expression reads
+                    expressions.append("file_type")
+                elif column in COMPACT_EXPRESSIONS:
+                    if index == 0:
+                        return False
+                    expressions[index] = COMPACT_SOURCES[column]
+            expressions = list(collections.OrderedDict.fromkeys(expressions))
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                name, table, ", ".join(expressions)
+            )
+        )
+        return True
+
+    def build_dir_stats(self):
+        """Fill ``dir_stats`` from the ``files`` rows.
+
+        The rows below each directory are aggregated by one grouped query,
+        then the directories are added to their parent, the deepest first.
+        """
+        directories = {}
+        cursor = self.connection.connection.cursor()
+        for file_id, parent_id, level, file_type, size, mtime in cursor.execute(
+            "SELECT file_id, parent_id, level, file_type, file_size, "
+            "modification_time FROM files WHERE is_directory"
+        ):
+            is_file, is_directory = int(file_type == "F"), int(file_type == "D")
+            directories[file_id] = [
+                parent_id,
+                level,
+                1,
+                size,
+                is_file,
+                size if is_file else None,
+                is_directory,
+                mtime,
+                level,
+            ]
+        for (
+            parent_id,
+            count,
+            size,
+            files,
+            file_size,
+            dirs,
+            mtime,
+            level,
+        ) in cursor.execute(
+            "SELECT parent_id, count(*), sum(file_size), "
+            "sum(file_type = 'F'), "
+            "sum(CASE WHEN file_type = 'F' THEN file_size END), "
+            "sum(file_type = 'D'), max(modification_time), max(level) "
+            "FROM files WHERE NOT is_directory GROUP BY parent_id"
+        ):
+            stats = directories.get(parent_id)
+            if stats is not None:
+                stats[2] += count
+                stats[3] = _add(stats[3], size)
+                stats[4] += files
+                stats[5] = _add(stats[5], file_size)
+                stats[6] += dirs
+                stats[7] = _max(stats[7], mtime)
+                stats[8] = max(stats[8], level)
+
+        for stats in sorted(directories.values(), key=lambda s: -s[1]):
+            parent = directories.get(stats[0])
+            if parent is not None:
+                parent[2] += stats[2]
+                parent[3] = _add(parent[3], stats[3])
+                parent[4] += stats[4]
+                parent[5] = _add(parent[5], stats[5])
+                parent[6] += stats[6]
+                parent[7] = _max(parent[7], stats[7])
+                parent[8] = max(parent[8], stats[8])
+
+        # the raw cursor leaves the transaction it opens to the connection
+        with self.connection.begin():
+            cursor.execute("DELETE FROM dir_stats")
+            cursor.executemany(
+                "INSERT INTO dir_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (file_id,) + tuple(stats[2:8]) + (stats[8] - stats[1],)
+                    for file_id, stats in directories.items()
+                ],
+            )
+        cursor.close()
+        self._dir_stats_ready = True
+
+    def _dir_stats_changed(self):
+        if self._dir_stats_ready:
+            self.connection.execute(DirStats.__table__.delete())
+            self._dir_stats_ready = False
+
+    def load_path_id_cache(self):
+        """Rebuild the ``path_id_cache`` of the scan stored in the database,
+        which leaves out the excluded directories."""
+        select = (
+            sqlalchemy.sql.select([File.file_id, File.dirname, File.file_name])
+            .where(File.is_directory)
+            .where(File.excluded.is_(None))
+        )
+        return {
+            os.path.normpath(os.path.join(dirname, file_name)): file_id
+            for file_id, dirname, file_name in self.connection.execute(select)
+        }
 
     def begin(self):
         self.insert_transaction = self.connection.begin()
@@ -123,13 +669,83 @@ class Database:
     def commit(self):
         self.insert_transaction.commit()
 
+    @property
+    def uses_closure(self):
+        """Whether ``relations`` rows have to be inserted."""
+        return self.hierarchy == CLOSURE
+
+    def _renumber(self):
+        """Number the rows for the ``INTERVAL`` hierarchy if rows were added
+        since they last were. Deleted rows leave gaps that don't break the
+        numbering of the rest."""
+        if self.hierarchy == INTERVAL and self._intervals_stale:
+            with self.connection.begin():
+                self._number_intervals()
+            self._intervals_stale = False
+
+    def _number_intervals(self):
+        """Give every row its pre-order number ``lft`` and the largest number
+        found in its subtree ``rgt``, so the descendants of a directory are
+        the rows with ``lft`` between the directory ``lft`` and ``rgt``.
+
+        This reads and updates the whole table, so it waits until a query,
+        a deletion or :meth:`record_scan` needs the numbers rather than
+        following every commit of a scan made in batches.
+        """
+        children = {}
+        for file_id, parent_id in self.connection.execute(
+            sqlalchemy.sql.select([File.file_id, File.parent_id])
+        ):
+            children.setdefault(parent_id, []).append(file_id)
+
+        intervals = []
+        counter = 0
+        # (file_id, None) enters a row, (file_id, lft) leaves it
+        stack = [(file_id, None) for file_id in reversed(children.get(None, []))]
+        while stack:
+            file_id, lft = stack.pop()
+            if lft is None:
+                counter += 1
+                stack.append((file_id, counter))
+                stack.extend(
+                    (child_id, None) for child_id in reversed(children.get(file_id, []))
+                )
+            else:
+                intervals.append((lft, counter, file_id))
+
+        cursor = self.connection.connection.cursor()
+        cursor.executemany(
+            "UPDATE files SET lft = ?, rgt = ? WHERE file_id = ?", intervals
+        )
+        self._create_index(cursor, "ix_files_lft", ("lft",))
+        cursor.close()
+
     def create_session(self):
-        self._session = self.SessionMaker()
+        """Start reading the files anew, after they changed."""
+        # queries skip SQLAlchemy, on the connection the updates are made on
+        self._executor = execution.Executor(
+            self.connection.connection.connection,
+            self.connection.dialect,
+            self._statements,
+        )
 
     def insert_file(self, data, parent_id, is_directory=False):
         self.file_count += 1
         data["file_id"] = self.file_count
+        data["is_directory"] = is_directory
+        data["parent_id"] = parent_id
+        data["level"] = 0
+        self._dir_stats_changed()
+        if parent_id is not None:
+            select = sqlalchemy.sql.select([File.level]).where(
+                File.file_id == parent_id
+            )
+            data["level"] = self.connection.execute(select).scalar() + 1
         self.connection.execute(File.__table__.insert(), [data])
+        self._intervals_stale = True
+
+        if not self.uses_closure:
+            return self.file_count
 
         if is_directory:
             relation_data = {
@@ -157,50 +773,340 @@ class Database:
 
         return self.file_count
 
-    def query(self, query, path_id_cache):
+    def reserve_file_ids(self, count):
+        """Reserve ``count`` consecutive file ids and return the first one."""
+        first = self.file_count + 1
+        self.file_count += count
+        return first
+
+    def insert_files(self, rows):
+        """Insert ``files`` rows that already carry their ``file_id``."""
+        if rows:
+            self.connection.execute(File.__table__.insert(), rows)
+            self._intervals_stale = True
+            self._dir_stats_changed()
+
+    def insert_relations(self, rows):
+        """Insert ``(ancestor_id, descendant_id, depth)`` tuples of the
+        ``CLOSURE`` hierarchy.
+
+        There are depth times more relations than files, so the tuples go
+        straight to a single DBAPI ``executemany``.
+        """
+        if rows:
+            cursor = self.connection.connection.cursor()
+            cursor.executemany(self._relation_insert, rows)
+            cursor.close()
+
+    def computed_values(self, name, keys):
+        """Map the ``(device, inode, mtime_ns)`` ``keys`` with a stored value
+        of the computed column ``name`` to that value, None for the files it
+        could not be computed for."""
+        cursor = self.connection.connection.cursor()
+        found = {}
+        for key in keys:
+            row = cursor.execute(
+                "SELECT value FROM computed_values WHERE device = ? AND inode = ? "
+                "AND mtime_ns = ? AND name = ?",
+                key + (name,),
+            ).fetchone()
+            if row is not None:
+                found[key] = row[0]
+        cursor.close()
+        return found
+
+    def store_computed_values(self, name, values):
+        """Store the ``key -> value`` mapping ``values`` of the computed column
+        ``name``, see :meth:`computed_values`."""
+        if values:
+            cursor = self.connection.connection.cursor()
+            cursor.executemany(
+                "INSERT OR REPLACE INTO computed_values VALUES (?, ?, ?, ?, ?)",
+                [key + (name, value) for key, value in values.items()],
+            )
+            cursor.close()
+
+    def directory_stamps(self):
+        """Map every directory id to its stored ``(mtime_ns, ctime_ns)``."""
+        select = sqlalchemy.sql.select(
+            [File.file_id, File.mtime_ns, File.ctime_ns]
+        ).where(File.is_directory)
+        return {
+            file_id: (mtime_ns, ctime_ns)
+            for file_id, mtime_ns, ctime_ns in self.connection.execute(select)
+        }
+
+    def children(self, parent_id):
+        """``(file_name, file_id, is_directory, file_type, excluded)`` of the
+        stored entries of a directory."""
+        select = sqlalchemy.sql.select(
+            [
+                File.file_name,
+                File.file_id,
+                File.is_directory,
+                File.file_type,
+                File.excluded,
+            ]
+        ).where(File.parent_id == parent_id)
+        return self.connection.execute(select).fetchall()
+
+    def update_files(self, rows):
+        """Overwrite the scanned columns of existing rows, matched by the
+        ``file_id`` of each row."""
+        if not rows:
+            return
+        columns = [c for c in rows[0] if c != "file_id"]
+        if not ROLLUP_FIELDS.isdisjoint(columns):
+            self._dir_stats_changed()
+        update = (
+            File.__table__.update()
+            .where(File.file_id == sqlalchemy.bindparam("_file_id"))
+            .values({c: sqlalchemy.bindparam(c) for c in columns})
+        )
+        params = []
+        for row in rows:
+            row = dict(row)
+            row["_file_id"] = row.pop("file_id")
+            params.append(row)
+        self.connection.execute(update, params)
+
+    def has_pending_stats(self):
+        select = sqlalchemy.sql.select([File.file_id]).where(File.stat_pending)
+        return self.connection.execute(select.limit(1)).first() is not None
+
+    def pending_stats(self, path_id, max_depth=None):
+        """``(file_id, full_path)`` of the rows below ``path_id``, down to
+        ``max_depth``, whose stat columns are still to be filled."""
+        select = sqlalchemy.sql.select([File.file_id, File.full_path]).where(
+            File.stat_pending
+        )
+        if self.hierarchy == INTERVAL:
+            self._renumber()
+            scope = (
+                sqlalchemy.sql.select([File.lft, File.rgt, File.level])
+                .where(File.file_id == path_id)
+                .alias()
+            )
+            select = select.where(File.lft.between(scope.c.lft, scope.c.rgt))
+            if max_depth is not None:
+                select = select.where(File.level - scope.c.level <= max_depth)
+        else:
+            join = sqlalchemy.orm.join(
+                File, Relation, File.file_id == Relation.descendant_id
+            )
+            select = select.select_from(join).where(Relation.ancestor_id == path_id)
+            if max_depth is not None:
+                select = select.where(Relation.depth <= max_depth)
+        return self.connection.execute(select).fetchall()
+
+    def delete_subtree(self, file_id):
+        """Delete a row and all of its descendants, returning their number."""
+        if self.uses_closure:
+            select = sqlalchemy.sql.select([Relation.descendant_id]).where(
+                Relation.ancestor_id == file_id
+            )
+        else:
+            self._renumber()
+            scope = (
+                sqlalchemy.sql.select([File.lft, File.rgt])
+                .where(File.file_id == file_id)
+                .alias()
+            )
+            select = sqlalchemy.sql.select([File.file_id]).where(
+                File.lft.between(scope.c.lft, scope.c.rgt)
+            )
+        file_ids = {row[0] for row in self.connection.execute(select)}
+        file_ids.add(file_id)
+        self._dir_stats_changed()
+
+        params = [(i,) for i in file_ids]
+        cursor = self.connection.connection.cursor()
+        cursor.executemany("DELETE FROM files WHERE file_id = ?", params)
+        if self.uses_closure:
+            cursor.executemany("DELETE FROM relations WHERE descendant_id = ?", params)
+        cursor.close()
+        return len(file_ids)
+
+    def _rollup(self, query):
+        """The ``dir_stats`` columns answering the aggregates of ``query`` over
+        its whole FROM subtree, labelled as in ``query``, or None."""
+        if (
+            query._distinct
+            or query._group_by_clause.clauses
+            or query._having is not None
+            or query._order_by_clause.clauses
+            or query._limit_clause is not None
+            or query._offset_clause is not None
+        ):
+            return None
+        where = query._whereclause
+        rollups = ROLLUPS.get(
+            _normalize(parser.clause_text(where)) if where is not None else None
+        )
+        if rollups is None:
+            return None
+        columns = []
+        for column in query._raw_columns:
+            label = (
+                column.name
+                if isinstance(column, sqlalchemy.sql.elements.Label)
+                else None
+            )
+            if label is not None:
+                column = column.element
+            if not isinstance(column, sqlalchemy.sql.elements.ColumnClause):
+                return None
+            name = rollups.get(_normalize(column.name))
+            if name is None:
+                return None
+            # untyped, like the result of the aggregate itself
+            columns.append(
+                sqlalchemy.sql.literal_column("dir_stats." + name).label(
+                    label or column.name
+                )
+            )
+        return columns
+
+    def largest_directories(self, path_id, count):
+        """``(total_size, file_count, full_path)`` of the ``count`` directories
+        of the subtree of ``path_id`` with the largest ``total_size``."""
+        if not self._dir_stats_ready:
+            self.build_dir_stats()
+        select = (
+            sqlalchemy.sql.select(
+                [DirStats.total_size, DirStats.file_count, File.full_path]
+            )
+            .select_from(
+                sqlalchemy.orm.join(DirStats, File, DirStats.dir_id == File.file_id)
+            )
+            .order_by(DirStats.total_size.desc(), File.full_path)
+            .limit(count)
+        )
+        if path_id != self._root_id():
+            if self.hierarchy == INTERVAL:
+                self._renumber()
+                scope = (
+                    sqlalchemy.sql.select([File.lft, File.rgt])
+                    .where(File.file_id == path_id)
+                    .alias()
+                )
+                select = select.where(File.lft.between(scope.c.lft, scope.c.rgt))
+            else:
+                subtree = sqlalchemy.sql.select([Relation.descendant_id]).where(
+                    Relation.ancestor_id == path_id
+                )
+                select = select.where(DirStats.dir_id.in_(subtree))
+        return [tuple(row) for row in self.connection.execute(select)]
+
+    def _root_id(self):
+        select = sqlalchemy.sql.select([File.file_id]).where(File.parent_id.is_(None))
+        return self.connection.execute(select).scalar()
+
+    def _statement(self, query, path_id_cache):
+        """``query`` over the files of its FROM subtree, or over the
+        ``dir_stats`` row of the directory for the aggregates it answers.
+
+        Returns a function building the statement, the values of its
+        parameters and the key it is compiled once by, None for queries not
+        made by :meth:`parser.Parser.parse`.
+        """
         # replace from clause into a join with relationship table
         path_id = path_id_cache.get(query.froms[0].name.strip(" '\""))
         if path_id is None:
             raise DatabaseException("Unknown FROM path")
+        shape = parser.query_shape(query)
+        values = {"path_id": path_id}
+        if shape is not None:
+            values.update(shape[1])
+
+        # aggregates of the whole subtree are looked up in dir_stats
+        rollup = self._rollup(query)
+        if rollup is not None:
+            if not self._dir_stats_ready:
+                self.build_dir_stats()
+            key = shape and (shape[0], tuple(column.name for column in rollup))
+            select = sqlalchemy.sql.select(rollup, from_obj=DirStats.__table__)
+            select = select.where(DirStats.dir_id == sqlalchemy.bindparam("path_id"))
+            return select, values, key
 
+        if self.hierarchy == INTERVAL:
+            self._renumber()
+            select = sqlalchemy.sql.select([File.lft, File.rgt, File.level]).where(
+                File.file_id == path_id
+            )
+            lft, rgt, level = self.connection.execute(select).first()
+            values.update(lft=lft, rgt=rgt, level=level)
+        key = shape and (shape[0], None)
+        return functools.partial(self._subtree_statement, query), values, key
+
+    def _subtree_statement(self, query):
         query._from_obj.clear()
-        join = sqlalchemy.orm.join(
-            File, Relation, File.file_id == Relation.descendant_id
-        )
-        query = query.select_from(join).where(Relation.ancestor_id == path_id)
+        if self.hierarchy == INTERVAL:
+            # the subtree is a range of lft numbers and depth is relative to
+            # the level of the FROM directory
+            scope = (
+                sqlalchemy.sql.select(
+                    [
+                        File,
+                        (File.level - sqlalchemy.bindparam("level")).label("depth"),
+                    ]
+                )
+                .where(
+                    File.lft.between(
+                        sqlalchemy.bindparam("lft"), sqlalchemy.bindparam("rgt")
+                    )
+                )
+                .alias("files")
+            )
+            query = query.select_from(scope)
+            depth = scope.c.depth
+        else:
+            join = sqlalchemy.orm.join(
+                File, Relation, File.file_id == Relation.descendant_id
+            )
+            query = query.select_from(join).where(
+                Relation.ancestor_id == sqlalchemy.bindparam("path_id")
+            )
+            depth = Relation.depth
 
         # ignore ancestor_id and descendant_id in result if "select *" was used
         cols = []
-        fields = (
-            File.file_name,
-            File.dirname,
-            File.full_path,
-            File.file_type,
-            File.file_size,
-            File.access_time,
-            File.modification_time,
-            File.group_id,
-            File.owner_id,
-            Relation.depth,
-        )
         for c in query._raw_columns:
             if str(c).strip() == "*":
                 cols.extend(sqlalchemy.sql.text(f) for f in File._field_names)
-                cols.append(Relation.depth)
+                cols.append(depth)
             else:
                 cols.append(c)
-        query = query.with_only_columns(cols)
+        return query.with_only_columns(cols)
 
-        result = self._session.execute(query)
-        return result
+    def query(self, query, path_id_cache):
+        """Run ``query``, returning an :class:`execution.Result`."""
+        return self._executor.execute(*self._statement(query, path_id_cache))
+
+    def explain(self, query, path_id_cache):
+        """The details of the ``EXPLAIN QUERY PLAN`` rows of ``query``."""
+        sql, params = self._executor.compile(*self._statement(query, path_id_cache))
+        cursor = self.connection.connection.cursor()
+        plan = cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        details = [row[-1] for row in plan]
+        cursor.close()
+        return details
 
     @property
     def files(self):
-        return self._session.query(File)
+        select = sqlalchemy.sql.select(File.__table__.c).order_by(File.file_id)
+        return execution.Selection(self._executor, select)
 
     @property
     def relations(self):
-        return self._session.query(Relation).options(
-            sqlalchemy.orm.joinedload("ancestor"),
-            sqlalchemy.orm.joinedload("descendant"),
-        )
+        select = sqlalchemy.sql.select(
+            [Relation.ancestor_id, Relation.descendant_id, Relation.depth]
+        ).order_by(Relation.relation_id)
+        return execution.Selection(self._executor, select)
+
+
+def _set_catalog_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in CATALOG_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
@@ -0,0 +1,234 @@
+import collections
+import concurrent.futures
+import logging
+import os
+
+import sqlalchemy.sql
+
+from ifsql import hashing
+
+logger = logging.getLogger(__name__)
+
+# bytes read at each end of a file by partial_hash
+BLOCK_SIZE = 64 * 1024
+# threads reading the blocks of partial_hash, which waits on the disk
+PARTIAL_JOBS = 16
+# partial hashes are cached next to the full ones under this algorithm
+PARTIAL_ALGORITHM = "{}_ends_{}".format(hashing.FAST_ALGORITHM, BLOCK_SIZE)
+
+
+class DupesStats:
+    """How much :func:`find_duplicates` had to read at every stage."""
+
+    def __init__(self):
+        self.files = 0
+        self.same_size = 0
+        self.same_partial_hash = 0
+        self.fully_hashed = 0
+        self.bytes_read = 0
+
+    def __str__(self):
+        return (
+            "{} files, {} sharing their size, {} sharing their first and last "
+            "blocks, {} hashed in full, {:.1f} MiB read"
+        ).format(
+            self.files,
+            self.same_size,
+            self.same_partial_hash,
+            self.fully_hashed,
+            self.bytes_read / (1 << 20),
+        )
+
+
+def partial_hash(path, size):
+    """Hash of the first and last ``BLOCK_SIZE`` bytes of a file of ``size``
+    bytes, None if it can't be read. Files of up to two blocks are read
+    whole, and then the result is their ``content_hash``."""
+    fast = hashing._fast_hash()
+    try:
+        with open(path, "rb") as f:
+            if size <= 2 * BLOCK_SIZE:
+                fast.update(f.read())
+            else:
+                fast.update(f.read(BLOCK_SIZE))
+                f.seek(-BLOCK_SIZE, os.SEEK_END)
+                fast.update(f.read(BLOCK_SIZE))
+    except OSError as e:
+        logger.debug("cannot read %s: %s", path, e)
+        return None
+    return fast.hexdigest()
+
+
+def partial_hashes(files):
+    """The :func:`partial_hash` of the ``(path, size)`` pairs ``files``."""
+    if len(files) < 2:
+        return [partial_hash(path, size) for path, size in files]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PARTIAL_JOBS) as pool:
+        return list(pool.map(lambda file: partial_hash(*file), files))
+
+
+class File:
+    """A file of the scan and the paths it is known by: hard links of the
+    same inode are one file."""
+
+    def __init__(self, key, file_ids, paths, content_hash):
+        self.key = key
+        self.file_ids = file_ids
+        self.paths = paths
+        self.content_hash = content_hash
+
+    @property
+    def size(self):
+        return self.key[2]
+
+
+def _files(database, path_id_cache, path, min_size):
+    """The regular files of at least ``min_size`` bytes below ``path``,
+    grouped by size."""
+    select = sqlalchemy.sql.select(
+        [
+            sqlalchemy.sql.literal_column(column)
+            for column in (
+                "file_id",
+                "full_path",
+                "device",
+                "inode",
+                "file_size",
+                "mtime_ns",
+                "content_hash",
+            )
+        ],
+        whereclause=sqlalchemy.sql.text(
+            "file_type = 'F' AND file_size >= {:d}".format(min_size)
+        ),
+        from_obj=sqlalchemy.sql.table(path),
+    )
+    files = {}
+    with database.lock:
+        rows = database.query(select, path_id_cache).fetchall()
+    for file_id, full_path, device, inode, size, mtime_ns, content_hash in rows:
+        key = (device, inode, size, mtime_ns)
+        if device is None:
+            # not stat'd, neither cached nor recognized as a link
+            key = (None, full_path, size, None)
+        file = files.get(key)
+        if file is None:
+            files[key] = File(key, [file_id], [full_path], content_hash)
+        else:
+            file.file_ids.append(file_id)
+            file.paths.append(full_path)
+
+    by_size = collections.defaultdict(list)
+    for file in files.values():
+        by_size[file.size].append(file)
+    return by_size
+
+
+def _colliding(groups):
+    return [group for group in groups if len(group) > 1]
+
+
+def find_duplicates(database, path_id_cache, path, min_size, cache, processes=None):
+    """Find the regular files below ``path`` of at least ``min_size`` bytes
+    with the same content.
+
+    Files are first grouped by size. Files sharing their size are then told
+    apart by the hash of their first and last blocks, and only those still
+    colliding are hashed in full, in parallel, using and filling both the
+    :class:`hashing.HashCache` ``cache`` and the ``content_hash`` column.
+
+    Returns the ``(file_size, paths)`` of every group of duplicates, the ones
+    wasting the most space first, and the :class:`DupesStats` of the search.
+    """
+    stats = DupesStats()
+    by_size = _files(database, path_id_cache, path, min_size)
+    stats.files = sum(len(group) for group in by_size.values())
+    candidates = _colliding(by_size.values())
+    stats.same_size = sum(len(group) for group in candidates)
+
+    keys = [file.key for group in candidates for file in group]
+    known = cache.get(keys, hashing.FAST_ALGORITHM)
+    for group in candidates:
+        for file in group:
+            file.content_hash = file.content_hash or known.get(file.key)
+
+    # groups whose hashes are all known skip the partial hashes
+    full_groups, partial = [], []
+    for group in candidates:
+        if all(file.content_hash is not None for file in group):
+            full_groups.append(group)
+        else:
+            partial.extend(group)
+    known = cache.get([file.key for file in partial], PARTIAL_ALGORITHM)
+    unread = [file for file in partial if file.key not in known]
+    results = partial_hashes([(file.paths[0], file.size) for file in unread])
+    read = {}
+    for file, result in zip(unread, results):
+        if result is not None:
+            stats.bytes_read += min(file.size, 2 * BLOCK_SIZE)
+            if file.key[0] is not None:
+                read[file.key] = result
+            known[file.key] = result
+    cache.put(read, PARTIAL_ALGORITHM)
+
+    by_partial_hash = collections.defaultdict(list)
+    for file in partial:
+        result = known.get(file.key)
+        if result is None:
+            continue
+        if file.size <= 2 * BLOCK_SIZE:
+            file.content_hash = result
+        by_partial_hash[file.size, result].append(file)
+    survivors = _colliding(by_partial_hash.values())
+    stats.same_partial_hash = sum(len(group) for group in survivors)
+
+    unhashed = [
+        file for group in survivors for file in group if file.content_hash is None
+    ]
+    results = hashing.hash_files(
+        [file.paths[0] for file in unhashed],
+        sum(file.size for file in unhashed),
+        processes=processes,
+    )
+    for file, (content_hash, _) in zip(unhashed, results):
+        file.content_hash = content_hash
+    stats.fully_hashed = len(unhashed)
+    stats.bytes_read += sum(file.size for file in unhashed)
+
+    hashed = [
+        file
+        for group in survivors + full_groups
+        for file in group
+        if file.content_hash is not None
+    ]
+    _store(database, cache, hashed)
+
+    by_content = collections.defaultdict(list)
+    for file in hashed:
+        by_content[file.size, file.content_hash].append(file)
+    duplicates = sorted(
+        _colliding(by_content.values()),
+        key=lambda group: (-group[0].size * (len(group) - 1), group[0].paths[0]),
+    )
+    return [
+        (group[0].size, sorted(path for file in group for path in file.paths))
+        for group in duplicates
+    ], stats
+
+
+def _store(database, cache, files):
+    cache.put(
+        {file.key: file.content_hash for file in files if file.key[0] is not None},
+        hashing.FAST_ALGORITHM,
+    )
+    with database.lock:
+        database.begin()
+        database.update_files(
+            [
+                {"file_id": file_id, "content_hash": file.content_hash}
+                for file in files
+                for file_id in file.file_ids
+            ]
+        )
+        database.commit()
+        database.create_session()
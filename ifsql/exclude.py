@@ -0,0 +1,159 @@
+import os
+import os.path
+import re
+
+GITIGNORE = ".gitignore"
+
+# values of the excluded column
+EXCLUDED = "exclude"
+GITIGNORED = "gitignore"
+MOUNT_POINT = "mount"
+
+
+class Pattern:
+    """A pattern in ``.gitignore`` syntax.
+
+    A pattern without a slash matches names anywhere below the directory it
+    is relative to, one with a slash matches paths from that directory. A
+    trailing slash only matches directories, a leading ``!`` negates it,
+    ``*`` doesn't match slashes and ``**`` does.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.negated = text.startswith("!")
+        if self.negated:
+            text = text[1:]
+        self.directory_only = text.endswith("/")
+        text = text.rstrip("/")
+        self.anchored = "/" in text
+        self.regex = re.compile(_translate(text.lstrip("/")), re.S)
+
+    def __repr__(self):
+        return "Pattern({!r})".format(self.text)
+
+    def matches(self, name, relpath):
+        """Whether an entry called ``name`` whose path from the directory of
+        the pattern is ``relpath`` matches."""
+        return self.regex.fullmatch(relpath if self.anchored else name) is not None
+
+
+def _translate(glob):
+    parts, i = [], 0
+    while i < len(glob):
+        if glob.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif glob.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif glob[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif glob[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif glob[i] == "[" and "]" in glob[i + 2 :]:
+            end = glob.index("]", i + 2)
+            content = glob[i + 1 : end]
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            parts.append("[" + content.replace("\\", "\\\\") + "]")
+            i = end + 1
+        elif glob[i] == "\\" and i + 1 < len(glob):
+            parts.append(re.escape(glob[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(glob[i]))
+            i += 1
+    return "".join(parts)
+
+
+def parse_patterns(lines):
+    """The :class:`Pattern` of every line of a ``.gitignore`` style file,
+    skipping blank lines and comments."""
+    patterns = []
+    for line in lines:
+        line = line.rstrip("\n").rstrip()
+        if line and not line.startswith("#"):
+            patterns.append(Pattern(line))
+    return patterns
+
+
+def read_patterns(path):
+    with open(path, errors="surrogateescape") as f:
+        return parse_patterns(f)
+
+
+def _excluded(rules, name, relpath, is_directory):
+    """Whether the last of the ``(base, pattern)`` rules matching an entry
+    excludes it, ``base`` being the directory the pattern is relative to."""
+    excluded = False
+    for base, pattern in rules:
+        if excluded == (not pattern.negated):
+            continue  # can't change the outcome
+        if pattern.directory_only and not is_directory:
+            continue
+        if base == ".":
+            path = relpath
+        elif relpath.startswith(base + os.sep):
+            path = relpath[len(base) + 1 :]
+        else:
+            continue
+        if pattern.matches(name, path):
+            excluded = not pattern.negated
+    return excluded
+
+
+class Exclusions:
+    """What a walk of ``root`` leaves out.
+
+    ``patterns`` are :class:`Pattern` objects relative to ``root``. With
+    ``gitignore`` the ``.gitignore`` files met on the way apply to their
+    directory and below, and with ``one_file_system`` directories on another
+    device than ``root`` are not descended into. Instances are picklable so
+    that they can be handed to the workers of :func:`analyse.sharded_walk`.
+    """
+
+    def __init__(self, root, patterns=(), gitignore=False, one_file_system=False):
+        self.root = root
+        self.patterns = [(".", pattern) for pattern in patterns]
+        self.gitignore = gitignore
+        self.device = os.stat(root).st_dev if one_file_system else None
+        # relpath -> (base, pattern) rules of the .gitignore files from the
+        # root down to that directory
+        self._gitignore_rules = {}
+
+    def rules(self, relpath):
+        """The ``.gitignore`` rules applying inside the directory ``relpath``."""
+        if not self.gitignore:
+            return ()
+        rules = self._gitignore_rules.get(relpath)
+        if rules is not None:
+            return rules
+
+        rules = () if relpath == "." else self.rules(os.path.dirname(relpath) or ".")
+        path = self.root if relpath == "." else os.path.join(self.root, relpath)
+        try:
+            patterns = read_patterns(os.path.join(path, GITIGNORE))
+        except OSError:
+            patterns = []
+        if patterns:
+            rules = rules + tuple((relpath, pattern) for pattern in patterns)
+        self._gitignore_rules[relpath] = rules
+        return rules
+
+    def excluded(self, rules, relpath, name, is_directory):
+        """Why the entry ``name`` of the directory ``relpath`` is excluded by
+        its name, or None. ``rules`` are the :meth:`rules` of ``relpath``."""
+        path = name if relpath == "." else relpath + os.sep + name
+        if self.patterns and _excluded(self.patterns, name, path, is_directory):
+            return EXCLUDED
+        if rules and _excluded(rules, name, path, is_directory):
+            return GITIGNORED
+        return None
+
+    def is_mount_point(self, device):
+        """Whether a directory on ``device`` is on another filesystem than
+        the root, when the walk stays on one."""
+        return self.device is not None and device != self.device
@@ -0,0 +1,173 @@
+import collections
+import functools
+import sqlite3
+
+import sqlalchemy.exc
+import sqlalchemy.sql
+
+# rows fetched from SQLite at a time
+ARRAY_SIZE = 1024
+# compiled statements kept, as many as the prepared statements sqlite3 keeps
+STATEMENT_CACHE_SIZE = 128
+
+
+@functools.lru_cache(maxsize=256)
+def _row_class(names):
+    # names that aren't identifiers, like "count(*)", become _0, _1, ...
+    return collections.namedtuple("Row", names, rename=True)
+
+
+class Result:
+    """The rows of an executed statement, as named tuples fetched
+    ``ARRAY_SIZE`` at a time from a cursor.
+
+    SQLite reports some errors only once rows are fetched, they are raised
+    as the ``sqlalchemy.exc.DBAPIError`` of the statement ``sql`` run with
+    ``params`` too.
+    """
+
+    def __init__(self, cursor, sql=None, params=None):
+        self._cursor = cursor
+        self._sql = sql
+        self._params = params
+        self._keys = [column[0] for column in cursor.description or ()]
+        self._make = _row_class(tuple(self._keys))._make
+
+    def _fetch(self, method, *args):
+        try:
+            return method(*args)
+        except sqlite3.Error as e:
+            self.close()
+            raise sqlalchemy.exc.DBAPIError.instance(
+                self._sql, self._params, e, sqlite3.Error
+            )
+
+    def keys(self):
+        return list(self._keys)
+
+    def __iter__(self):
+        while True:
+            rows = self._fetch(self._cursor.fetchmany, ARRAY_SIZE)
+            if not rows:
+                break
+            yield from map(self._make, rows)
+
+    def fetchmany(self, size=ARRAY_SIZE):
+        return list(map(self._make, self._fetch(self._cursor.fetchmany, size)))
+
+    def fetchall(self):
+        return list(map(self._make, self._fetch(self._cursor.fetchall)))
+
+    def first(self):
+        row = self._fetch(self._cursor.fetchone)
+        self.close()
+        return None if row is None else self._make(row)
+
+    def scalar(self):
+        row = self.first()
+        return None if row is None else row[0]
+
+    def close(self):
+        self._cursor.close()
+
+
+class StatementCache:
+    """The SQL text and parameter names of the last ``size`` statements
+    compiled by an :class:`Executor`, by key."""
+
+    def __init__(self, size=None):
+        self.size = STATEMENT_CACHE_SIZE if size is None else size
+        self._statements = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._statements.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._statements.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self._statements[key] = entry
+        if len(self._statements) > self.size:
+            self._statements.popitem(last=False)
+
+
+class Executor:
+    """Run SQLAlchemy statements on a raw ``sqlite3`` connection: they are
+    compiled once to SQL and positional parameters, and their rows skip the
+    result processing of SQLAlchemy.
+
+    Statements given a key are only compiled the first time and looked up in
+    ``cache`` after that, then SQLite reuses their prepared statement too.
+    Errors are raised as the ``sqlalchemy.exc.DBAPIError`` SQLAlchemy would
+    have raised.
+    """
+
+    def __init__(self, connection, dialect, cache=None):
+        self.connection = connection
+        self.dialect = dialect
+        self.cache = StatementCache() if cache is None else cache
+
+    def compile(self, statement, values=None, key=None):
+        """The SQL text of ``statement`` and its positional parameters.
+
+        ``statement`` may be a function building it, only called when ``key``
+        isn't cached. All the statements built for a key have to be the same
+        but for the ``values`` of their named parameters, parameters left out
+        of ``values`` keep the value they were compiled with.
+        """
+        values = values or {}
+        entry = self.cache.get(key) if key is not None else None
+        if entry is None:
+            if callable(statement):
+                statement = statement()
+            compiled = statement.compile(dialect=self.dialect)
+            defaults = {
+                name: value
+                for name, value in compiled.params.items()
+                if name not in values
+            }
+            entry = str(compiled), compiled.positiontup or (), defaults
+            if key is not None:
+                self.cache.put(key, entry)
+        sql, names, defaults = entry
+        return sql, [
+            values[name] if name in values else defaults[name] for name in names
+        ]
+
+    def execute(self, statement, values=None, key=None):
+        """Run ``statement``, see :meth:`compile`, returning a
+        :class:`Result`."""
+        sql, params = self.compile(statement, values, key)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, params)
+        except sqlite3.Error as e:
+            cursor.close()
+            raise sqlalchemy.exc.DBAPIError.instance(sql, params, e, sqlite3.Error)
+        return Result(cursor, sql, params)
+
+
+class Selection:
+    """A statement run anew whenever its rows are needed, which stands for a
+    SQLAlchemy ORM query of a whole table."""
+
+    def __init__(self, executor, statement):
+        self.executor = executor
+        self.statement = statement
+
+    def __iter__(self):
+        return iter(self.executor.execute(self.statement))
+
+    def all(self):
+        return self.executor.execute(self.statement).fetchall()
+
+    def count(self):
+        select = sqlalchemy.sql.select([sqlalchemy.func.count()]).select_from(
+            self.statement.alias()
+        )
+        return self.executor.execute(select).scalar()
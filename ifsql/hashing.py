@@ -0,0 +1,238 @@
+import concurrent.futures
+import functools
+import hashlib
+import logging
+import os
+import os.path
+import sqlite3
+
+import sqlalchemy.exc
+import sqlalchemy.sql
+
+from ifsql import parser
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+logger = logging.getLogger(__name__)
+
+# columns filled by fill_hashes, "select *" leaves them out
+CONTENT_HASH = "content_hash"
+SHA256 = "sha256"
+COLUMNS = frozenset([CONTENT_HASH, SHA256])
+
+if xxhash is not None:
+    FAST_ALGORITHM = "xxh3_128"
+    _fast_hash = xxhash.xxh3_128
+else:
+    FAST_ALGORITHM = "blake2b_128"
+    _fast_hash = functools.partial(hashlib.blake2b, digest_size=16)
+
+CHUNK_SIZE = 1 << 20
+# files hashed together by a worker process
+POOL_CHUNK = 16
+# below that many bytes files are hashed in this process
+PARALLEL_THRESHOLD = 64 << 20
+
+
+def default_cache_path():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "ifsql", "hashes.sqlite")
+
+
+class HashCache:
+    """Digests of file contents kept across sessions in a SQLite file.
+
+    Digests are keyed by ``(device, inode, size, mtime_ns)`` and the
+    algorithm, so a file is read again only once it changed. Without ``path``
+    the cache only lasts as long as the object.
+    """
+
+    def __init__(self, path=None):
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(
+            path if path is not None else ":memory:", check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "algorithm TEXT, digest TEXT, "
+            "PRIMARY KEY (device, inode, size, mtime_ns, algorithm)"
+            ") WITHOUT ROWID"
+        )
+
+    def get(self, keys, algorithm):
+        """Map the known ones of ``keys`` to their digest."""
+        found = {}
+        for key in keys:
+            row = self.connection.execute(
+                "SELECT digest FROM hashes WHERE device = ? AND inode = ? "
+                "AND size = ? AND mtime_ns = ? AND algorithm = ?",
+                key + (algorithm,),
+            ).fetchone()
+            if row is not None:
+                found[key] = row[0]
+        return found
+
+    def put(self, digests, algorithm):
+        """Store the ``key -> digest`` mapping ``digests``."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                [key + (algorithm, digest) for key, digest in digests.items()],
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+def hash_file(path, with_sha256=False):
+    """``(content_hash, sha256)`` hex digests of the file ``path``, read once
+    in ``CHUNK_SIZE`` chunks; ``sha256`` is None unless ``with_sha256``.
+    Both are None if the file can't be read."""
+    fast = _fast_hash()
+    sha256 = hashlib.sha256() if with_sha256 else None
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    try:
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                fast.update(view[:count])
+                if sha256 is not None:
+                    sha256.update(view[:count])
+    except OSError as e:
+        logger.debug("cannot hash %s: %s", path, e)
+        return None, None
+    return fast.hexdigest(), sha256.hexdigest() if sha256 is not None else None
+
+
+def hash_files(paths, total_size, with_sha256=False, processes=None):
+    """The :func:`hash_file` results of ``paths``, in order. A process pool
+    is used once there are more than ``PARALLEL_THRESHOLD`` bytes to read."""
+    hash_one = functools.partial(hash_file, with_sha256=with_sha256)
+    if processes == 1 or len(paths) < 2 or total_size < PARALLEL_THRESHOLD:
+        return [hash_one(path) for path in paths]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(hash_one, paths, chunksize=POOL_CHUNK))
+
+
+def needs_hash(scope):
+    """The hash columns the query of a :class:`parser.ScanScope` reads."""
+    return COLUMNS & scope.columns
+
+
+def candidates(database, path_id_cache, select, filters, deferred):
+    """``(file_id, full_path, device, inode, file_size, mtime_ns)`` of the
+    rows of the FROM subtree of ``select`` matching all ``filters`` and the
+    conjuncts of its WHERE clause not involving the ``deferred`` columns.
+
+    These are the rows whose hashes, or computed columns, ``select`` may
+    read, see :func:`computed.fill_columns`.
+    """
+    base_filters = list(filters)
+    filters = list(filters)
+    # the literals of the conjuncts stay bound, written in the text a ":" in
+    # a string would be read as a parameter
+    values = {}
+    for text, used, names in parser.where_parts(select) or ():
+        if names.isdisjoint(deferred):
+            filters.append("({})".format(text))
+            values.update(used)
+
+    for where, values in ((filters, values), (base_filters, {})):
+        candidates = sqlalchemy.sql.select(
+            [
+                sqlalchemy.sql.literal_column(column)
+                for column in (
+                    "file_id",
+                    "full_path",
+                    "device",
+                    "inode",
+                    "file_size",
+                    "mtime_ns",
+                )
+            ],
+            whereclause=sqlalchemy.sql.text(" AND ".join(where)).bindparams(**values),
+            from_obj=sqlalchemy.sql.table(select.froms[0].name),
+        )
+        try:
+            return database.query(candidates, path_id_cache).fetchall()
+        except sqlalchemy.exc.OperationalError:
+            # a conjunct refers to a result column alias, use the subtree
+            continue
+    return []
+
+
+def fill_hashes(database, path_id_cache, select, cache, processes=None):
+    """Fill the hash columns ``select`` reads for the rows it may return.
+
+    Only the regular files kept by the conjuncts of the WHERE clause that
+    don't involve a hash column are hashed, looking them up in the
+    :class:`HashCache` ``cache`` first. Returns the number of files read.
+    """
+    columns = needs_hash(parser.scan_scope(select))
+    if not columns:
+        return 0
+    missing = " OR ".join("{} IS NULL".format(column) for column in sorted(columns))
+    with database.lock:
+        rows = candidates(
+            database,
+            path_id_cache,
+            select,
+            ["file_type = 'F'", "({})".format(missing)],
+            COLUMNS,
+        )
+    if not rows:
+        return 0
+
+    keys = [
+        (device, inode, size, mtime_ns) for _, _, device, inode, size, mtime_ns in rows
+    ]
+    known = {CONTENT_HASH: cache.get(keys, FAST_ALGORITHM)}
+    if SHA256 in columns:
+        known[SHA256] = cache.get(keys, SHA256)
+
+    missing = [
+        index
+        for index, key in enumerate(keys)
+        if any(key not in known[column] for column in known)
+    ]
+    results = hash_files(
+        [rows[index][1] for index in missing],
+        sum(rows[index][4] or 0 for index in missing),
+        with_sha256=SHA256 in columns,
+        processes=processes,
+    )
+    computed = {CONTENT_HASH: {}, SHA256: {}}
+    for index, (content_hash, sha256) in zip(missing, results):
+        if content_hash is not None:
+            computed[CONTENT_HASH][keys[index]] = content_hash
+            computed[SHA256][keys[index]] = sha256
+    cache.put(computed[CONTENT_HASH], FAST_ALGORITHM)
+    if SHA256 in columns:
+        cache.put(computed[SHA256], SHA256)
+
+    updates = []
+    for (file_id, *_), key in zip(rows, keys):
+        update = {"file_id": file_id}
+        for column in known:
+            update[column] = known[column].get(key) or computed[column].get(key)
+        updates.append(update)
+    with database.lock:
+        database.begin()
+        database.update_files(updates)
+        database.commit()
+        database.create_session()
+
+    logger.info(
+        "hashed %d files, %d from the cache", len(missing), len(rows) - len(missing)
+    )
+    return len(missing)
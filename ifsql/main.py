@@ -3,11 +3,12 @@
 
 import argparse
 import os
+import sqlite3
 import sys
 import logging
 
-from ifsql import cmd
-from ifsql import __version__
+import ifsql
+from ifsql import exclude
 
 __author__ = "Nykakin"
 __copyright__ = "Nykakin"
@@ -15,6 +16,24 @@ __license__ = "MIT"
 
 _logger = logging.getLogger(__name__)
 
+# cmd, stream and the modules they use pull in SQLAlchemy and Lark, they are
+# imported by build_cmd and execute so that --version and argument errors
+# don't wait for them
+
+
+class VersionAction(argparse.Action):
+    """``--version``, which looks :data:`ifsql.__version__` up only when
+    given."""
+
+    def __init__(self, option_strings, dest, **kwargs):
+        super().__init__(
+            option_strings, dest, nargs=0, default=argparse.SUPPRESS, **kwargs
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print("ifsql {}".format(ifsql.__version__))
+        parser.exit()
+
 
 def parse_args(args):
     """Parse command line parameters
@@ -32,7 +51,127 @@ def parse_args(args):
         "directory", nargs="?", default=os.getcwd(), help="directory to analyse"
     )
     parser.add_argument(
-        "--version", action="version", version="ifsql {ver}".format(ver=__version__)
+        "--version",
+        action=VersionAction,
+        help="show program's version number and exit",
+    )
+    parser.add_argument(
+        "-e",
+        "--execute",
+        metavar="QUERY",
+        help="print the rows of QUERY, one tab separated line each, and exit",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="scan up to N directories concurrently",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        metavar="N",
+        help="scan top-level subdirectories in N processes",
+    )
+    parser.add_argument(
+        "--catalog",
+        metavar="PATH",
+        help="keep the scan in a SQLite file and reuse it on the next start",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="update a reopened catalog with the directories changed since",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep the scan up to date with inotify while the prompt is open",
+    )
+    parser.add_argument(
+        "--background",
+        action="store_true",
+        help="show the prompt right away and scan in the background",
+    )
+    parser.add_argument(
+        "--no-stat",
+        dest="with_stat",
+        action="store_false",
+        help="type entries from directory listings and stat them only when "
+        "a query reads their size, times or owner",
+    )
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="scan only the directories the queries need, as they need them",
+    )
+    parser.add_argument(
+        "--exclude",
+        metavar="GLOB",
+        action="append",
+        default=[],
+        help="leave out the entries matching GLOB, in .gitignore syntax "
+        "relative to the directory; can be given several times",
+    )
+    parser.add_argument(
+        "--exclude-from",
+        metavar="FILE",
+        action="append",
+        default=[],
+        help="leave out the entries matching the patterns listed in FILE",
+    )
+    parser.add_argument(
+        "--gitignore",
+        action="store_true",
+        help="leave out the entries ignored by the .gitignore files met",
+    )
+    parser.add_argument(
+        "--one-file-system",
+        action="store_true",
+        help="do not descend into directories on other filesystems",
+    )
+    parser.add_argument(
+        "--hash-cache",
+        metavar="PATH",
+        help="keep the content hashes of files in PATH "
+        "(default: ~/.cache/ifsql/hashes.sqlite)",
+    )
+    parser.add_argument(
+        "--index-advisor",
+        action="store_true",
+        help="index the columns queries filter on most after each scan, "
+        "from a log kept in ~/.cache/ifsql/workload.sqlite",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="show a live progress line and a summary while scanning",
+    )
+    parser.add_argument(
+        "--scan-stats",
+        metavar="FILE",
+        help="write scan timings and throughput as JSON to FILE, - for stdout",
+    )
+    parser.add_argument(
+        "--hierarchy",
+        choices=("closure", "interval"),
+        default="closure",
+        help="how the directory tree is stored (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="store paths once per directory and times as integers, "
+        "for less memory on large trees",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="insert scanned entries on a separate thread",
     )
     parser.add_argument(
         "-v",
@@ -50,7 +189,28 @@ def parse_args(args):
         action="store_const",
         const=logging.DEBUG,
     )
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    if parsed.lazy and (parsed.catalog or parsed.refresh or parsed.watch):
+        parser.error("--lazy cannot be combined with --catalog, --refresh or --watch")
+    if parsed.lazy and parsed.background:
+        parser.error("--lazy cannot be combined with --background")
+    if parsed.lazy and scan_tuned(parsed):
+        parser.error("--lazy cannot be combined with --jobs, --processes or --pipeline")
+    if parsed.execute is not None and (parsed.watch or parsed.background):
+        parser.error("--execute cannot be combined with --watch or --background")
+
+    parsed.exclude = [exclude.Pattern(pattern) for pattern in parsed.exclude]
+    for path in parsed.exclude_from:
+        try:
+            parsed.exclude.extend(exclude.read_patterns(path))
+        except OSError as e:
+            parser.error("cannot read --exclude-from {}: {}".format(path, e.strerror))
+    return parsed
+
+
+def scan_tuned(args):
+    """Whether options only a full scan follows were given."""
+    return args.jobs > 1 or args.processes > 1 or args.pipeline
 
 
 def setup_logging(loglevel):
@@ -65,6 +225,100 @@ def setup_logging(loglevel):
     )
 
 
+def build_exclusions(args):
+    if not (args.exclude or args.gitignore or args.one_file_system):
+        return None
+    return exclude.Exclusions(
+        args.directory,
+        args.exclude,
+        gitignore=args.gitignore,
+        one_file_system=args.one_file_system,
+    )
+
+
+def build_cmd(args, lazy=False, background=False):
+    from ifsql import advisor
+    from ifsql import cmd
+    from ifsql import hashing
+    from ifsql import parser
+
+    return cmd.Cmd(
+        args.directory,
+        hierarchy=args.hierarchy,
+        compact=args.compact,
+        catalog=args.catalog,
+        refresh=args.refresh,
+        watch=args.watch,
+        lazy=lazy,
+        background=background,
+        progress=args.progress,
+        scan_stats=args.scan_stats,
+        exclusions=build_exclusions(args),
+        hash_cache=args.hash_cache or hashing.default_cache_path(),
+        parser_cache=parser.default_cache_path(),
+        index_advisor=advisor.default_log_path() if args.index_advisor else None,
+        jobs=args.jobs,
+        processes=args.processes,
+        pipeline=args.pipeline,
+        with_stat=args.with_stat,
+    )
+
+
+def print_rows(rows):
+    for row in rows:
+        print("\t".join("" if value is None else str(value) for value in row))
+
+
+def execute(args):
+    """Run the query of ``--execute`` and return the exit status.
+
+    Queries :func:`stream.plan` accepts are evaluated while walking the
+    directory, the other ones go through a lazy scan and the database. A
+    full scan is made when its metrics or options tuning it were asked for.
+    """
+    import sqlalchemy.exc
+
+    from ifsql import database
+    from ifsql import parser
+    from ifsql import stream
+
+    measured = args.progress or args.scan_stats is not None
+    try:
+        select = parser.Parser(parser.default_cache_path()).parse(args.execute)
+        if args.catalog is not None:
+            raise stream.NotStreamable("the catalog answers it")
+        if measured:
+            raise stream.NotStreamable("scan metrics were asked for")
+        if scan_tuned(args):
+            raise stream.NotStreamable("scan options were given")
+        headers, rows = stream.execute(args.directory, select, build_exclusions(args))
+        print_rows(rows)
+        return 0
+    except stream.NotStreamable as e:
+        _logger.info("not streaming the query: %s", e)
+    except (database.DatabaseException, parser.ParserException) as e:
+        print(e)
+        return 1
+    except sqlite3.Error as e:
+        _logger.info(e)
+        print("database error")
+        return 1
+
+    try:
+        lazy = args.catalog is None and not measured and not scan_tuned(args)
+        c = build_cmd(args, lazy=lazy)
+        headers, rows = c.query(args.execute)
+    except (database.DatabaseException, parser.ParserException) as e:
+        print(e)
+        return 1
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        _logger.info(e)
+        print("database error")
+        return 1
+    print_rows(rows)
+    return 0
+
+
 def run():
     """
     Entry point for console_scripts
@@ -74,5 +328,13 @@ def run():
     if not os.path.isdir(args.directory):
         print("Not a directory")
         sys.exit(1)
-    c = cmd.Cmd(args.directory)
+    if args.execute is not None:
+        sys.exit(execute(args))
+    from ifsql import database
+
+    try:
+        c = build_cmd(args, lazy=args.lazy, background=args.background)
+    except database.DatabaseException as e:
+        print(e)
+        sys.exit(1)
     c.run()
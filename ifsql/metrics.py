@@ -0,0 +1,208 @@
+import heapq
+import json
+import os
+import sys
+import time
+
+# number of directories reported by ScanMetrics.summary as the slowest ones
+SLOWEST_DIRECTORIES = 10
+# seconds between two updates of the progress line
+PROGRESS_INTERVAL = 0.5
+
+
+class DirectoryTiming:
+    """Stat calls made while listing a single directory.
+
+    Filled by :func:`analyse.scan_directory`, possibly in a worker thread or
+    process, and handed to :meth:`ScanMetrics.directory_scanned` afterwards.
+    """
+
+    def __init__(self):
+        self.device = None
+        self.latencies = []
+
+
+class LatencyHistogram:
+    """Latencies counted in power of two buckets of microseconds: bucket
+    ``i`` holds the latencies below ``2 ** i`` us and not below the bound of
+    bucket ``i - 1``."""
+
+    def __init__(self):
+        self.buckets = []
+        self.calls = 0
+        self.total = 0.0
+
+    def record(self, latency):
+        bucket = int(latency * 1e6).bit_length()
+        if bucket >= len(self.buckets):
+            self.buckets.extend([0] * (bucket + 1 - len(self.buckets)))
+        self.buckets[bucket] += 1
+        self.calls += 1
+        self.total += latency
+
+    def percentile(self, fraction):
+        """Upper bound, in microseconds, of the bucket holding the
+        ``fraction`` quantile."""
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= fraction * self.calls:
+                return 2**bucket
+        return None
+
+    def summary(self):
+        return {
+            "calls": self.calls,
+            "total_seconds": self.total,
+            "mean_us": self.total / self.calls * 1e6 if self.calls else None,
+            "p50_us": self.percentile(0.5),
+            "p99_us": self.percentile(0.99),
+            "histogram_us": {
+                "<{}".format(2**bucket): count
+                for bucket, count in enumerate(self.buckets)
+                if count
+            },
+        }
+
+
+def device_name(device):
+    if device is None:
+        return "unknown"
+    return "{}:{}".format(os.major(device), os.minor(device))
+
+
+class ScanMetrics:
+    """Throughput and timings of a scan.
+
+    Walkers report every listed directory with :meth:`directory_scanned` and
+    every insert with :meth:`batch_inserted`, each of them always from the
+    same thread. With ``progress`` a progress line is kept up to date on
+    ``stream`` and the summary is written there at the end.
+    """
+
+    def __init__(self, progress=False, stream=sys.stderr):
+        self.progress = progress
+        self.stream = stream
+        self.started = time.monotonic()
+        self.finished = None
+        self.entries = 0
+        self.directories = 0
+        # device name -> LatencyHistogram of its stat calls
+        self.stat_latency = {}
+        self.batches = 0
+        self.batch_rows = 0
+        self.batch_seconds = 0.0
+        self.slowest_batch = 0.0
+        # (stat seconds, relpath, entries) of the slowest directories
+        self._slowest = []
+        self._progress_shown = 0.0
+
+    def directory_scanned(self, relpath, entries, timing):
+        self.directories += 1
+        self.entries += entries
+
+        histogram = self.stat_latency.get(device_name(timing.device))
+        if histogram is None:
+            histogram = self.stat_latency[device_name(timing.device)] = (
+                LatencyHistogram()
+            )
+        for latency in timing.latencies:
+            histogram.record(latency)
+
+        item = (sum(timing.latencies), relpath, entries)
+        if len(self._slowest) < SLOWEST_DIRECTORIES:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+        if self.progress:
+            now = time.monotonic()
+            if now - self._progress_shown >= PROGRESS_INTERVAL:
+                self._progress_shown = now
+                self.stream.write("\r" + self.progress_line())
+                self.stream.flush()
+
+    def batch_inserted(self, rows, seconds):
+        self.batches += 1
+        self.batch_rows += rows
+        self.batch_seconds += seconds
+        self.slowest_batch = max(self.slowest_batch, seconds)
+
+    def finish(self):
+        self.finished = time.monotonic()
+        if self.progress:
+            self.stream.write("\r" + self.progress_line() + "\n")
+            self.stream.write(str(self) + "\n")
+            self.stream.flush()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def progress_line(self):
+        elapsed = self.elapsed or 1e-9
+        return "scanned {} entries in {} directories, {:.0f} entries/s, {:.1f}s".format(
+            self.entries, self.directories, self.entries / elapsed, elapsed
+        )
+
+    def summary(self):
+        elapsed = self.elapsed or 1e-9
+        return {
+            "elapsed_seconds": elapsed,
+            "entries": self.entries,
+            "directories": self.directories,
+            "entries_per_second": self.entries / elapsed,
+            "directories_per_second": self.directories / elapsed,
+            "stat_latency": {
+                device: histogram.summary()
+                for device, histogram in sorted(self.stat_latency.items())
+            },
+            "insert_batches": {
+                "count": self.batches,
+                "rows": self.batch_rows,
+                "total_seconds": self.batch_seconds,
+                "mean_seconds": (
+                    self.batch_seconds / self.batches if self.batches else None
+                ),
+                "max_seconds": self.slowest_batch,
+            },
+            "slowest_directories": [
+                {"path": relpath, "entries": entries, "stat_seconds": seconds}
+                for seconds, relpath, entries in sorted(self._slowest, reverse=True)
+            ],
+        }
+
+    def __str__(self):
+        summary = self.summary()
+        lines = [
+            "{entries} entries, {directories} directories in {elapsed_seconds:.2f}s: "
+            "{entries_per_second:.0f} entries/s, "
+            "{directories_per_second:.0f} directories/s".format(**summary)
+        ]
+        for device, latency in summary["stat_latency"].items():
+            if latency["calls"]:
+                lines.append(
+                    "stat on {}: {calls} calls, mean {mean_us:.1f}us, "
+                    "p50 <{p50_us}us, p99 <{p99_us}us".format(device, **latency)
+                )
+        batches = summary["insert_batches"]
+        if batches["count"]:
+            lines.append(
+                "inserts: {count} batches of {rows} rows in {total_seconds:.2f}s, "
+                "slowest {max_seconds:.3f}s".format(**batches)
+            )
+        for directory in summary["slowest_directories"][:3]:
+            lines.append(
+                "slow directory: {path} ({entries} entries, "
+                "{stat_seconds:.3f}s of stat)".format(**directory)
+            )
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Write :meth:`summary` as JSON to ``path``, ``-`` being stdout."""
+        if path == "-":
+            json.dump(self.summary(), sys.stdout, indent=2)
+            sys.stdout.write("\n")
+            return
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
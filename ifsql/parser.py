@@ -1,8 +1,18 @@
+import collections
+import functools
+import logging
+import os
+import os.path
+import re
+import weakref
+
 import lark
 import lark.exceptions
 
 import sqlalchemy.sql
 
+logger = logging.getLogger(__name__)
+
 GRAMMAR = "".join(
     (
         # simple-select-stmt
@@ -10,126 +20,143 @@ GRAMMAR = "".join(
         # WITH [ RECURSIVE ] clause is not supported
         """
             simple_select: select_core simple_select_order_by simple_select_limit_offset
-    
-            simple_select_order_by: [ /order/i /by/i ordering_term ( "," ordering_term )* ]
-            simple_select_limit_offset: [ /limit/i expr [ [ /offset/i | "," ]~1 expr ] ]
 
-            ordering_term: expr [ /collate/i collation_name ] [ /asc/i | /desc/i ]
+            simple_select_order_by: [ ORDER BY ordering_terms ]
+            !simple_select_limit_offset: [ LIMIT expr [ ( OFFSET | "," ) expr ] ]
+
+            ordering_terms: ordering_term ( "," ordering_term )*
+            ordering_term: expr [ COLLATE collation_name ] [ ASC | DESC ]
         """,
         # select-core
         # https://www.sqlite.org/docsrc/doc/trunk/art/syntax/all-bnf.html#select-core
         # VALUES clause is not supported
-        """    
-            select_core: /select/i select_core_params select_core_columns select_core_from select_core_where select_core_aggr
-            select_core_params: [ /distinct/i | /all/i ]
+        """
+            select_core: SELECT select_core_params select_core_columns select_core_from select_core_where select_core_aggr
+            select_core_params: [ DISTINCT | ALL ]
             select_core_columns: result_column ( "," result_column )*
-            select_core_from: [ /from/i table_name ]
-            select_core_where: [ /where/i expr ]
-            select_core_aggr: [ /group/i /by/i expr ( "," expr )* [ /having/i expr ] ]
+            select_core_from: [ FROM table_name ]
+            select_core_where: [ WHERE expr ]
+            select_core_aggr: [ GROUP BY expr_comma [ HAVING expr ] ]
         """,
         # result-column
         # https://www.sqlite.org/docsrc/doc/trunk/art/syntax/all-bnf.html#result-column
         # passing table-name is not supported, since we have only one table with file data to work with
-        # aliasing with as is not supported for very same reason
         """
-            !result_column: "*" | expr [ /as/i string ]
+            !result_column: "*" | expr [ AS ( string | column_name ) ]
         """,
         # table name in select from can be either a string (which is a path like "./path/to/my/dir"
         # or a dot ., which is translated to local directory
         """
-            !table_name: string | "."
+            !table_name: string | PATH | "."
+
+            PATH: /[^0-9"' ,:][^"' ,]*/
         """,
         # expr
         # https://www.sqlite.org/docsrc/doc/trunk/art/syntax/all-bnf.html#expr
+        # one rule per level of operator precedence, from the loosest
+        # https://www.sqlite.org/lang_expr.html#operators_and_parse_affecting_attributes
         #
         # TODO: support select statements (https://www.sqlite.org/docsrc/doc/trunk/art/syntax/all-bnf.html#select-stmt)
         #   in order to allow subquerying?
         # TODO: support type casitng
         """
-            !expr: literal_value
+            ?expr: or_expr
+
+            !?or_expr: or_expr OR and_expr | and_expr
+            !?and_expr: and_expr AND not_expr | not_expr
+            !?not_expr: NOT not_expr | equality
+            !?equality: equality ( "=" | "==" | "!=" | "<>" ) relational
+                | equality IS [ NOT ] relational
+                | equality [ NOT ] ( LIKE | GLOB | REGEXP | MATCH ) relational [ ESCAPE relational ]
+                | equality [ NOT ] IN "(" expr_comma ")"
+                | equality [ NOT ] BETWEEN relational AND relational
+                | equality ( ISNULL | NOTNULL | NOT NULL )
+                | relational
+            !?relational: relational ( "<" | "<=" | ">" | ">=" ) bitwise | bitwise
+            !?bitwise: bitwise ( "&" | "|" | "<<" | ">>" ) additive | additive
+            !?additive: additive ( "+" | "-" ) multiplicative | multiplicative
+            !?multiplicative: multiplicative ( "*" | "/" | "%" ) concat | concat
+            !?concat: concat "||" collate | collate
+            !?collate: collate COLLATE collation_name | unary
+            !?unary: ( "+" | "-" | "~" ) unary | primary
+            !?primary: literal_value
                 | column_name
-                | unary_operator expr
-                | expr binary_operator expr
-                | expr binary_operator expr
                 | "(" expr ")"
-                | function_name "(" [ [ /distinct/i ] expr_comma | "*" ] ")"
-                | expr /collate/i collation_name
-                | expr [ /not/i ] ( /like/i | /glob/i | /regexp/i | /match/i ) expr [ /escape/i expr ]
-                | expr ( /isnull/i | /notnull/i | /not null/i )
-                | expr /is/i [ /not/i ] expr
-                | expr [ /not/i ] /in/i "(" expr_comma ")"
-                | expr [ /not/i ] /between/i expr /and/i expr
-                | /case/i [ expr ] (/when/i expr /then/i expr)* [ /else/i expr ] /end/i
-    
-            !expr_comma: expr ( "," expr )*
-
-            column_name: /[a-z_]+/
-            function_name: /[a-zA-Z]+/
-            collation_name: /[a-zA-Z]+/
-
-            !unary_operator: "+" 
-                | "-"
-                | /not/i    
-                | "~"
-
-            !binary_operator: "||"
-                | "*"
-                | "/"
-                | "%"
-                | "+"
-                | "-"
-                | "<<"
-                | ">>"
-                | "&" 
-                | "|"
-                | "<"
-                | "<="
-                | ">"
-                | ">="
-                | "="
-                | "==" 
-                | "!="
-                | "<>"
-                | /is not/i 
-                | /is/i
-                | /in/i
-                | /like/i 
-                | /glob/i 
-                | /match/i
-                | /regexp/i
-                | /and/i
-                | /or/i
-    
-            raise_function: /raise/i ( [ /ignore/i | [ /rollback/i | /abort/i | /fail/i ]~1 "," error_message ]~1 )
-            error_message: /[a-zA-Z0-9]+/
+                | function_name "(" [ [ DISTINCT ] expr_comma | "*" ] ")"
+                | CASE [ expr ] ( WHEN expr THEN expr )+ [ ELSE expr ] END
+
+            expr_comma: expr ( "," expr )*
+
+            column_name: NAME
+            function_name: NAME
+            collation_name: NAME
+
+            NAME: /[a-z_][a-z0-9_]*/i
         """,
         # literal_value
         # https://www.sqlite.org/docsrc/doc/trunk/art/syntax/all-bnf.html#literal-value
         """
-            literal_value: SIGNED_NUMBER -> number
+            literal_value: NUMBER
                 | string
-                | /null/i
-                | "CURRENT_DATE" -> current_date
-                | "CURRENT_TIME" -> current_time
-                | "CURRENT_TIMESTAMP" -> current_timestamp
+                | NULL
+                | CURRENT_DATE
+                | CURRENT_TIME
+                | CURRENT_TIMESTAMP
         """,
         # string is defined as either
         # * sequence of alphanumeric characters inside souble quotes, e.g. "test"
         # * sequence of alphanumeric characters insinde backticks, e.g. 'test'
-        # * sequence of alphanumeric characters that doesn't contain comma and spaces and doesn't
-        #   start with a number, e.g. test
+        # * a literal lifted out of the query by _lift, e.g. :p0
         """
-            string: ESCAPED_STRING | BACKTICK_STRING | /[^0-9"' ,][^"' ,]*/
+            string: ESCAPED_STRING | BACKTICK_STRING | PARAMETER
 
-            BACKTICK_STRING_INNER: ("\\\'"|/[^']/)
-            BACKTICK_STRING: "'" BACKTICK_STRING_INNER* "'"
+            BACKTICK_STRING: /'(?:[^']|'')*'/
+            PARAMETER: /:p[0-9]+/
+        """,
+        # keywords, apart from names only when they stand alone
+        """
+            ALL: "all"i
+            AND: "and"i
+            AS: "as"i
+            ASC: "asc"i
+            BETWEEN: "between"i
+            BY: "by"i
+            CASE: "case"i
+            COLLATE: "collate"i
+            CURRENT_DATE: "current_date"i
+            CURRENT_TIME: "current_time"i
+            CURRENT_TIMESTAMP: "current_timestamp"i
+            DESC: "desc"i
+            DISTINCT: "distinct"i
+            ELSE: "else"i
+            END: "end"i
+            ESCAPE: "escape"i
+            FROM: "from"i
+            GLOB: "glob"i
+            GROUP: "group"i
+            HAVING: "having"i
+            IN: "in"i
+            IS: "is"i
+            ISNULL: "isnull"i
+            LIKE: "like"i
+            LIMIT: "limit"i
+            MATCH: "match"i
+            NOT: "not"i
+            NOTNULL: "notnull"i
+            NULL: "null"i
+            OFFSET: "offset"i
+            OR: "or"i
+            ORDER: "order"i
+            REGEXP: "regexp"i
+            SELECT: "select"i
+            THEN: "then"i
+            WHEN: "when"i
+            WHERE: "where"i
         """,
         # common utilities
         """
-            number: SIGNED_NUMBER
-
             %import common.ESCAPED_STRING
-            %import common.SIGNED_NUMBER
+            %import common.NUMBER
             %import common.WS
             %ignore WS
         """,
@@ -141,48 +168,48 @@ class TreeToSqlAlchemy(lark.Transformer):
     def expr(self, args):
         return " ".join(args)
 
+    or_expr = expr
+    and_expr = expr
+    not_expr = expr
+    equality = expr
+    relational = expr
+    bitwise = expr
+    additive = expr
+    multiplicative = expr
+    concat = expr
+    collate = expr
+    unary = expr
+    primary = expr
+
     def expr_comma(self, args):
         return ", ".join(args)
 
+    ordering_terms = expr_comma
+
     def to_str(self, args):
         return str(args[0])
 
     literal_value = to_str
     string = to_str
-    number = to_str
-    binary_operator = to_str
-    unary_operator = to_str
     column_name = to_str
     table_name = to_str
     function_name = to_str
     collation_name = to_str
-    raise_function = to_str
-    error_message = to_str
 
     def simple_select(self, args):
-        select = args[0]
-        if args[1] is not None:
-            select = select.order_by(args[1])
-        if args[2][0] is not None:
-            select = select.limit(args[2][0])
-        if args[2][1] is not None:
-            select = select.offset(args[2][0])
-        return select
+        return QueryTemplate(
+            order_by=args[1], limit=args[2][0], offset=args[2][1], **args[0]
+        )
 
     def select_core(self, args):
-        select = sqlalchemy.sql.select(
-            columns=args[2], from_obj=sqlalchemy.sql.table(args[3])
+        return dict(
+            distinct=args[1] is not None,
+            columns=args[2],
+            table=args[3],
+            where=args[4],
+            group_by=args[5][0],
+            having=args[5][1],
         )
-        if args[1] is not None:
-            select = select.distinct()
-        if args[4] is not None:
-            select = select.where(args[4])
-        if args[5][0] is not None:
-            select = select.group_by(args[5][0])
-        if args[5][1] is not None:
-            select = select.having(args[5][1])
-
-        return select
 
     def select_core_from(self, args):
         return str(args[1])
@@ -198,24 +225,20 @@ class TreeToSqlAlchemy(lark.Transformer):
         return list(args)
 
     def result_column(self, args):
-        column = sqlalchemy.sql.literal_column(str(args[0]))
-        if len(args) > 1:
-            column = column.label(args[2].strip("'\"'"))
-
-        return column
+        return str(args[0]), args[2] if len(args) > 1 else None
 
     def select_core_where(self, args):
         where = None
         if len(args) > 0:
-            where = sqlalchemy.sql.text(args[1])
+            where = args[1]
         return where
 
     def select_core_aggr(self, args):
         group_by, having = None, None
         if len(args) > 0:
-            group_by = sqlalchemy.sql.text(args[2])
+            group_by = args[2]
         if len(args) > 3:
-            having = sqlalchemy.sql.text(args[4])
+            having = args[4]
         return group_by, having
 
     def ordering_term(self, args):
@@ -224,30 +247,422 @@ class TreeToSqlAlchemy(lark.Transformer):
     def simple_select_order_by(self, args):
         order_by = None
         if len(args) > 0:
-            order_by = sqlalchemy.sql.text(args[2])
+            order_by = args[2]
         return order_by
 
     def simple_select_limit_offset(self, args):
         limit, offset = None, None
         if len(args) > 0:
-            limit = sqlalchemy.sql.text(args[1])
+            limit = args[1]
         if len(args) > 3:
-            offset = sqlalchemy.sql.text(args[3])
+            offset = args[3]
+            if args[2] == ",":
+                # LIMIT offset, count
+                limit, offset = offset, limit
         return limit, offset
 
 
+# string and number literals, and the path of the FROM clause, are lifted out
+# of queries as :p0, :p1... parameters, double quoted strings may be columns
+_LITERAL = re.compile(
+    r"""
+        (?P<string>'(?:[^']|'')*')
+        | (?P<quoted>"(?:[^"]|"")*")
+        | (?P<from>\bfrom\s+)(?P<path>'(?:[^']|'')*'|"(?:[^"]|"")*"|[^\s"',]+)
+        | (?<![\w./])(?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)(?![\w.])
+    """,
+    re.VERBOSE | re.IGNORECASE,
+)
+_PARAMETER = re.compile(r"(?<![:\w]):(p[0-9]+)\b")
+
+
+def _lift(text):
+    """The shape of the query ``text``, with its literals replaced by
+    parameters, and the literals by parameter name. Raises
+    :class:`ParserException` if ``text`` has parameters of its own."""
+    literals = {}
+
+    def parameter(match):
+        kind = match.lastgroup
+        if kind == "quoted":
+            return match.group()
+        name = "p{}".format(len(literals))
+        literals[name] = match.group(kind)
+        return (match.group("from") or "") + ":" + name
+
+    shape = _LITERAL.sub(parameter, text)
+    if _PARAMETER.findall(shape) != list(literals):
+        raise ParserException("parser error")
+    return shape, literals
+
+
+def _value(literal):
+    if literal.startswith("'"):
+        return literal[1:-1].replace("''", "'")
+    try:
+        return int(literal)
+    except ValueError:
+        return float(literal)
+
+
+def _inline(text, literals):
+    return _PARAMETER.sub(lambda match: literals[match.group(1)], text)
+
+
+def _bind(text, literals, params):
+    """A text clause of ``text`` with its parameters bound, added to
+    ``params``."""
+    clause = sqlalchemy.sql.text(text)
+    names = _PARAMETER.findall(text)
+    if not names:
+        return clause
+    values = {name: _value(literals[name]) for name in names}
+    params.update(values)
+    return clause.bindparams(**values)
+
+
+class QueryTemplate(
+    collections.namedtuple(
+        "QueryTemplate",
+        [
+            "distinct",
+            "columns",
+            "table",
+            "where",
+            "group_by",
+            "having",
+            "order_by",
+            "limit",
+            "offset",
+        ],
+    )
+):
+    """The clauses of a parsed query as SQL text, with parameters in place of
+    its literals."""
+
+    def select(self, literals):
+        """The select of the query with the ``literals`` of :func:`_lift`,
+        and the values of its bound parameters.
+
+        Literals are bound in the WHERE, HAVING, LIMIT and OFFSET clauses,
+        elsewhere SQLite gives them another meaning, like the position of a
+        column in ORDER BY, and they are written as they are.
+        """
+        params = {}
+        columns = []
+        for text, label in self.columns:
+            column = sqlalchemy.sql.literal_column(_inline(text, literals))
+            if label is not None:
+                column = column.label(_inline(label, literals).strip("'\"'"))
+            columns.append(column)
+        select = sqlalchemy.sql.select(
+            columns=columns,
+            from_obj=sqlalchemy.sql.table(_inline(self.table, literals)),
+        )
+        if self.distinct:
+            select = select.distinct()
+        if self.where is not None:
+            select = select.where(_bind(self.where, literals, params))
+        if self.group_by is not None:
+            select = select.group_by(
+                sqlalchemy.sql.text(_inline(self.group_by, literals))
+            )
+        if self.having is not None:
+            select = select.having(_bind(self.having, literals, params))
+        if self.order_by is not None:
+            select = select.order_by(
+                sqlalchemy.sql.text(_inline(self.order_by, literals))
+            )
+        if self.limit is not None:
+            select = select.limit(_bind(self.limit, literals, params))
+        if self.offset is not None:
+            select = select.offset(_bind(self.offset, literals, params))
+        return select, params
+
+
+def _bind_values(clause):
+    return {
+        name: bind.value for name, bind in getattr(clause, "_bindparams", {}).items()
+    }
+
+
+def _write_values(text, values):
+    return _PARAMETER.sub(
+        lambda match: (
+            (
+                "'{}'".format(values[match.group(1)].replace("'", "''"))
+                if isinstance(values[match.group(1)], str)
+                else str(values[match.group(1)])
+            )
+            if match.group(1) in values
+            else match.group()
+        ),
+        text,
+    )
+
+
+def clause_text(clause):
+    """The SQL text of a text clause of a parsed query, with the values of its
+    parameters written in."""
+    values = _bind_values(clause)
+    if not values:
+        return clause.text
+    return _write_values(clause.text, values)
+
+
 class ParserException(Exception):
     pass
 
 
+# parsed query shapes kept by a Parser
+TEMPLATE_CACHE_SIZE = 128
+
+# the shape and parameter values of the selects made by Parser.parse
+_SHAPES = weakref.WeakKeyDictionary()
+
+
+def default_cache_path():
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "ifsql", "parser.lark")
+
+
+def _lark(cache_path):
+    """The LALR parser of ``GRAMMAR``, its tables loaded from ``cache_path``
+    or saved there once built. Lark rebuilds them if the cache was saved for
+    another grammar or version of lark."""
+    options = dict(start="simple_select", parser="lalr", maybe_placeholders=False)
+    if cache_path is not None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            return lark.Lark(GRAMMAR, cache=cache_path, **options)
+        except OSError as e:
+            logger.debug("cannot cache the parser in %s: %s", cache_path, e)
+    return lark.Lark(GRAMMAR, **options)
+
+
 class Parser:
-    def __init__(self):
-        self._parser = lark.Lark(GRAMMAR, start="simple_select")
+    """Parse queries into selects.
+
+    The parser tables are cached in ``cache_path``, such as
+    :func:`default_cache_path`, without one they are built every time.
+    """
+
+    def __init__(self, cache_path=None):
+        self._parser = _lark(cache_path)
         self._transformer = TreeToSqlAlchemy()
+        self._template = functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)(
+            self._parse_shape
+        )
+
+    def _parse_shape(self, shape):
+        return self._transformer.transform(self._parser.parse(shape))
 
     def parse(self, text):
+        """The select of the query ``text``. Queries differing only by their
+        literals and FROM path are only parsed once."""
+        shape, literals = _lift(text)
         try:
-            tree = self._parser.parse(text)
-            return self._transformer.transform(tree)
+            template = self._template(shape)
         except lark.exceptions.LarkError as e:
             raise ParserException("parser error") from e
+        select, params = template.select(literals)
+        _SHAPES[select] = (shape, params)
+        return select
+
+
+def query_shape(select):
+    """``(shape, params)`` of a select made by :meth:`Parser.parse`: the query
+    text with parameters in place of its literals and FROM path, and the values
+    of the parameters bound in its clauses. None for other selects."""
+    return _SHAPES.get(select)
+
+
+ScanScope = collections.namedtuple(
+    "ScanScope", ["path", "max_depth", "dirnames", "columns"]
+)
+ScanScope.__doc__ = """The part of the tree a query can return rows from.
+
+``max_depth`` is the largest ``depth`` allowed by the WHERE clause or None,
+``dirnames`` holds ``(value, exact, case_sensitive)`` constraints on
+``dirname``: ``value`` is either the whole ``dirname`` or a prefix of it.
+``columns`` holds every name the query may refer to a column by, and
+``"*"`` when all columns are selected.
+"""
+
+_TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<string>'(?:[^']|'')*')
+        | (?P<quoted>"(?:[^"]|"")*")
+        | (?P<number>\d+(?:\.\d*)?)
+        | (?P<word>[A-Za-z_][A-Za-z_0-9]*)
+        | (?P<operator><=|>=|==|!=|<>|\|\||<<|>>|\S)
+    )""",
+    re.VERBOSE,
+)
+
+_LIKE_WILDCARDS = re.compile(r"[%_]")
+_GLOB_WILDCARDS = re.compile(r"[*?\[]")
+
+
+def _tokenize(text):
+    tokens = []
+    for match in _TOKEN.finditer(text):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = value[1:-1].replace("''", "'")
+        elif kind == "quoted":
+            # sqlite reads "x" as a column if there is one, else as a string
+            kind, value = "string", value[1:-1].replace('""', '"')
+            if value in ("depth", "dirname"):
+                kind = "word"
+        if kind == "word":
+            value = value.lower()
+        tokens.append((kind, value))
+    return tokens
+
+
+def _conjunct_bounds(tokens):
+    """``(start, end)`` token indices of the parts of ``tokens`` separated by
+    top level ANDs, None if there is a top level OR."""
+    bounds, start = [], 0
+    parentheses = cases = betweens = 0
+    for index, token in enumerate(tokens):
+        if parentheses == 0 and cases == 0:
+            if token == ("word", "or"):
+                return None
+            if token == ("word", "and"):
+                if betweens:
+                    betweens -= 1
+                else:
+                    bounds.append((start, index))
+                    start = index + 1
+                    continue
+            elif token == ("word", "between"):
+                betweens += 1
+        if token == ("operator", "("):
+            parentheses += 1
+        elif token == ("operator", ")"):
+            parentheses -= 1
+        elif token == ("word", "case"):
+            cases += 1
+        elif token == ("word", "end"):
+            cases -= 1
+    bounds.append((start, len(tokens)))
+    return bounds
+
+
+def _conjuncts(tokens):
+    """Split ``tokens`` on top level ANDs, None if there is a top level OR."""
+    bounds = _conjunct_bounds(tokens)
+    if bounds is None:
+        return None
+    return [tokens[start:end] for start, end in bounds]
+
+
+def where_parts(select):
+    """``(text, values, names)`` of the top level conjuncts of the WHERE
+    clause of ``select``: their SQL text with parameters, the values of
+    their parameters and the names they may refer to. None when there is a
+    top level OR."""
+    where = select._whereclause
+    if where is None:
+        return []
+    matches = list(_TOKEN.finditer(where.text))
+    bounds = _conjunct_bounds(_tokenize(where.text))
+    if bounds is None:
+        return None
+
+    values = _bind_values(where)
+    parts = []
+    for start, end in bounds:
+        if start == end:
+            continue
+        text = where.text[
+            matches[start].start(matches[start].lastgroup) : matches[end - 1].end()
+        ]
+        used = {name: values[name] for name in _PARAMETER.findall(text)}
+        tokens = _tokenize(_write_values(text, used))
+        names = {value for kind, value in tokens if kind != "operator"}
+        parts.append((text, used, frozenset(names)))
+    return parts
+
+
+def where_conjuncts(select):
+    """``(text, names)`` of every top level conjunct of the WHERE clause of
+    ``select``, ``names`` being the column names it may refer to. None when
+    there is a top level OR, an empty list without WHERE clause."""
+    parts = where_parts(select)
+    if parts is None:
+        return None
+    return [(_write_values(text, values), names) for text, values, names in parts]
+
+
+def _max_depth(conjunct):
+    if len(conjunct) == 3:
+        (left_kind, left), (_, operator), (right_kind, right) = conjunct
+        if left == "depth" and left_kind == "word" and right_kind == "number":
+            bound = {"<": -1, "<=": 0, "=": 0, "==": 0}.get(operator)
+            number = right
+        elif right == "depth" and right_kind == "word" and left_kind == "number":
+            bound = {">": -1, ">=": 0, "=": 0, "==": 0}.get(operator)
+            number = left
+        else:
+            return None
+        if bound is None or "." in number:
+            return None
+        return int(number) + bound
+    if (
+        len(conjunct) == 5
+        and conjunct[:2] == [("word", "depth"), ("word", "between")]
+        and conjunct[3] == ("word", "and")
+    ):
+        upper_kind, upper = conjunct[4]
+        if upper_kind == "number" and "." not in upper:
+            return int(upper)
+    return None
+
+
+def _dirname(conjunct):
+    if len(conjunct) != 3 or conjunct[0] != ("word", "dirname"):
+        return None
+    _, (_, operator), (value_kind, value) = conjunct
+    if value_kind != "string":
+        return None
+    if operator in ("=", "=="):
+        return value, True, True
+    if operator == "like":
+        return _LIKE_WILDCARDS.split(value)[0], False, False
+    if operator == "glob":
+        return _GLOB_WILDCARDS.split(value)[0], False, True
+    return None
+
+
+def scan_scope(select):
+    """Find the subtree and the depth and ``dirname`` bounds of ``select``.
+
+    Only conjuncts of the WHERE clause are used, so a clause with a top level
+    OR gives no bounds.
+    """
+    path = os.path.normpath(select.froms[0].name.strip(" '\""))
+    max_depth, dirnames = None, []
+
+    where = select._whereclause
+    conjuncts = _conjuncts(_tokenize(clause_text(where))) if where is not None else None
+    for conjunct in conjuncts or ():
+        depth = _max_depth(conjunct)
+        if depth is not None:
+            max_depth = depth if max_depth is None else min(max_depth, depth)
+            continue
+        dirname = _dirname(conjunct)
+        if dirname is not None:
+            dirnames.append(dirname)
+
+    # the shape of a parsed query names the same columns without compiling it
+    shape = query_shape(select)
+    text = shape[0] if shape is not None else str(select)
+    columns = {value for kind, value in _tokenize(text) if kind in ("word", "string")}
+    if any(getattr(column, "name", None) == "*" for column in select._raw_columns):
+        columns.add("*")
+
+    return ScanScope(path, max_depth, tuple(dirnames), frozenset(columns))
@@ -0,0 +1,355 @@
+import logging
+import os
+import os.path
+import re
+import sqlite3
+import time
+
+import sqlalchemy.dialects.sqlite
+import sqlalchemy.sql
+
+from ifsql import analyse
+from ifsql import database
+from ifsql import computed
+from ifsql import hashing
+from ifsql import parser
+
+logger = logging.getLogger(__name__)
+
+# rows evaluated at once, or everything scanned during FLUSH_INTERVAL seconds
+BATCH_SIZE = 1000
+FLUSH_INTERVAL = 0.2
+
+COLUMNS = database.fields()
+# columns queries may use that "select *" leaves out
+HIDDEN_COLUMNS = ["excluded", "device", "inode"]
+_CREATE_STREAM = "CREATE TABLE stream ({})".format(", ".join(COLUMNS + HIDDEN_COLUMNS))
+
+# the start of an aggregate call, anywhere in an expression
+AGGREGATE = re.compile(r"\b(count|sum|total|min|max|avg)\s*\(", re.I)
+# parentheses, strings as a whole, and the text between them
+_TOKEN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|[()]|[^'\"()]+")
+
+
+class NotStreamable(Exception):
+    pass
+
+
+def _aggregate(expression):
+    """``(function, argument)`` when ``expression`` is a single aggregate call,
+    like ``sum(file_size)``, None when it is anything else: ``sum(a) / 2`` has
+    to be computed from the combined sum, not summed over the batches."""
+    match = AGGREGATE.match(expression.strip())
+    if match is None:
+        return None
+    rest = expression.strip()[match.end() :]
+    depth = 1
+    for token in _TOKEN.finditer(rest):
+        if token.group() == "(":
+            depth += 1
+        elif token.group() == ")":
+            depth -= 1
+            if depth == 0:
+                if rest[token.end() :].strip():
+                    return None
+                return match.group(1), rest[: token.start()]
+    return None
+
+
+def _combine_sum(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def _combine_min(values):
+    values = [v for v in values if v is not None]
+    return min(values) if values else None
+
+
+def _combine_max(values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def _combine_avg(sums, counts):
+    total, count = _combine_sum(sums), sum(counts)
+    return total / count if count else None
+
+
+class Aggregate:
+    """An aggregate result column computed from per batch partial results.
+
+    ``partials`` are the SQL expressions evaluated on every batch and
+    ``combine`` reduces the list of values each of them took.
+    """
+
+    PARTIALS = {
+        "count": ("count({})",),
+        "sum": ("sum({})",),
+        "total": ("total({})",),
+        "min": ("min({})",),
+        "max": ("max({})",),
+        "avg": ("sum({})", "count({})"),
+    }
+    COMBINE = {
+        "count": sum,
+        "sum": _combine_sum,
+        "total": sum,
+        "min": _combine_min,
+        "max": _combine_max,
+        "avg": _combine_avg,
+    }
+
+    def __init__(self, function, argument):
+        function = function.lower()
+        self.partials = [p.format(argument) for p in self.PARTIALS[function]]
+        self.combine = self.COMBINE[function]
+
+
+class Plan:
+    """How a parsed select is evaluated batch by batch, see :func:`plan`."""
+
+    def __init__(self, select, headers, aggregates, limit, params=()):
+        self.select = select
+        self.headers = headers
+        self.aggregates = aggregates
+        self.limit = limit
+        self.params = params
+
+
+def _header(column):
+    if isinstance(column, sqlalchemy.sql.elements.Label):
+        return column.name, str(column.element)
+    return str(column), str(column)
+
+
+def plan(select):
+    """Check that ``select`` can be evaluated while walking and build its
+    :class:`Plan`, raise :class:`NotStreamable` otherwise.
+
+    Filters and projections are evaluated on every batch of rows and, with a
+    LIMIT, stop the walk once enough rows were found. A select made of
+    aggregates only is reduced from the partial results of every batch.
+    Sorting, grouping, DISTINCT and OFFSET need the whole table, and hashes
+    and computed columns are filled by the database once the other filters
+    applied.
+    """
+    scope = parser.scan_scope(select)
+    if hashing.needs_hash(scope):
+        raise NotStreamable("the query reads content hashes")
+    if computed.needed(scope):
+        raise NotStreamable("the query reads computed columns")
+    if (
+        select._distinct
+        or select._group_by_clause.clauses
+        or select._having is not None
+        or select._order_by_clause.clauses
+        or select._offset_clause is not None
+    ):
+        raise NotStreamable("the query needs the whole table")
+
+    limit = None
+    if select._limit_clause is not None:
+        try:
+            limit = int(parser.clause_text(select._limit_clause))
+        except ValueError:
+            raise NotStreamable("LIMIT is not a number")
+
+    columns = list(select._raw_columns)
+    headers, expressions = zip(*(_header(c) for c in columns))
+    aggregates = []
+    for expression in expressions:
+        call = _aggregate(expression)
+        if call is None or call[1].strip().lower().startswith("distinct"):
+            break
+        aggregates.append(Aggregate(*call))
+
+    if len(aggregates) == len(columns):
+        partials = [p for aggregate in aggregates for p in aggregate.partials]
+        columns = [sqlalchemy.sql.literal_column(p) for p in partials]
+    elif any(AGGREGATE.search(e) for e in expressions):
+        raise NotStreamable("aggregates mixed with other columns or expressions")
+    else:
+        aggregates = None
+        # the stream table has the columns "select *" returns from the
+        # database and the hidden ones
+        columns = [
+            c
+            for column in columns
+            for c in (
+                [sqlalchemy.sql.literal_column(c) for c in COLUMNS]
+                if str(column) == "*"
+                else [column]
+            )
+        ]
+
+    batch_select = sqlalchemy.sql.select(
+        columns,
+        whereclause=select._whereclause,
+        from_obj=sqlalchemy.sql.table("stream"),
+    )
+    compiled = batch_select.compile(dialect=sqlalchemy.dialects.sqlite.dialect())
+    params = [compiled.params[name] for name in compiled.positiontup]
+    # SQLite checks the columns and functions the statement names when it
+    # prepares it, the database knows the columns the stream table hasn't
+    connection = sqlite3.connect(":memory:")
+    try:
+        connection.execute(_CREATE_STREAM)
+        connection.execute("EXPLAIN " + str(compiled), params)
+    except sqlite3.Error as e:
+        raise NotStreamable("the stream table cannot run the query: {}".format(e))
+    finally:
+        connection.close()
+    headers = [
+        h for header in headers for h in (COLUMNS if header == "*" else [header])
+    ]
+    return Plan(str(compiled), headers, aggregates, limit, params)
+
+
+class Evaluator:
+    """Runs the per batch statement of a :class:`Plan` on a small SQLite
+    table that only ever holds the current batch."""
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.connection = sqlite3.connect(":memory:")
+        self.columns = COLUMNS + HIDDEN_COLUMNS
+        self.connection.execute(_CREATE_STREAM)
+        self.insert = "INSERT INTO stream VALUES ({})".format(
+            ", ".join("?" * len(self.columns))
+        )
+
+        # values are stored the way the files table stores them
+        dialect = sqlalchemy.dialects.sqlite.dialect()
+        table = database.File.__table__
+        self.processors = [
+            (
+                table.c[c].type.dialect_impl(dialect).bind_processor(dialect)
+                if c in table.c
+                else None
+            )
+            for c in self.columns
+        ]
+
+    def row(self, data):
+        values = []
+        for column, processor in zip(self.columns, self.processors):
+            value = data[column]
+            if processor is not None and value is not None:
+                value = processor(value)
+            values.append(value)
+        return values
+
+    def evaluate(self, rows):
+        self.connection.executemany(self.insert, rows)
+        result = self.connection.execute(self.plan.select, self.plan.params).fetchall()
+        self.connection.execute("DELETE FROM stream")
+        return result
+
+    def close(self):
+        self.connection.close()
+
+
+def walk(root, scope, exclusions=None):
+    """Yield the entries of the FROM subtree of ``scope`` with their
+    ``depth``, pruned by the depth and ``dirname`` bounds of ``scope`` and by
+    the :class:`exclude.Exclusions` ``exclusions``."""
+    with_stat = analyse.needs_stat(scope)
+    relpath = scope.path
+    if relpath == ".":
+        path = root
+        data = analyse.analyse_file(root, root, ".")
+    else:
+        path = os.path.join(root, relpath)
+        try:
+            data = analyse.analyse_file(
+                root, os.path.dirname(path), os.path.basename(path)
+            )
+        except OSError:
+            data = None
+        if data is None or not os.path.isdir(path):
+            raise database.DatabaseException("Unknown FROM path")
+    data["depth"] = 0
+    yield data
+    if data["file_type"] == "L":
+        return
+
+    stack = [(path, relpath, 0)]
+    while stack:
+        path, relpath, depth = stack.pop()
+        if scope.max_depth is not None and depth >= scope.max_depth:
+            continue
+        if not analyse.in_dirname_scope(relpath, scope.dirnames):
+            continue
+
+        files, directories, _, _ = analyse.scan_directory(
+            path, relpath, with_stat, exclusions=exclusions
+        )
+        for name, data in files:
+            data["depth"] = depth + 1
+            yield data
+
+        subdirectories = []
+        for name, data in directories:
+            data["depth"] = depth + 1
+            yield data
+            if data["file_type"] != "L" and data["excluded"] is None:
+                subdirectories.append(
+                    (data["full_path"], analyse.child_relpath(relpath, name), depth + 1)
+                )
+        stack.extend(reversed(subdirectories))
+
+
+def execute(root, select, exclusions=None):
+    """Evaluate ``select`` while walking ``root``, without a database.
+
+    Returns the column names and an iterator over the result rows, which are
+    produced as the walk goes. Raises :class:`NotStreamable` before touching
+    the filesystem if the query needs the normal engine.
+    """
+    query_plan = plan(select)
+    scope = parser.scan_scope(select)
+    return query_plan.headers, _rows(root, scope, query_plan, exclusions)
+
+
+def _rows(root, scope, query_plan, exclusions):
+    evaluator = Evaluator(query_plan)
+    partials = []
+    emitted = 0
+    try:
+        batch, flushed = [], time.monotonic()
+        entries = walk(root, scope, exclusions)
+        while query_plan.limit is None or emitted < query_plan.limit:
+            data = next(entries, None)
+            if data is not None:
+                batch.append(evaluator.row(data))
+            if data is None or (
+                len(batch) >= BATCH_SIZE or time.monotonic() - flushed >= FLUSH_INTERVAL
+            ):
+                result = evaluator.evaluate(batch) if batch else []
+                batch, flushed = [], time.monotonic()
+                if query_plan.aggregates is not None:
+                    partials.extend(result)
+                else:
+                    for row in result:
+                        if query_plan.limit is not None and emitted >= query_plan.limit:
+                            break
+                        emitted += 1
+                        yield tuple(row)
+            if data is None:
+                break
+    finally:
+        evaluator.close()
+
+    if query_plan.aggregates is not None:
+        # one row of partial values per batch, in the order of the partials
+        columns = list(zip(*partials)) or [()] * sum(
+            len(a.partials) for a in query_plan.aggregates
+        )
+        row, index = [], 0
+        for aggregate in query_plan.aggregates:
+            values = columns[index : index + len(aggregate.partials)]
+            index += len(aggregate.partials)
+            row.append(aggregate.combine(*values))
+        if query_plan.limit is None or query_plan.limit > 0:
+            yield tuple(row)
@@ -0,0 +1,232 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import os.path
+import select
+import struct
+import threading
+import time
+
+from ifsql import analyse
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) flags
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# events are applied once no new one came for COALESCE_DELAY seconds, but
+# no later than MAX_DELAY seconds after the first one
+COALESCE_DELAY = 0.2
+MAX_DELAY = 2.0
+# seconds between two refreshes when inotify can't be used
+POLL_INTERVAL = 30.0
+
+
+class WatchLimitReached(Exception):
+    pass
+
+
+class Inotify:
+    """A minimal ctypes binding of the Linux inotify API."""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise WatchLimitReached(
+                    "inotify watch limit reached, "
+                    "see /proc/sys/fs/inotify/max_user_watches"
+                )
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """Yield the pending ``(wd, mask, name)`` events."""
+        while True:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+                offset += EVENT_HEADER.size
+                name = buffer[offset : offset + length].rstrip(b"\0")
+                offset += length
+                yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(threading.Thread):
+    """Keeps a scan up to date from a background thread.
+
+    Every scanned directory gets an inotify watch. Bursts of events are
+    coalesced into the set of directories they happened in and those
+    directories are listed again with :func:`analyse.refresh_directories`.
+    When inotify is not available or runs out of watches the whole scan is
+    refreshed every ``poll_interval`` seconds instead.
+    """
+
+    def __init__(
+        self,
+        root,
+        database,
+        path_id_cache,
+        poll_interval=POLL_INTERVAL,
+        exclusions=None,
+    ):
+        super().__init__(name="ifsql-watcher", daemon=True)
+        self.root = root
+        self.database = database
+        self.path_id_cache = path_id_cache
+        self.exclusions = exclusions
+        self.poll_interval = poll_interval
+        self.polling = False
+        self._stopped = threading.Event()
+        self._inotify = None
+        # watch descriptor -> (relpath, file_id) of the watched directory
+        self._watches = {}
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        try:
+            self._inotify = Inotify()
+            with self.database.lock:
+                self._sync_watches()
+        except (OSError, AttributeError, WatchLimitReached) as e:
+            self._fall_back(e)
+        else:
+            self._watch()
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+
+        if self.polling:
+            self._poll()
+
+    def _fall_back(self, reason):
+        logger.warning(
+            "%s, polling for changes every %d seconds instead",
+            reason,
+            self.poll_interval,
+        )
+        self.polling = True
+
+    def _sync_watches(self):
+        """Watch the directories added and forget the ones removed."""
+        watched = {}
+        for wd, (relpath, file_id) in self._watches.items():
+            if self.path_id_cache.get(relpath) == file_id:
+                watched[relpath] = wd
+            else:
+                self._inotify.rm_watch(wd)
+
+        self._watches = {wd: self._watches[wd] for wd in watched.values()}
+        for relpath, file_id in list(self.path_id_cache.items()):
+            if relpath in watched:
+                continue
+            path = self.root if relpath == "." else os.path.join(self.root, relpath)
+            try:
+                wd = self._inotify.add_watch(path)
+            except OSError:
+                continue  # vanished or a symlink, IN_ONLYDIR rejects both
+            self._watches[wd] = (relpath, file_id)
+
+    def _watch(self):
+        poll = select.poll()
+        poll.register(self._inotify.fd, select.POLLIN)
+
+        while not self._stopped.is_set():
+            if not poll.poll(100):
+                continue
+
+            dirty, overflow = set(), False
+            first = last = time.monotonic()
+            while True:
+                for wd, mask, name in self._inotify.read_events():
+                    last = time.monotonic()
+                    if mask & IN_Q_OVERFLOW:
+                        overflow = True
+                    elif not mask & IN_IGNORED and wd in self._watches:
+                        dirty.add(self._watches[wd][0])
+                now = time.monotonic()
+                if now - last >= COALESCE_DELAY or now - first >= MAX_DELAY:
+                    break
+                poll.poll(COALESCE_DELAY * 1000)
+
+            if overflow:
+                # events were lost, only a full refresh is reliable
+                stats = analyse.refresh(
+                    self.root,
+                    self.database,
+                    self.path_id_cache,
+                    exclusions=self.exclusions,
+                )
+            else:
+                stats = analyse.refresh_directories(
+                    self.root, self.database, self.path_id_cache, dirty, self.exclusions
+                )
+            logger.info("watch: %s", stats)
+
+            try:
+                with self.database.lock:
+                    self._sync_watches()
+            except WatchLimitReached as e:
+                self._fall_back(e)
+                return
+
+    def _poll(self):
+        while not self._stopped.wait(self.poll_interval):
+            stats = analyse.refresh(
+                self.root, self.database, self.path_id_cache, exclusions=self.exclusions
+            )
+            logger.info("poll: %s", stats)
@@ -14,11 +14,16 @@ def database():
     return ifsql.database.Database()
 
 
+@pytest.fixture(scope="session")
+def parser_cache(tmp_path_factory):
+    return str(tmp_path_factory.mktemp("cache") / "parser.lark")
+
+
 @pytest.fixture
-def parser():
+def parser(parser_cache):
     import ifsql.parser
 
-    return ifsql.parser.Parser()
+    return ifsql.parser.Parser(parser_cache)
 
 
 @pytest.fixture
@@ -33,6 +38,30 @@ def fs():
     return MockFilesystem()
 
 
+@pytest.fixture
+def tree(fs):
+    fs.add_directory("subdir1")
+    fs.add_directory("subdir2")
+    fs.add_directory("subdir2/subdir3")
+    fs.add_file(path="file1", size=100)
+    fs.add_file(path="subdir1/file2", size=200)
+    fs.add_file(path="subdir1/file3", size=300)
+    fs.add_file(path="subdir2/file4", size=400)
+    fs.add_file(path="subdir2/subdir3/file5", size=500)
+    return fs
+
+
+@pytest.fixture
+def query_rows():
+    """Run a query and return its rows sorted, for comparing databases."""
+
+    def query_rows(database, parser, path_id_cache, text):
+        query = parser.parse(text)
+        return sorted(tuple(r) for r in database.query(query, path_id_cache))
+
+    return query_rows
+
+
 class MockFilesystem:
     def __init__(self):
         self.root = tempfile.mkdtemp()
@@ -46,3 +75,9 @@ class MockFilesystem:
 
         with open(full_path, "wb") as f:
             f.write((0).to_bytes(size, "big"))
+
+    def write_file(self, path, content):
+        full_path = os.path.join(self.root, path)
+
+        with open(full_path, "wb") as f:
+            f.write(content)
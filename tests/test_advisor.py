@@ -0,0 +1,76 @@
+def make_tree(fs):
+    fs.add_directory("subdir1")
+    fs.add_file(path="file1", size=100)
+    fs.add_file(path="subdir1/file2", size=200)
+
+
+def test_indexed_columns():
+    import ifsql.advisor
+
+    assert ifsql.advisor.indexed_columns(
+        [
+            "SEARCH files USING INDEX ix_files_file_type_file_size "
+            "(file_type=? AND file_size>?)",
+            "SEARCH relations USING COVERING INDEX ix_relations_descendant "
+            "(descendant_id=? AND ancestor_id=?)",
+        ]
+    ) == {"file_type", "file_size"}
+    assert (
+        ifsql.advisor.indexed_columns(
+            [
+                "SEARCH relations USING COVERING INDEX ix_relations_ancestor_depth "
+                "(ancestor_id=?)",
+                "SEARCH files USING INTEGER PRIMARY KEY (rowid=?)",
+            ]
+        )
+        == set()
+    )
+
+
+def test_advisor_indexes_filtered_columns(fs, database, parser):
+    import ifsql.advisor
+    import ifsql.analyse
+
+    make_tree(fs)
+    path_id_cache = {}
+    ifsql.analyse.walk(fs.root, database, path_id_cache)
+    advisor = ifsql.advisor.IndexAdvisor()
+
+    text = "SELECT file_name FROM . WHERE file_size > 150 AND owner_id >= 0"
+    for _ in range(ifsql.advisor.MIN_QUERIES):
+        assert advisor.observe(database, parser.parse(text), path_id_cache) == {
+            "file_size",
+            "owner_id",
+        }
+    # not filtered on, a top level OR, answered from dir_stats
+    for text in (
+        "SELECT file_name FROM .",
+        "SELECT file_name FROM . WHERE file_size > 150 OR group_id = 0",
+        "SELECT count(*) FROM . WHERE file_type = 'F'",
+    ):
+        assert advisor.observe(database, parser.parse(text), path_id_cache) == set()
+
+    assert advisor.advice() == ["file_size", "owner_id"]
+    assert advisor.apply(database) == ["ix_files_file_size", "ix_files_owner_id"]
+    assert advisor.advice() == []
+    query = parser.parse(
+        "SELECT file_name FROM . WHERE file_size > 150 AND file_type = 'F'"
+    )
+    assert [tuple(row) for row in database.query(query, path_id_cache)] == [("file2",)]
+
+
+def test_advisor_log_outlives_the_session(fs, tmpdir):
+    import ifsql.advisor
+    import ifsql.cmd
+
+    make_tree(fs)
+    log = str(tmpdir.join("workload.sqlite"))
+    cmd = ifsql.cmd.Cmd(fs.root, index_advisor=log)
+    for _ in range(ifsql.advisor.MIN_QUERIES):
+        cmd.query("SELECT file_name FROM . WHERE creation_time > '2000'")
+
+    cmd = ifsql.cmd.Cmd(fs.root, index_advisor=log)
+    indexes = cmd._database.connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'"
+    )
+    assert "ix_files_creation_time" in {name for (name,) in indexes}
@@ -0,0 +1,453 @@
+import pytest
+
+
+@pytest.mark.parametrize("options", [{"jobs": 4}, {"processes": 2}])
+def test_concurrent_walk_matches_serial(tree, parser, options, query_rows):
+    import ifsql.analyse
+    import ifsql.database
+
+    serial, serial_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, serial, serial_cache)
+
+    parallel, parallel_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, parallel, parallel_cache, **options)
+
+    assert sorted(serial_cache) == sorted(parallel_cache)
+    assert serial.relations.count() == parallel.relations.count()
+    for path in serial_cache:
+        for text in (
+            # access_time is left out, scanning a directory updates it
+            "SELECT file_name, dirname, full_path, file_type, file_size, "
+            "modification_time, owner_id, depth FROM '{}'",
+            "SELECT file_name, depth FROM '{}' WHERE file_type = 'F'",
+        ):
+            text = text.format(path)
+            assert query_rows(serial, parser, serial_cache, text) == query_rows(
+                parallel, parser, parallel_cache, text
+            )
+
+
+@pytest.mark.parametrize(
+    "latency, expected",
+    [(None, 1), (10e-6, 1), (100e-6, 5), (1e-3, 8)],
+)
+def test_stat_latency_tuner(latency, expected):
+    import ifsql.analyse
+
+    tuner = ifsql.analyse.StatLatencyTuner(max_workers=8)
+    if latency is not None:
+        tuner.record(latency * 10, 10)
+    assert tuner.concurrency == expected
+
+
+def test_walk_does_not_descend_into_symlinked_directories(fs, database):
+    import os
+    import ifsql.analyse
+
+    fs.add_directory("subdir1")
+    fs.add_file(path="subdir1/file1", size=100)
+    os.symlink(os.path.join(fs.root, "subdir1"), os.path.join(fs.root, "link"))
+
+    path_id_cache = {}
+    ifsql.analyse.walk(fs.root, database, path_id_cache)
+
+    assert sorted(path_id_cache) == [".", "link", "subdir1"]
+    files = {f.file_name: f for f in database.files.all()}
+    assert sorted(files) == [".", "file1", "link", "subdir1"]
+    assert files["link"].file_type == "L"
+    assert files["file1"].dirname == "./subdir1"
+
+
+def test_walk_keeps_entries_it_cannot_stat(tree, database, monkeypatch):
+    import contextlib
+    import errno
+    import os
+    import ifsql.analyse
+
+    scandir = os.scandir
+
+    class Entry:
+        def __init__(self, entry):
+            self._entry = entry
+
+        def __getattr__(self, name):
+            return getattr(self._entry, name)
+
+        def stat(self, follow_symlinks=True):
+            if self._entry.name == "file2":
+                raise PermissionError(errno.EACCES, "denied", self._entry.path)
+            return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    @contextlib.contextmanager
+    def denying_scandir(path):
+        with scandir(path) as entries:
+            yield (Entry(entry) for entry in entries)
+
+    monkeypatch.setattr(os, "scandir", denying_scandir)
+    ifsql.analyse.walk(tree.root, database, {})
+
+    files = {f.file_name: f for f in database.files.all()}
+    assert sorted(files) == [
+        ".",
+        "file1",
+        "file2",
+        "file3",
+        "file4",
+        "file5",
+        "subdir1",
+        "subdir2",
+        "subdir3",
+    ]
+    assert files["file2"].file_type == "F"
+    assert files["file2"].file_size is None
+    assert not files["file2"].stat_pending
+
+
+@pytest.mark.parametrize("jobs", [None, 4])
+def test_pipelined_walk_matches_serial(tree, parser, jobs, query_rows):
+    import ifsql.analyse
+    import ifsql.database
+
+    serial, serial_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, serial, serial_cache)
+
+    pipelined, pipelined_cache = ifsql.database.Database(), {}
+    scanner, writer = ifsql.analyse.walk(
+        tree.root, pipelined, pipelined_cache, jobs=jobs, pipeline=True
+    )
+
+    assert sorted(serial_cache) == sorted(pipelined_cache)
+    assert serial.relations.count() == pipelined.relations.count()
+    text = "SELECT full_path, file_type, depth FROM ."
+    assert query_rows(serial, parser, serial_cache, text) == query_rows(
+        pipelined, parser, pipelined_cache, text
+    )
+    assert scanner.entries == writer.entries == 9
+
+
+def test_pipelined_walk_reports_scanner_errors(fs, database):
+    import ifsql.analyse
+
+    def broken_traverse(root, inserter, path_id_cache):
+        raise OSError("broken")
+
+    with pytest.raises(OSError):
+        ifsql.analyse.pipelined_walk(fs.root, database, {}, broken_traverse)
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"jobs": 4}, {"processes": 2}, {"pipeline": True}]
+)
+def test_interval_hierarchy_matches_closure(tree, parser, options, query_rows):
+    import ifsql.analyse
+    import ifsql.database
+
+    closure, closure_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, closure, closure_cache)
+
+    interval = ifsql.database.Database(hierarchy=ifsql.database.INTERVAL)
+    interval_cache = {}
+    ifsql.analyse.walk(tree.root, interval, interval_cache, **options)
+
+    assert interval.relations.count() == 0
+    for path in closure_cache:
+        for text in (
+            "SELECT file_name, dirname, file_type, file_size, depth FROM '{}'",
+            "SELECT full_path FROM '{}' WHERE depth <= 1 ORDER BY depth",
+            "SELECT depth, COUNT(*) FROM '{}' GROUP BY depth",
+        ):
+            text = text.format(path)
+            assert query_rows(closure, parser, closure_cache, text) == query_rows(
+                interval, parser, interval_cache, text
+            )
+
+
+@pytest.mark.parametrize("hierarchy", ["closure", "interval"])
+def test_refresh_matches_full_rescan(tree, parser, hierarchy, query_rows):
+    import os
+    import shutil
+    import time
+    import ifsql.analyse
+    import ifsql.database
+
+    tree.add_directory("subdir4")
+    tree.add_file(path="subdir4/file6", size=600)
+
+    database, path_id_cache = ifsql.database.Database(hierarchy), {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+
+    # directory times have the granularity of the kernel clock tick
+    time.sleep(0.05)
+    tree.add_file(path="subdir2/subdir3/new_file", size=10)
+    shutil.rmtree(os.path.join(tree.root, "subdir1"))
+    tree.add_directory("subdir1")
+    tree.add_directory("subdir1/new_subdir")
+    tree.add_file(path="subdir1/new_subdir/file7", size=700)
+    os.remove(os.path.join(tree.root, "file1"))
+    tree.add_directory("file1")
+
+    stats = ifsql.analyse.refresh(tree.root, database, path_id_cache)
+    assert stats.changed == 3
+    assert stats.added == 4
+    assert stats.removed == 3
+
+    expected, expected_cache = ifsql.database.Database(hierarchy), {}
+    ifsql.analyse.walk(tree.root, expected, expected_cache)
+
+    assert sorted(path_id_cache) == sorted(expected_cache)
+    for path in expected_cache:
+        text = "SELECT full_path, file_type, file_size, depth FROM '{}'".format(path)
+        assert query_rows(database, parser, path_id_cache, text) == query_rows(
+            expected, parser, expected_cache, text
+        )
+
+
+def test_refresh_of_unchanged_tree_only_stats_directories(tree, database):
+    import ifsql.analyse
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+
+    stats = ifsql.analyse.refresh(tree.root, database, path_id_cache, "subdir2")
+    assert stats.checked == 2
+    assert stats.changed == stats.added == stats.updated == stats.removed == 0
+
+
+def test_refresh_reads_directories_under_the_lock(tree, database):
+    import ifsql.analyse
+
+    # a Watcher thread changes path_id_cache while holding the lock
+    class PathIdCache(dict):
+        def __iter__(self):
+            assert database.lock._is_owned()
+            return super().__iter__()
+
+    path_id_cache = PathIdCache()
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+    stats = ifsql.analyse.refresh(tree.root, database, path_id_cache)
+    assert stats.checked == 4
+
+
+@pytest.mark.parametrize(
+    "text, listed",
+    [
+        ("SELECT file_name, depth FROM subdir2", 3),
+        ("SELECT file_name, depth FROM . WHERE depth <= 1", 1),
+        ("SELECT file_name FROM . WHERE depth < 3 AND file_size > 150", 3),
+        ("SELECT file_name FROM . WHERE dirname LIKE './subdir2/%'", 3),
+        ("SELECT file_name FROM . WHERE dirname = './subdir1'", 2),
+        ("SELECT file_name FROM . WHERE depth = 1 OR file_size = 500", 4),
+    ],
+)
+def test_scoped_scan_matches_full_scan(tree, parser, text, listed, query_rows):
+    import ifsql.analyse
+    import ifsql.database
+    import ifsql.parser
+
+    full, full_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, full, full_cache)
+
+    lazy, lazy_cache = ifsql.database.Database(), {}
+    scan = ifsql.analyse.ScopedScan(tree.root, lazy, lazy_cache)
+    assert scan.ensure(ifsql.parser.scan_scope(parser.parse(text))) == listed
+    assert query_rows(lazy, parser, lazy_cache, text) == query_rows(
+        full, parser, full_cache, text
+    )
+
+    # what is listed already is reused
+    assert scan.ensure(ifsql.parser.scan_scope(parser.parse(text))) == 0
+    text = "SELECT file_name, depth FROM ."
+    assert scan.ensure(ifsql.parser.scan_scope(parser.parse(text))) == 4 - listed
+    assert query_rows(lazy, parser, lazy_cache, text) == query_rows(
+        full, parser, full_cache, text
+    )
+
+
+@pytest.mark.parametrize("hierarchy", ["closure", "interval"])
+def test_stat_free_walk_fills_stats_on_demand(tree, parser, hierarchy, query_rows):
+    import ifsql.analyse
+    import ifsql.database
+
+    full, full_cache = ifsql.database.Database(hierarchy), {}
+    ifsql.analyse.walk(tree.root, full, full_cache)
+
+    stat_free, stat_free_cache = ifsql.database.Database(hierarchy), {}
+    ifsql.analyse.walk(tree.root, stat_free, stat_free_cache, with_stat=False)
+
+    text = "SELECT file_name, dirname, full_path, file_type, depth FROM ."
+    assert query_rows(stat_free, parser, stat_free_cache, text) == query_rows(
+        full, parser, full_cache, text
+    )
+    text = "SELECT file_name, file_size FROM . WHERE file_type = 'F'"
+    assert {r[1] for r in query_rows(stat_free, parser, stat_free_cache, text)} == {
+        None
+    }
+
+    # only the rows in scope are stat'd
+    subdir2 = stat_free_cache["subdir2"]
+    assert ifsql.analyse.fill_stats(stat_free, subdir2, max_depth=1) == 3
+    assert ifsql.analyse.fill_stats(stat_free, subdir2, max_depth=1) == 0
+    assert ifsql.analyse.fill_stats(stat_free, stat_free_cache["."]) == 5
+    assert not stat_free.has_pending_stats()
+
+    text = (
+        "SELECT file_name, file_type, file_size, modification_time, owner_id, "
+        "depth FROM ."
+    )
+    assert query_rows(stat_free, parser, stat_free_cache, text) == query_rows(
+        full, parser, full_cache, text
+    )
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("SELECT file_name, depth FROM . WHERE file_type = 'F'", False),
+        ("SELECT file_name FROM . WHERE file_size > 0", True),
+        ("SELECT file_name, mtime_ns FROM .", True),
+        ("SELECT device, inode FROM .", True),
+    ],
+)
+def test_needs_stat(parser, text, expected):
+    import ifsql.analyse
+    import ifsql.parser
+
+    scope = ifsql.parser.scan_scope(parser.parse(text))
+    assert ifsql.analyse.needs_stat(scope) == expected
+
+
+def test_scoped_scan_stats_only_when_needed(tree, database, parser, query_rows):
+    import ifsql.analyse
+    import ifsql.parser
+
+    path_id_cache = {}
+    scan = ifsql.analyse.ScopedScan(tree.root, database, path_id_cache)
+    text = "SELECT file_name FROM subdir1"
+    scan.ensure(ifsql.parser.scan_scope(parser.parse(text)))
+    assert database.has_pending_stats()
+
+    text = "SELECT file_name, file_size FROM subdir2 WHERE file_type = 'F'"
+    scope = ifsql.parser.scan_scope(parser.parse(text))
+    scan.ensure(scope)
+    # subdir2 itself was listed stat-free with the root
+    ifsql.analyse.fill_stats(database, path_id_cache["subdir2"], scope.max_depth)
+    assert query_rows(database, parser, path_id_cache, text) == [
+        ("file4", 400),
+        ("file5", 500),
+    ]
+    assert database.has_pending_stats()
+
+
+def test_background_scan_matches_serial(tree, parser, query_rows):
+    import ifsql.analyse
+    import ifsql.database
+
+    serial, serial_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, serial, serial_cache)
+
+    background, background_cache = ifsql.database.Database(), {}
+    background.create_session()
+    done = []
+    scan = ifsql.analyse.BackgroundScan(
+        tree.root, background, background_cache, on_done=lambda: done.append(True)
+    )
+    scan.start()
+    scan.join()
+
+    assert done == [True]
+    assert scan.status() is None
+    assert scan.entries == 9
+    assert sorted(serial_cache) == sorted(background_cache)
+    text = "SELECT file_name, dirname, full_path, file_type, file_size, depth FROM ."
+    assert query_rows(background, parser, background_cache, text) == query_rows(
+        serial, parser, serial_cache, text
+    )
+
+
+def test_intervals_are_numbered_once_read(tree, parser, monkeypatch, query_rows):
+    import ifsql.analyse
+    import ifsql.database
+
+    numbered = []
+    number_intervals = ifsql.database.Database._number_intervals
+
+    def counting_number_intervals(self):
+        numbered.append(self)
+        number_intervals(self)
+
+    monkeypatch.setattr(
+        ifsql.database.Database, "_number_intervals", counting_number_intervals
+    )
+    # a commit per entry
+    monkeypatch.setattr(ifsql.analyse.BackgroundScan, "BATCH_SIZE", 1)
+
+    closure, closure_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, closure, closure_cache)
+
+    interval = ifsql.database.Database(hierarchy=ifsql.database.INTERVAL)
+    interval_cache = {}
+    scan = ifsql.analyse.BackgroundScan(tree.root, interval, interval_cache)
+    scan.start()
+    scan.join()
+    assert numbered == []
+
+    text = "SELECT file_name, dirname, file_type, depth FROM subdir2"
+    assert query_rows(interval, parser, interval_cache, text) == query_rows(
+        closure, parser, closure_cache, text
+    )
+    interval.record_scan(tree.root)
+    assert query_rows(interval, parser, interval_cache, text) == query_rows(
+        closure, parser, closure_cache, text
+    )
+    assert len(numbered) == 1
+
+
+def test_background_scan_wait_for_subtree(
+    tree, database, parser, monkeypatch, query_rows
+):
+    import threading
+
+    import ifsql.analyse
+
+    monkeypatch.setattr(ifsql.analyse.BackgroundScan, "COMMIT_INTERVAL", 0)
+
+    # the scan blocks before listing subdir3
+    release = threading.Event()
+    scan_directory = ifsql.analyse.scan_directory
+
+    def blocking_scan_directory(path, relpath, *args, **kwargs):
+        if relpath.endswith("subdir3"):
+            release.wait()
+        return scan_directory(path, relpath, *args, **kwargs)
+
+    monkeypatch.setattr(ifsql.analyse, "scan_directory", blocking_scan_directory)
+
+    path_id_cache = {}
+    database.create_session()
+    scan = ifsql.analyse.BackgroundScan(tree.root, database, path_id_cache)
+    scan.start()
+    try:
+        assert scan.wait("subdir1", timeout=10)
+        assert not scan.wait("subdir2", timeout=0.1)
+
+        with database.lock:
+            text = "SELECT file_name, depth FROM ."
+            assert query_rows(database, parser, path_id_cache, text) == [
+                (".", 0),
+                ("file1", 1),
+                ("file2", 2),
+                ("file3", 2),
+                ("file4", 2),
+                ("subdir1", 1),
+                ("subdir2", 1),
+                ("subdir3", 2),
+            ]
+        assert scan.status() == (
+            "partial: 8 entries, 75% of directories, complete to depth 2"
+        )
+    finally:
+        release.set()
+
+    assert scan.wait("subdir2", timeout=10)
+    scan.join()
+    assert scan.status() is None
@@ -0,0 +1,174 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def tree(fs):
+    fs.add_directory("subdir.d")
+    fs.write_file("notes.txt", b"one\ntwo\nthree")
+    fs.write_file("script.SH", b"#!/bin/sh\necho hello\n")
+    fs.write_file("image.png", b"\x89PNG\r\n\x1a\n" + bytes(100))
+    fs.write_file("subdir.d/data.bin", bytes(range(256)))
+    fs.write_file("subdir.d/empty", b"")
+    return fs
+
+
+@pytest.fixture
+def computed(monkeypatch):
+    """The ``(column, file name)`` pairs ifsql.computed evaluates."""
+    import ifsql.computed
+
+    calls = []
+    for column in ifsql.computed.COLUMNS.values():
+
+        def recording_compute(path, column=column, compute=column.compute):
+            calls.append((column.name, os.path.basename(path)))
+            return compute(path)
+
+        monkeypatch.setattr(column, "compute", recording_compute)
+    return calls
+
+
+@pytest.mark.parametrize(
+    "content, mime_type, is_binary, line_count",
+    [
+        (b"", "inode/x-empty", False, 0),
+        (b"one line", "text/plain", False, 1),
+        (b"two\nlines\n", "text/plain", False, 2),
+        (b"#!/usr/bin/env python\n", "text/x-shellscript", False, 1),
+        (b"<!DOCTYPE html>\n<html>", "text/html", False, 2),
+        (b"%PDF-1.4\n", "application/pdf", False, 1),
+        (b"\x7fELF\x02\x01\x01\0", "application/x-executable", True, 1),
+        (b"\0\1\2\n", "application/octet-stream", True, 1),
+        (bytes(257) + b"ustar\0", "application/x-tar", True, 1),
+    ],
+)
+def test_builtin_columns(fs, content, mime_type, is_binary, line_count):
+    import ifsql.computed
+
+    fs.write_file("file", content)
+    path = os.path.join(fs.root, "file")
+    assert ifsql.computed.mime_type(path) == mime_type
+    assert ifsql.computed.is_binary(path) == is_binary
+    assert ifsql.computed.line_count(path) == line_count
+    assert ifsql.computed.line_count(os.path.join(fs.root, "missing")) is None
+
+
+def test_extension():
+    import ifsql.computed
+
+    assert ifsql.computed.extension("/a/b/archive.tar.GZ") == "gz"
+    assert ifsql.computed.extension("/a/b.d/.bashrc") == ""
+    assert ifsql.computed.extension("/a/b/README") == ""
+
+
+def test_evaluate_in_batches(tree, monkeypatch):
+    import ifsql.computed
+    import ifsql.hashing
+
+    paths = [
+        os.path.join(dirpath, name)
+        for dirpath, _, names in os.walk(tree.root)
+        for name in names
+    ]
+    monkeypatch.setattr(ifsql.computed, "BATCH_SIZE", 2)
+    monkeypatch.setattr(ifsql.hashing, "PARALLEL_THRESHOLD", 0)
+    for column in ifsql.computed.COLUMNS.values():
+        serial = [column.compute(path) for path in paths]
+        assert ifsql.computed.evaluate(column, paths, 1000, processes=2) == serial
+
+
+def test_cheap_predicates_apply_first(tree, database, parser, computed, query_rows):
+    import ifsql.analyse
+    import ifsql.computed
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+
+    text = (
+        "SELECT file_name, line_count FROM . "
+        "WHERE line_count > 1 AND is_binary = 0 AND file_size > 0"
+    )
+    ifsql.computed.fill_columns(database, path_id_cache, parser.parse(text))
+    # is_binary only for the non-empty files, line_count only for text ones
+    assert sorted(name for column, name in computed if column == "is_binary") == [
+        "data.bin",
+        "image.png",
+        "notes.txt",
+        "script.SH",
+    ]
+    assert sorted(name for column, name in computed if column == "line_count") == [
+        "notes.txt",
+        "script.SH",
+    ]
+    assert query_rows(database, parser, path_id_cache, text) == [
+        ("notes.txt", 3),
+        ("script.SH", 2),
+    ]
+
+    # the cheap extension filter keeps script.SH only, which is known not to
+    # be binary already
+    del computed[:]
+    text = "SELECT file_name FROM . WHERE is_binary = 0 AND extension = 'sh'"
+    ifsql.computed.fill_columns(database, path_id_cache, parser.parse(text))
+    assert [column for column, _ in computed] == ["extension"] * 7
+    assert query_rows(database, parser, path_id_cache, text) == [("script.SH",)]
+
+
+def test_values_are_kept_for_unchanged_files(
+    tree, database, parser, computed, query_rows
+):
+    import ifsql.analyse
+    import ifsql.computed
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+    text = "SELECT file_name, mime_type FROM subdir.d"
+    ifsql.computed.fill_columns(database, path_id_cache, parser.parse(text))
+    assert sorted(name for _, name in computed) == ["data.bin", "empty"]
+
+    # a renamed file is a new row of the same inode, only the changed file
+    # is read again
+    os.rename(
+        os.path.join(tree.root, "subdir.d", "data.bin"),
+        os.path.join(tree.root, "subdir.d", "moved.bin"),
+    )
+    tree.write_file("subdir.d/empty", b"not anymore")
+    ifsql.analyse.refresh(tree.root, database, path_id_cache)
+    del computed[:]
+    ifsql.computed.fill_columns(database, path_id_cache, parser.parse(text))
+    assert computed == [("mime_type", "empty")]
+    assert query_rows(database, parser, path_id_cache, text) == [
+        ("empty", "text/plain"),
+        ("moved.bin", "application/octet-stream"),
+        ("subdir.d", None),
+    ]
+
+
+def test_values_that_cannot_be_computed_are_kept(tree, database, parser, computed):
+    import ifsql.analyse
+    import ifsql.computed
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+    # unreadable from now on, its stored stat columns are unchanged
+    os.remove(os.path.join(tree.root, "notes.txt"))
+
+    text = "SELECT file_name, line_count FROM . WHERE file_name = 'notes.txt'"
+    ifsql.computed.fill_columns(database, path_id_cache, parser.parse(text))
+    assert computed == [("line_count", "notes.txt")]
+    del computed[:]
+    ifsql.computed.fill_columns(database, path_id_cache, parser.parse(text))
+    assert computed == []
+
+
+def test_cmd_query_fills_computed_columns(tree):
+    import ifsql.cmd
+
+    cmd = ifsql.cmd.Cmd(tree.root, with_stat=False)
+    headers, rows = cmd.query(
+        "SELECT extension, sum(line_count) FROM . "
+        "WHERE file_type = 'F' AND is_binary = 0 GROUP BY extension"
+    )
+    assert sorted(rows) == [("", 0), ("sh", 2), ("txt", 3)]
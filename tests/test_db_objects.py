@@ -64,11 +64,84 @@ def test_relations(fs, database):
     )
 
     relations = database.relations.all()
-    assert len(relations) == len(expected_relations)
-    for i, relation in enumerate(relations):
-        expected_relation = ifsql.database.Relation(
-            ancestor_id=expected_relations[i][0],
-            descendant_id=expected_relations[i][1],
-            depth=expected_relations[i][2],
-        )
-        assert expected_relation == relation
+    assert relations == list(expected_relations)
+    assert relations[0].ancestor_id == file_map["."]
+
+
+def test_catalog_reopen(fs, parser):
+    import os
+    import ifsql.database
+    import ifsql.analyse
+
+    fs.add_directory("subdir1")
+    fs.add_directory("subdir1/subdir2")
+    fs.add_file(path="file1", size=100)
+    fs.add_file(path="subdir1/subdir2/file2", size=200)
+    catalog = os.path.join(fs.root, "catalog.sqlite")
+
+    database = ifsql.database.Database(catalog=catalog)
+    assert database.scan_info is None
+    path_id_cache = {}
+    ifsql.analyse.walk(fs.root, database, path_id_cache)
+    database.record_scan(fs.root)
+
+    reopened = ifsql.database.Database(catalog=catalog)
+    assert reopened.scan_info.root == os.path.abspath(fs.root)
+    assert reopened.scan_info.schema_version == ifsql.database.SCHEMA_VERSION
+    assert reopened.load_path_id_cache() == path_id_cache
+    assert reopened.file_count == database.file_count
+
+    reopened.create_session()
+    query = parser.parse("SELECT file_name, depth FROM subdir1 WHERE file_type = 'F'")
+    result = list(reopened.query(query, path_id_cache))
+    assert [(r.file_name, r.depth) for r in result] == [("file2", 2)]
+
+
+def test_catalog_without_completed_scan_is_discarded(fs):
+    import os
+    import ifsql.database
+    import ifsql.analyse
+
+    fs.add_file(path="file1", size=100)
+    catalog = os.path.join(fs.root, "catalog.sqlite")
+
+    database = ifsql.database.Database(
+        hierarchy=ifsql.database.INTERVAL, catalog=catalog
+    )
+    ifsql.analyse.walk(fs.root, database, {})
+
+    reopened = ifsql.database.Database(catalog=catalog)
+    assert reopened.scan_info is None
+    assert reopened.file_count == 0
+    reopened.create_session()
+    assert reopened.files.count() == 0
+
+
+def test_catalog_dir_stats_are_committed(tree, parser):
+    import os
+    import sqlite3
+    import ifsql.analyse
+    import ifsql.database
+
+    catalog = os.path.join(tree.root, "catalog.sqlite")
+    database = ifsql.database.Database(catalog=catalog)
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+    database.record_scan(tree.root)
+    assert not database.connection.connection.in_transaction
+    text = "SELECT count(*), sum(file_size) FROM subdir2"
+    expected = list(database.query(parser.parse(text), path_id_cache))
+
+    # another connection sees the rollups and can write to the catalog
+    other = sqlite3.connect(catalog, timeout=0)
+    assert other.execute("SELECT count(*) FROM dir_stats").fetchone() == (4,)
+    other.execute("DELETE FROM dir_stats")
+    other.commit()
+    other.close()
+
+    # and the rollups built again by a query are kept too
+    reopened = ifsql.database.Database(catalog=catalog)
+    assert list(reopened.query(parser.parse(text), path_id_cache)) == expected
+    other = sqlite3.connect(catalog, timeout=0)
+    assert other.execute("SELECT count(*) FROM dir_stats").fetchone() == (4,)
+    other.close()
@@ -1,5 +1,7 @@
 import datetime
 import operator
+import os
+import re
 
 import pytest
 
@@ -711,3 +713,196 @@ def test_select_collate(fs, database, parser):
 
     assert len(result) == 1
     assert result[0].file_name == "file1"
+
+
+@pytest.mark.parametrize("hierarchy", ["closure", "interval"])
+@pytest.mark.parametrize(
+    "select, where",
+    [
+        ("count(*), sum(file_size), max(modification_time), max(depth)", ""),
+        ("SUM(file_size) AS total", ""),
+        ("count(*), sum(file_size)", "file_type = 'F'"),
+        ("count(*)", "file_type='D'"),
+    ],
+)
+def test_select_aggregates_from_dir_stats(tree, parser, hierarchy, select, where):
+    import ifsql.database
+    import ifsql.analyse
+
+    database = ifsql.database.Database(hierarchy)
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+
+    for path in (".", "subdir1", "subdir2", "subdir2/subdir3"):
+        text = "SELECT {} FROM {}".format(select, path)
+        query = parser.parse(text + (" WHERE " + where if where else ""))
+        assert database._rollup(query) is not None
+        result = database.query(query, path_id_cache)
+        # an extra conjunct leaves the aggregates to the join
+        joined = database.query(
+            parser.parse(
+                text + " WHERE depth >= 0" + (" AND " + where if where else "")
+            ),
+            path_id_cache,
+        )
+        assert result.keys() == joined.keys()
+        assert list(result) == list(joined)
+
+
+def test_dir_stats_follow_changes(tree, database, parser):
+    import ifsql.analyse
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+
+    query = "SELECT count(*), sum(file_size) FROM subdir2 WHERE file_type = 'F'"
+    assert list(database.query(parser.parse(query), path_id_cache)) == [(2, 900)]
+
+    tree.add_file(path="subdir2/subdir3/file6", size=600)
+    ifsql.analyse.refresh(tree.root, database, path_id_cache)
+    assert list(database.query(parser.parse(query), path_id_cache)) == [(3, 1500)]
+
+
+def test_du_command(tree, capsys):
+    import ifsql.cmd
+
+    cmd = ifsql.cmd.Cmd(tree.root, with_stat=False)
+    cmd.execute(".du FROM subdir2 1")
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 3
+    assert lines[2].split()[1:] == ["2", os.path.join(tree.root, "subdir2")]
+
+    cmd.execute(".du")
+    lines = capsys.readouterr().out.splitlines()[2:]
+    paths = [line.split()[2] for line in lines]
+    assert paths[:2] == [
+        os.path.join(tree.root, "."),
+        os.path.join(tree.root, "subdir2"),
+    ]
+    # as large as each other
+    assert sorted(paths[2:]) == [
+        os.path.join(tree.root, "subdir1"),
+        os.path.join(tree.root, "subdir2", "subdir3"),
+    ]
+
+    cmd.execute(".du FROM subdir1 many")
+    assert capsys.readouterr().out.startswith("Usage")
+
+
+def test_explain_uses_the_indexes(tree, database, parser):
+    import ifsql.analyse
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+
+    query = parser.parse("SELECT file_name FROM subdir1 WHERE depth = 1")
+    assert database.explain(query, path_id_cache)[0] == (
+        "SEARCH relations USING COVERING INDEX ix_relations_ancestor_depth "
+        "(ancestor_id=? AND depth=?)"
+    )
+
+    assert database.create_indexes([("file_name",)]) == ["ix_files_file_name"]
+    assert database.create_indexes([("file_name",)]) == []
+    query = parser.parse("SELECT full_path FROM . WHERE file_name = 'file3'")
+    assert "ix_files_file_name" in database.explain(query, path_id_cache)[0]
+
+
+@pytest.mark.parametrize("hierarchy", ["closure", "interval"])
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("lazy", [False, True])
+@pytest.mark.parametrize(
+    "text, index",
+    [
+        (
+            "SELECT full_path, file_size FROM . "
+            "WHERE file_type = 'F' AND file_size > 150",
+            "ix_files_file_type_file_size_file_name_full_path",
+        ),
+        (
+            "SELECT file_name, full_path FROM subdir1 WHERE file_name = 'file3'",
+            "ix_files_file_name_full_path",
+        ),
+    ],
+)
+def test_file_indexes_cover_the_query(
+    tree, parser, hierarchy, compact, lazy, text, index
+):
+    import ifsql.analyse
+    import ifsql.database
+    import ifsql.parser
+
+    database = ifsql.database.Database(hierarchy, compact=compact)
+    path_id_cache = {}
+    if lazy:
+        scan = ifsql.analyse.ScopedScan(tree.root, database, path_id_cache)
+        scan.ensure(ifsql.parser.scan_scope(parser.parse(text)))
+    else:
+        ifsql.analyse.walk(tree.root, database, path_id_cache)
+        database.record_scan(tree.root)
+
+    plan = database.explain(parser.parse(text), path_id_cache)
+    assert any("USING COVERING INDEX {} ".format(index) in detail for detail in plan)
+
+
+TIMESTAMP = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{6}$")
+
+
+@pytest.mark.parametrize("hierarchy", ["closure", "interval"])
+def test_compact_layout_matches(tree, parser, hierarchy):
+    import ifsql.database
+    import ifsql.analyse
+
+    databases = []
+    for compact in (False, True):
+        database = ifsql.database.Database(hierarchy, compact=compact)
+        path_id_cache = {}
+        ifsql.analyse.walk(tree.root, database, path_id_cache)
+        databases.append((database, path_id_cache))
+    tree.add_file(path="subdir2/file6", size=600)
+    os.remove(os.path.join(tree.root, "subdir1", "file2"))
+
+    rows = []
+    for database, path_id_cache in databases:
+        ifsql.analyse.refresh(tree.root, database, path_id_cache)
+        query = parser.parse(
+            "SELECT *, creation_time FROM subdir2 "
+            "WHERE file_type = 'F' OR dirname LIKE './subdir2%'"
+        )
+        rows.append(sorted(tuple(row) for row in database.query(query, path_id_cache)))
+    # the times of the normal layout come from the float stat fields, and may
+    # be off by a microsecond
+    assert len(rows[0]) == len(rows[1])
+    for row, compact_row in zip(*rows):
+        for value, compact_value in zip(row, compact_row):
+            if isinstance(value, str) and TIMESTAMP.match(value):
+                value, compact_value = (
+                    datetime.datetime.strptime(v, "%Y-%m-%d %H:%M:%S.%f")
+                    for v in (value, compact_value)
+                )
+                assert abs(value - compact_value) <= datetime.timedelta(microseconds=1)
+            else:
+                assert value == compact_value
+
+    # paths and times are only stored once per directory and as integers
+    columns = database.connection.execute("PRAGMA table_info(files_compact)")
+    names = {column[1] for column in columns}
+    assert "mtime_ns" in names and "file_name" in names
+    assert names.isdisjoint(["dirname", "full_path", "modification_time"])
+
+
+def test_compact_catalog_is_reopened_compact(tree, parser, tmpdir):
+    import ifsql.database
+    import ifsql.analyse
+
+    catalog = str(tmpdir.join("catalog.sqlite"))
+    database = ifsql.database.Database(catalog=catalog, compact=True)
+    ifsql.analyse.walk(tree.root, database, {})
+    database.record_scan(tree.root)
+
+    database = ifsql.database.Database(catalog=catalog)
+    database.create_session()
+    assert database.compact
+    query = parser.parse("SELECT full_path FROM . WHERE file_name = 'file5'")
+    assert list(database.query(query, database.load_path_id_cache())) == [
+        (os.path.join(tree.root, "subdir2", "subdir3", "file5"),)
+    ]
@@ -0,0 +1,114 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def tree(fs):
+    size = 4 * 64 * 1024
+    original = bytes(range(256)) * (size // 256)
+    fs.add_directory("subdir1")
+    fs.add_directory("subdir2")
+    fs.write_file("a", original)
+    fs.write_file("subdir1/copy_of_a", original)
+    os.link(os.path.join(fs.root, "a"), os.path.join(fs.root, "subdir2/link_to_a"))
+    # same size, first and last blocks, only the middle differs
+    fs.write_file(
+        "subdir2/middle", original[: size // 2] + b"x" + original[size // 2 + 1 :]
+    )
+    # same size, the first block differs
+    fs.write_file("subdir2/start", b"x" + original[1:])
+    fs.write_file("small1", b"small")
+    fs.write_file("subdir1/small2", b"small")
+    fs.write_file("empty1", b"")
+    fs.write_file("empty2", b"")
+    return fs
+
+
+@pytest.fixture
+def fully_hashed(monkeypatch):
+    import ifsql.hashing
+
+    paths = []
+    hash_file = ifsql.hashing.hash_file
+
+    def recording_hash_file(path, with_sha256=False):
+        paths.append(os.path.basename(path))
+        return hash_file(path, with_sha256)
+
+    monkeypatch.setattr(ifsql.hashing, "hash_file", recording_hash_file)
+    return paths
+
+
+def test_find_duplicates(tree, database, fully_hashed):
+    import ifsql.analyse
+    import ifsql.dupes
+    import ifsql.hashing
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+    cache = ifsql.hashing.HashCache()
+
+    groups, stats = ifsql.dupes.find_duplicates(database, path_id_cache, ".", 1, cache)
+    assert [
+        (size, [os.path.relpath(path, tree.root) for path in paths])
+        for size, paths in groups
+    ] == [
+        (4 * 64 * 1024, ["a", "subdir1/copy_of_a", "subdir2/link_to_a"]),
+        (5, ["small1", "subdir1/small2"]),
+    ]
+    # the link is the same file as a, the empty files are too small
+    assert stats.files == 6
+    assert stats.same_size == 6
+    assert stats.same_partial_hash == 5
+    # only the files sharing their first and last blocks are read in full
+    assert sorted(fully_hashed) == ["a", "copy_of_a", "middle"]
+    assert stats.fully_hashed == 3
+
+    # the hashes are kept, nothing is read the second time
+    del fully_hashed[:]
+    groups_again, stats = ifsql.dupes.find_duplicates(
+        database, path_id_cache, ".", 1, cache
+    )
+    assert groups_again == groups
+    assert fully_hashed == []
+    assert stats.bytes_read == 0
+
+
+def test_find_duplicates_in_subtree(tree, database):
+    import ifsql.analyse
+    import ifsql.dupes
+    import ifsql.hashing
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+    cache = ifsql.hashing.HashCache()
+
+    groups, stats = ifsql.dupes.find_duplicates(
+        database, path_id_cache, "subdir2", 0, cache
+    )
+    # the link to a and middle only differ in the middle
+    assert groups == []
+    assert stats.same_size == 3
+    assert stats.same_partial_hash == 2
+    assert stats.fully_hashed == 2
+
+
+def test_dupes_command(tree, capsys, tmpdir):
+    import ifsql.cmd
+
+    cmd = ifsql.cmd.Cmd(
+        tree.root, with_stat=False, hash_cache=str(tmpdir.join("hashes.sqlite"))
+    )
+    cmd.execute(".dupes FROM subdir1 1")
+    output = capsys.readouterr().out
+    assert "copy_of_a" not in output
+    assert "2 files, 0 sharing their size" in output
+
+    cmd.execute(".dupes 10")
+    output = capsys.readouterr().out
+    assert output.count("copy_of_a") == 1
+    assert "small1" not in output
+
+    cmd.execute(".dupes FROM")
+    assert capsys.readouterr().out.startswith("Usage")
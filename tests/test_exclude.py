@@ -0,0 +1,214 @@
+import os
+
+import pytest
+
+
+def make_tree(fs):
+    fs.add_directory(".git")
+    fs.add_directory("src")
+    fs.add_directory("src/build")
+    fs.add_directory("node_modules")
+    fs.add_directory("node_modules/lib")
+    fs.add_file(path=".git/HEAD", size=10)
+    fs.add_file(path="main.py", size=100)
+    fs.add_file(path="main.pyc", size=100)
+    fs.add_file(path="src/module.py", size=200)
+    fs.add_file(path="src/module.pyc", size=200)
+    fs.add_file(path="src/build/output.o", size=300)
+    fs.add_file(path="node_modules/lib/index.js", size=400)
+
+
+def patterns(*texts):
+    import ifsql.exclude
+
+    return [ifsql.exclude.Pattern(text) for text in texts]
+
+
+@pytest.mark.parametrize(
+    "text, name, relpath, is_directory, expected",
+    [
+        ("*.pyc", "a.pyc", "src/a.pyc", False, True),
+        ("*.pyc", "a.py", "src/a.py", False, False),
+        (".git", ".git", "sub/.git", True, True),
+        ("build/", "build", "src/build", True, True),
+        ("build/", "build", "src/build", False, False),
+        ("/build", "build", "build", True, True),
+        ("/build", "build", "src/build", True, False),
+        ("src/*.o", "a.o", "src/a.o", False, True),
+        ("src/*.o", "a.o", "src/sub/a.o", False, False),
+        ("src/**/*.o", "a.o", "src/sub/deep/a.o", False, True),
+        ("**/cache", "cache", "a/b/cache", True, True),
+        ("logs/**", "x", "logs/a/x", False, True),
+        ("file[0-9]", "file1", "file1", False, True),
+        ("file[!0-9]", "file1", "file1", False, False),
+        ("file?", "file10", "file10", False, False),
+    ],
+)
+def test_pattern(text, name, relpath, is_directory, expected):
+    import ifsql.exclude
+
+    excluded = ifsql.exclude._excluded(
+        [(".", ifsql.exclude.Pattern(text))], name, relpath, is_directory
+    )
+    assert excluded == expected
+
+
+def test_parse_patterns():
+    import ifsql.exclude
+
+    parsed = ifsql.exclude.parse_patterns(
+        ["# comment\n", "\n", "*.log  \n", "!keep.log\n"]
+    )
+    assert [p.text for p in parsed] == ["*.log", "!keep.log"]
+    assert parsed[1].negated
+    rules = [(".", p) for p in parsed]
+    assert ifsql.exclude._excluded(rules, "a.log", "a.log", False)
+    assert not ifsql.exclude._excluded(rules, "keep.log", "keep.log", False)
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"jobs": 4}, {"processes": 2}, {"pipeline": True}]
+)
+def test_walk_excludes(fs, database, parser, options):
+    import ifsql.analyse
+    import ifsql.exclude
+
+    make_tree(fs)
+    exclusions = ifsql.exclude.Exclusions(
+        fs.root, patterns(".git", "node_modules/", "*.pyc")
+    )
+
+    path_id_cache = {}
+    ifsql.analyse.walk(
+        fs.root, database, path_id_cache, exclusions=exclusions, **options
+    )
+
+    assert sorted(path_id_cache) == [".", "src", os.path.join("src", "build")]
+    query = parser.parse("SELECT file_name, excluded FROM .")
+    rows = sorted(tuple(row) for row in database.query(query, path_id_cache))
+    assert rows == [
+        (".", None),
+        (".git", "exclude"),
+        ("build", None),
+        ("main.py", None),
+        ("module.py", None),
+        ("node_modules", "exclude"),
+        ("output.o", None),
+        ("src", None),
+    ]
+
+
+def test_excluded_directories_are_never_listed(fs, database, monkeypatch):
+    import ifsql.analyse
+    import ifsql.exclude
+
+    make_tree(fs)
+    listed = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        listed.append(os.path.relpath(path, fs.root))
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", recording_scandir)
+
+    exclusions = ifsql.exclude.Exclusions(fs.root, patterns(".git", "node_modules"))
+    ifsql.analyse.walk(fs.root, database, {}, exclusions=exclusions)
+
+    assert sorted(listed) == [".", "src", os.path.join("src", "build")]
+
+
+def test_gitignore(fs, database, parser):
+    import ifsql.analyse
+    import ifsql.exclude
+
+    make_tree(fs)
+    with open(os.path.join(fs.root, ".gitignore"), "w") as f:
+        f.write("*.pyc\nnode_modules/\n")
+    with open(os.path.join(fs.root, "src", ".gitignore"), "w") as f:
+        f.write("/build\n!module.pyc\n")
+
+    path_id_cache = {}
+    exclusions = ifsql.exclude.Exclusions(fs.root, gitignore=True)
+    ifsql.analyse.walk(fs.root, database, path_id_cache, exclusions=exclusions)
+
+    query = parser.parse("SELECT full_path, excluded FROM . WHERE file_type != 'D'")
+    rows = sorted(tuple(row) for row in database.query(query, path_id_cache))
+    assert [(os.path.relpath(path, fs.root), excluded) for path, excluded in rows] == [
+        (".git/HEAD", None),
+        (".gitignore", None),
+        ("main.py", None),
+        ("src/.gitignore", None),
+        ("src/module.py", None),
+        ("src/module.pyc", None),
+    ]
+    query = parser.parse("SELECT file_name, excluded FROM . WHERE excluded IS NOT NULL")
+    rows = sorted(tuple(row) for row in database.query(query, path_id_cache))
+    assert rows == [("build", "gitignore"), ("node_modules", "gitignore")]
+
+
+@pytest.mark.parametrize("with_stat", [True, False])
+def test_one_file_system(fs, database, parser, with_stat):
+    import ifsql.analyse
+    import ifsql.exclude
+
+    make_tree(fs)
+    exclusions = ifsql.exclude.Exclusions(fs.root, one_file_system=True)
+    # every directory below the root looks like a mount point
+    exclusions.device = -1
+
+    path_id_cache = {}
+    ifsql.analyse.walk(
+        fs.root, database, path_id_cache, with_stat=with_stat, exclusions=exclusions
+    )
+
+    assert sorted(path_id_cache) == ["."]
+    query = parser.parse("SELECT file_name, excluded FROM . WHERE depth = 1")
+    rows = sorted(tuple(row) for row in database.query(query, path_id_cache))
+    assert rows == [
+        (".git", "mount"),
+        ("main.py", None),
+        ("main.pyc", None),
+        ("node_modules", "mount"),
+        ("src", "mount"),
+    ]
+
+
+def test_scoped_scan_and_refresh_keep_exclusions(fs, database, parser):
+    import ifsql.analyse
+    import ifsql.exclude
+
+    make_tree(fs)
+    exclusions = ifsql.exclude.Exclusions(fs.root, patterns("build", "*.pyc"))
+
+    path_id_cache = {}
+    scan = ifsql.analyse.ScopedScan(fs.root, database, path_id_cache, exclusions)
+    scan.ensure(ifsql.parser.scan_scope(parser.parse("SELECT * FROM src")))
+    assert "src/build" not in path_id_cache
+
+    fs.add_file(path="src/new.pyc", size=10)
+    fs.add_file(path="src/new.py", size=10)
+    stats = ifsql.analyse.refresh(
+        fs.root, database, path_id_cache, exclusions=exclusions
+    )
+    assert stats.added == 1
+
+    query = parser.parse("SELECT file_name, excluded FROM src WHERE depth = 1")
+    rows = sorted(tuple(row) for row in database.query(query, path_id_cache))
+    assert rows == [("build", "exclude"), ("module.py", None), ("new.py", None)]
+
+
+def test_stream_excludes(fs, parser):
+    import ifsql.exclude
+    import ifsql.stream
+
+    make_tree(fs)
+    exclusions = ifsql.exclude.Exclusions(fs.root, patterns(".git", "node_modules"))
+
+    text = "SELECT file_name FROM . WHERE excluded IS NOT NULL"
+    headers, rows = ifsql.stream.execute(fs.root, parser.parse(text), exclusions)
+    assert sorted(rows) == [(".git",), ("node_modules",)]
+
+    text = "SELECT count(*) FROM . WHERE file_type = 'F'"
+    headers, rows = ifsql.stream.execute(fs.root, parser.parse(text), exclusions)
+    assert list(rows) == [(5,)]
@@ -0,0 +1,115 @@
+import pytest
+
+
+@pytest.fixture
+def scanned(fs, database):
+    import ifsql.analyse
+
+    fs.add_directory("subdir1")
+    for i in range(5):
+        fs.add_file(path="subdir1/file{}".format(i), size=i)
+    path_id_cache = {}
+    ifsql.analyse.walk(fs.root, database, path_id_cache)
+    return database, path_id_cache
+
+
+def test_rows_are_fetched_in_batches(scanned, parser, monkeypatch):
+    import ifsql.execution
+
+    database, path_id_cache = scanned
+    monkeypatch.setattr(ifsql.execution, "ARRAY_SIZE", 2)
+    query = parser.parse(
+        "SELECT file_name, count(*), file_size AS size FROM subdir1 "
+        "WHERE file_type = 'F' GROUP BY file_name ORDER BY file_name"
+    )
+    result = database.query(query, path_id_cache)
+    assert result.keys()[0] == "file_name"
+    assert result.keys()[2] == "size"
+    rows = list(result)
+    assert rows == [("file{}".format(i), 1, i) for i in range(5)]
+    assert [(row.file_name, row.size) for row in rows][-1] == ("file4", 4)
+
+
+def test_errors_are_sqlalchemy_errors(scanned, parser):
+    import sqlalchemy.exc
+
+    database, path_id_cache = scanned
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        database.query(parser.parse("SELECT no_such_column FROM ."), path_id_cache)
+
+
+@pytest.mark.parametrize("fetch", [list, lambda result: result.fetchall()])
+def test_errors_while_fetching_are_sqlalchemy_errors(scanned, parser, fetch):
+    import sqlalchemy.exc
+
+    database, path_id_cache = scanned
+    # SQLite only fails once it reaches the row of file4
+    text = (
+        "SELECT file_name, CASE WHEN file_name = 'file4' "
+        "THEN abs(-9223372036854775807 - 1) END FROM subdir1"
+    )
+    result = database.query(parser.parse(text), path_id_cache)
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        fetch(result)
+
+
+def test_cmd_reports_errors_while_fetching(fs, capsys):
+    import ifsql.cmd
+
+    fs.add_file(path="file1", size=1)
+    cmd = ifsql.cmd.Cmd(fs.root)
+    cmd.execute(
+        "SELECT file_name, CASE WHEN file_name = 'file1' "
+        "THEN abs(-9223372036854775807 - 1) END FROM ."
+    )
+    assert capsys.readouterr().out.strip().splitlines()[-1] == "database error"
+
+
+def test_files_and_relations(scanned):
+    database, path_id_cache = scanned
+    assert database.files.count() == 7
+    assert [f.file_name for f in database.files][:2] == [".", "subdir1"]
+    relations = database.relations.all()
+    # the directories to themselves, subdir1 to . and the files to both
+    assert len(relations) == database.relations.count() == 2 + 1 + 2 * 5
+    assert all(relation.depth <= 2 for relation in relations)
+
+
+@pytest.mark.parametrize("hierarchy", ["closure", "interval"])
+def test_repeated_queries_are_compiled_once(fs, parser, hierarchy):
+    import ifsql.analyse
+    import ifsql.database
+
+    fs.add_directory("subdir1")
+    fs.add_directory("subdir2")
+    for i in range(5):
+        fs.add_file(path="subdir1/file{}".format(i), size=i)
+        fs.add_file(path="subdir2/file{}".format(i), size=10 * i)
+    database = ifsql.database.Database(hierarchy)
+    path_id_cache = {}
+    ifsql.analyse.walk(fs.root, database, path_id_cache)
+    database.record_scan(fs.root)
+
+    queries = [
+        "SELECT file_name, file_size FROM {} WHERE file_size > {} LIMIT 3",
+        "SELECT sum(file_size) FROM {} WHERE file_type = '{}'",
+    ]
+    values = [
+        ("subdir1", 1, "F"),
+        ("subdir2", 10, "F"),
+        (".", 20, "D"),
+        ("subdir2", 0, "D"),
+    ]
+    for path, size, file_type in values:
+        for text in queries:
+            text = text.format(path, size if "LIMIT" in text else file_type)
+            fresh = ifsql.database.Database(hierarchy)
+            fresh_cache = {}
+            ifsql.analyse.walk(fs.root, fresh, fresh_cache)
+            fresh.record_scan(fs.root)
+            assert list(database.query(parser.parse(text), path_id_cache)) == list(
+                fresh.query(parser.parse(text), fresh_cache)
+            )
+    # the rollups of files and directories are different statements
+    assert database._statements.misses == 3
+    assert database._statements.hits == len(values) * len(queries) - 3
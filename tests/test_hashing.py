@@ -0,0 +1,148 @@
+import hashlib
+import os
+
+import pytest
+
+
+@pytest.fixture
+def tree(fs):
+    fs.add_directory("subdir1")
+    fs.add_directory("subdir2")
+    fs.add_file(path="file1", size=100)
+    fs.add_file(path="subdir1/file2", size=100)
+    fs.add_file(path="subdir1/file3", size=300)
+    fs.add_file(path="subdir2/file4", size=400)
+    return fs
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    """The paths ifsql.hashing reads."""
+    import ifsql.hashing
+
+    paths = []
+    hash_file = ifsql.hashing.hash_file
+
+    def recording_hash_file(path, with_sha256=False):
+        paths.append(os.path.basename(path))
+        return hash_file(path, with_sha256)
+
+    monkeypatch.setattr(ifsql.hashing, "hash_file", recording_hash_file)
+    return paths
+
+
+def test_hash_file(fs):
+    import ifsql.hashing
+
+    fs.add_file(path="file1", size=3 * 1024 * 1024 + 5)
+    path = os.path.join(fs.root, "file1")
+    content_hash, sha256 = ifsql.hashing.hash_file(path, with_sha256=True)
+
+    with open(path, "rb") as f:
+        assert sha256 == hashlib.sha256(f.read()).hexdigest()
+    assert ifsql.hashing.hash_file(path) == (content_hash, None)
+    assert ifsql.hashing.hash_file(os.path.join(fs.root, "missing")) == (None, None)
+
+
+def test_hash_files_in_processes(tree, monkeypatch):
+    import ifsql.hashing
+
+    paths = [
+        os.path.join(tree.root, path)
+        for path in ("file1", "subdir1/file2", "subdir1/file3", "subdir2/file4")
+    ]
+    serial = ifsql.hashing.hash_files(paths, 900, with_sha256=True)
+    monkeypatch.setattr(ifsql.hashing, "PARALLEL_THRESHOLD", 0)
+    parallel = ifsql.hashing.hash_files(paths, 900, with_sha256=True, processes=2)
+    assert serial == parallel
+
+
+def test_hashes_only_rows_kept_by_the_where_clause(
+    tree, database, parser, hashed, query_rows
+):
+    import ifsql.analyse
+    import ifsql.hashing
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+    cache = ifsql.hashing.HashCache()
+
+    text = "SELECT file_name, content_hash FROM . WHERE file_size = 100"
+    assert (
+        ifsql.hashing.fill_hashes(database, path_id_cache, parser.parse(text), cache)
+        == 2
+    )
+    assert sorted(hashed) == ["file1", "file2"]
+    rows = query_rows(database, parser, path_id_cache, text)
+    # same content, same hash
+    assert rows[0][1] is not None and rows[0][1] == rows[1][1]
+
+    # a conjunct on the hash itself doesn't restrict what is hashed
+    text = "SELECT file_name FROM subdir2 WHERE content_hash = '{}'".format(rows[0][1])
+    assert (
+        ifsql.hashing.fill_hashes(database, path_id_cache, parser.parse(text), cache)
+        == 1
+    )
+    assert query_rows(database, parser, path_id_cache, text) == []
+
+
+def test_hash_cache_outlives_the_session(tree, parser, hashed, tmpdir, query_rows):
+    import ifsql.analyse
+    import ifsql.database
+    import ifsql.hashing
+
+    cache_path = str(tmpdir.join("hashes.sqlite"))
+    text = "SELECT file_name, content_hash, sha256 FROM subdir1"
+
+    first, first_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, first, first_cache)
+    cache = ifsql.hashing.HashCache(cache_path)
+    ifsql.hashing.fill_hashes(first, first_cache, parser.parse(text), cache)
+    cache.close()
+    assert sorted(hashed) == ["file2", "file3"]
+
+    # unchanged files are not read again, changed ones are
+    with open(os.path.join(tree.root, "subdir1", "file3"), "ab") as f:
+        f.write(b"more")
+    del hashed[:]
+    second, second_cache = ifsql.database.Database(), {}
+    ifsql.analyse.walk(tree.root, second, second_cache)
+    cache = ifsql.hashing.HashCache(cache_path)
+    ifsql.hashing.fill_hashes(second, second_cache, parser.parse(text), cache)
+    assert hashed == ["file3"]
+
+    rows = query_rows(second, parser, second_cache, text)
+    with open(os.path.join(tree.root, "subdir1", "file2"), "rb") as f:
+        assert rows[0][2] == hashlib.sha256(f.read()).hexdigest()
+
+
+def test_cmd_query_fills_hashes(tree, tmpdir):
+    import ifsql.cmd
+
+    tree.add_file(path="subdir2/file5", size=400)
+
+    cmd = ifsql.cmd.Cmd(tree.root, hash_cache=str(tmpdir.join("hashes.sqlite")))
+    headers, rows = cmd.query(
+        "SELECT content_hash, count(*) FROM . WHERE file_type = 'F' "
+        "GROUP BY content_hash HAVING count(*) > 1"
+    )
+    assert sorted(row[1] for row in rows) == [2, 2]
+
+
+def test_literals_with_colons_stay_literals(tree, database, parser, hashed, query_rows):
+    import ifsql.analyse
+    import ifsql.computed
+    import ifsql.hashing
+
+    tree.add_file(path="subdir1/file:b", size=10)
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+
+    text = "SELECT file_name, content_hash FROM . WHERE file_name LIKE '%:b'"
+    select = parser.parse(text)
+    cache = ifsql.hashing.HashCache()
+    assert ifsql.hashing.fill_hashes(database, path_id_cache, select, cache) == 1
+    assert hashed == ["file:b"]
+    text = "SELECT file_name, extension FROM . WHERE file_name = 'file:b'"
+    ifsql.computed.fill_columns(database, path_id_cache, parser.parse(text))
+    assert query_rows(database, parser, path_id_cache, text) == [("file:b", "")]
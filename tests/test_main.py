@@ -0,0 +1,42 @@
+import pytest
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["-e", "SELECT * FROM .", "--watch"],
+        ["-e", "SELECT * FROM .", "--background"],
+        ["--lazy", "--jobs", "4"],
+        ["--lazy", "--pipeline"],
+    ],
+)
+def test_rejected_combinations(args):
+    import ifsql.main
+
+    with pytest.raises(SystemExit):
+        ifsql.main.parse_args(args)
+
+
+@pytest.mark.parametrize(
+    "options, lazy",
+    [([], True), (["--jobs", "4"], False), (["--pipeline"], False)],
+)
+def test_execute_scans_as_tuned(tree, tmpdir, monkeypatch, capsys, options, lazy):
+    import ifsql.main
+
+    scans = []
+    build_cmd = ifsql.main.build_cmd
+
+    def recording_build_cmd(args, **kwargs):
+        scans.append(kwargs["lazy"])
+        return build_cmd(args, **kwargs)
+
+    monkeypatch.setattr(ifsql.main, "build_cmd", recording_build_cmd)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir))
+    args = ifsql.main.parse_args(
+        [tree.root, "-e", "SELECT file_name FROM . ORDER BY file_name LIMIT 2"]
+        + options
+    )
+    assert ifsql.main.execute(args) == 0
+    assert scans == [lazy]
+    assert capsys.readouterr().out.split() == [".", "file1"]
@@ -0,0 +1,88 @@
+import io
+import json
+
+import pytest
+
+
+def test_latency_histogram():
+    import ifsql.metrics
+
+    histogram = ifsql.metrics.LatencyHistogram()
+    for latency in [0.5e-6, 3e-6, 3e-6, 100e-6]:
+        histogram.record(latency)
+
+    summary = histogram.summary()
+    assert summary["calls"] == 4
+    assert summary["histogram_us"] == {"<1": 1, "<4": 2, "<128": 1}
+    assert summary["p50_us"] == 4
+    assert summary["p99_us"] == 128
+    assert ifsql.metrics.LatencyHistogram().summary()["p50_us"] is None
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"jobs": 4}, {"processes": 2}, {"pipeline": True}]
+)
+def test_walk_metrics(tree, database, options):
+    import ifsql.analyse
+    import ifsql.metrics
+
+    metrics = ifsql.metrics.ScanMetrics()
+    ifsql.analyse.walk(tree.root, database, {}, metrics=metrics, **options)
+
+    summary = json.loads(json.dumps(metrics.summary()))
+    assert metrics.finished is not None
+    # the listed entries, the root isn't part of any listing
+    assert summary["entries"] == 8
+    assert summary["directories"] == 4
+    assert summary["insert_batches"]["count"] >= 1
+    assert sum(s["calls"] for s in summary["stat_latency"].values()) == 8
+    assert sorted(d["path"] for d in summary["slowest_directories"]) == [
+        ".",
+        "subdir1",
+        "subdir2",
+        "subdir2/subdir3",
+    ]
+
+
+def test_stat_free_walk_metrics(tree, database):
+    import ifsql.analyse
+    import ifsql.metrics
+
+    metrics = ifsql.metrics.ScanMetrics()
+    ifsql.analyse.walk(tree.root, database, {}, with_stat=False, metrics=metrics)
+
+    summary = metrics.summary()
+    assert summary["entries"] == 8
+    assert sum(s["calls"] for s in summary["stat_latency"].values()) == 0
+
+
+def test_progress_and_write(tree, database, tmpdir):
+    import ifsql.analyse
+    import ifsql.metrics
+
+    stream = io.StringIO()
+    metrics = ifsql.metrics.ScanMetrics(progress=True, stream=stream)
+    ifsql.analyse.walk(tree.root, database, {}, metrics=metrics)
+
+    assert "scanned 8 entries in 4 directories" in stream.getvalue()
+    assert "8 entries, 4 directories" in stream.getvalue()
+
+    path = str(tmpdir.join("scan.json"))
+    metrics.write(path)
+    with open(path) as f:
+        assert json.load(f)["entries"] == 8
+
+
+def test_background_scan_metrics(tree, database):
+    import ifsql.analyse
+    import ifsql.metrics
+
+    metrics = ifsql.metrics.ScanMetrics()
+    database.create_session()
+    scan = ifsql.analyse.BackgroundScan(tree.root, database, {}, metrics=metrics)
+    scan.start()
+    scan.join()
+
+    assert metrics.finished is not None
+    assert metrics.summary()["entries"] == 8
+    assert metrics.summary()["directories"] == 4
@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 
@@ -34,3 +36,196 @@ import pytest
 )
 def test_parser(parser, input_query):
     parser.parse(input_query)
+
+
+@pytest.mark.parametrize(
+    "input_query, expected",
+    [
+        ("SELECT * FROM .", (".", None, ())),
+        ("SELECT * FROM 'a/b' WHERE depth <= 2", ("a/b", 2, ())),
+        ("SELECT * FROM . WHERE depth < 2 AND 3 >= depth", (".", 1, ())),
+        ("SELECT * FROM . WHERE depth BETWEEN 1 AND 4", (".", 4, ())),
+        ("SELECT * FROM . WHERE (depth < 2 OR file_size > 1)", (".", None, ())),
+        ("SELECT * FROM . WHERE depth < 2 OR file_size > 1", (".", None, ())),
+        ("SELECT * FROM . WHERE NOT depth < 2", (".", None, ())),
+        (
+            "SELECT * FROM . WHERE file_size BETWEEN 1 AND 2 AND depth = 3",
+            (".", 3, ()),
+        ),
+        (
+            "SELECT * FROM . WHERE dirname LIKE './a/%' AND dirname = './a/b'",
+            (".", None, (("./a/", False, False), ("./a/b", True, True))),
+        ),
+        (
+            "SELECT * FROM . WHERE dirname GLOB './A*'",
+            (".", None, (("./A", False, True),)),
+        ),
+    ],
+)
+def test_scan_scope(parser, input_query, expected):
+    import ifsql.parser
+
+    assert ifsql.parser.scan_scope(parser.parse(input_query))[:3] == expected
+
+
+@pytest.mark.parametrize(
+    "input_query, columns",
+    [
+        ("SELECT file_name FROM . WHERE depth < 2", {"file_name", "depth"}),
+        ("SELECT count(*) FROM . GROUP BY owner_id", {"owner_id"}),
+        ("SELECT * FROM .", {"*"}),
+    ],
+)
+def test_scan_scope_columns(parser, input_query, columns):
+    import ifsql.parser
+
+    assert columns <= ifsql.parser.scan_scope(parser.parse(input_query)).columns
+
+
+@pytest.mark.parametrize(
+    "input_query, conjuncts",
+    [
+        ("SELECT * FROM .", []),
+        ("SELECT * FROM . WHERE a = 1 OR b = 2", None),
+        (
+            "SELECT * FROM . WHERE file_size > 10 AND (a = 1 OR b = 2)",
+            ["file_size > 10", "( a = 1 OR b = 2 )"],
+        ),
+        (
+            "SELECT * FROM . WHERE depth BETWEEN 1 AND 2 AND content_hash = 'x'",
+            ["depth BETWEEN 1 AND 2", "content_hash = 'x'"],
+        ),
+    ],
+)
+def test_where_conjuncts(parser, input_query, conjuncts):
+    import ifsql.parser
+
+    result = ifsql.parser.where_conjuncts(parser.parse(input_query))
+    if conjuncts is None:
+        assert result is None
+    else:
+        assert [text for text, names in result] == conjuncts
+
+
+@pytest.mark.parametrize(
+    "input_query, sql, params",
+    [
+        (
+            "SELECT * FROM sub1 WHERE file_size > 10 AND file_name LIKE 'it''s%'",
+            "WHERE file_size > :p1 AND file_name LIKE :p2",
+            {"p1": 10, "p2": "it's%"},
+        ),
+        (
+            "SELECT file_name, 1.5 AS 'x' FROM . ORDER BY 2 LIMIT 3 OFFSET 4",
+            "SELECT file_name, 1.5 AS x FROM . ORDER BY 2 LIMIT :p4 OFFSET :p5",
+            {"p4": 3, "p5": 4},
+        ),
+        (
+            'SELECT count(*) FROM "a b" WHERE file_type = "F" GROUP BY depth '
+            "HAVING count(*) > 2e3",
+            'WHERE file_type = "F" GROUP BY depth HAVING count ( * ) > :p1',
+            {"p1": 2000.0},
+        ),
+    ],
+)
+def test_literals_are_parameters(parser, input_query, sql, params):
+    import ifsql.parser
+
+    select = parser.parse(input_query)
+    assert sql in " ".join(str(select).replace('"."', ".").split())
+    assert ifsql.parser.query_shape(select)[1] == params
+
+
+@pytest.mark.parametrize(
+    "input_query",
+    [
+        "SELECT file_name FROM . WHERE file_size > :p3",
+        "SELECT file_name FROM . WHERE file_size > :p0",
+        "SELECT :p0 FROM .",
+    ],
+)
+def test_typed_parameters_are_errors(parser, input_query):
+    import ifsql.parser
+
+    with pytest.raises(ifsql.parser.ParserException):
+        parser.parse(input_query)
+    # in a string it is a literal like any other
+    select = parser.parse("SELECT file_name FROM . WHERE file_name = ':p3'")
+    assert ifsql.parser.query_shape(select)[1] == {"p1": ":p3"}
+
+
+def test_query_shapes_are_parsed_once(parser):
+    import ifsql.parser
+
+    first = parser.parse("SELECT file_name FROM sub1 WHERE file_size > 10")
+    second = parser.parse("SELECT file_name FROM 'sub 2' WHERE file_size > 1000")
+    assert ifsql.parser.query_shape(first)[0] == ifsql.parser.query_shape(second)[0]
+    assert ifsql.parser.scan_scope(second).path == "sub 2"
+    assert ifsql.parser.where_conjuncts(second) == [
+        ("file_size > 1000", frozenset({"file_size", "1000"}))
+    ]
+    assert parser._template.cache_info().hits == 1
+
+
+@pytest.mark.parametrize(
+    "input_query, sql",
+    [
+        # keywords only stand alone
+        (
+            "SELECT notes FROM . WHERE NOT is_binary AND order_id IS NOT NULL",
+            "SELECT notes FROM . WHERE NOT is_binary AND order_id IS NOT NULL",
+        ),
+        ("SELECT a FROM . ORDER BY a DESC, b", "ORDER BY a DESC, b"),
+        ("SELECT a FROM . LIMIT 3, 10", "LIMIT :p2 OFFSET :p1"),
+        (
+            "SELECT a FROM . WHERE " + " OR ".join(["a = 1 AND b < 2"] * 50),
+            " OR ".join(
+                "a = :p{} AND b < :p{}".format(i, i + 1) for i in range(1, 101, 2)
+            ),
+        ),
+    ],
+)
+def test_parsed_sql(parser, input_query, sql):
+    assert sql in " ".join(str(parser.parse(input_query)).replace('"."', ".").split())
+
+
+def test_parser_tables_are_cached(tmpdir, monkeypatch):
+    import ifsql.parser
+
+    # only given a path
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmpdir.join("home")))
+    ifsql.parser.Parser()
+    assert not os.path.exists(ifsql.parser.default_cache_path())
+
+    cache_path = str(tmpdir.join("ifsql", "parser.lark"))
+    parser = ifsql.parser.Parser(cache_path)
+    assert os.path.exists(cache_path)
+    cached = ifsql.parser.Parser(cache_path)
+    query = "SELECT file_name FROM . WHERE file_size BETWEEN 1 AND 2"
+    assert str(cached.parse(query)) == str(parser.parse(query))
+
+    # an unwritable cache only costs the time to build the tables
+    tmpdir.join("file").write("")
+    parser = ifsql.parser.Parser(str(tmpdir.join("file", "parser.lark")))
+    assert str(parser.parse(query)) == str(cached.parse(query))
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "SELECT file_name, file_size FROM . WHERE file_size > 10",
+        "SELECT dirname, count(*) AS total FROM . WHERE file_type = 'F' "
+        "AND (file_name LIKE '%.py' OR NOT depth BETWEEN 1 AND 3) "
+        "GROUP BY dirname HAVING total > 1 ORDER BY total DESC LIMIT 10 OFFSET 2",
+        "SELECT -file_size * 2 || 'x' FROM . WHERE file_name IN ('a', 'b') "
+        "AND file_size & 1 <> 0 AND mode IS NOT NULL",
+    ],
+)
+def test_lalr_parses_like_earley(text):
+    import lark
+    import ifsql.parser
+
+    options = dict(start="simple_select", maybe_placeholders=False)
+    earley = lark.Lark(ifsql.parser.GRAMMAR, parser="earley", **options)
+    shape, _ = ifsql.parser._lift(text)
+    assert ifsql.parser._lark(None).parse(shape) == earley.parse(shape)
@@ -0,0 +1,54 @@
+import os
+import subprocess
+import sys
+
+
+def python(*args):
+    import ifsql
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(ifsql.__file__)), env.get("PYTHONPATH", "")]
+    )
+    return subprocess.run(
+        [sys.executable] + list(args),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+
+def loaded(module, prefixes):
+    code = (
+        "import sys, {}\n"
+        "print(' '.join(sorted(name for name in sys.modules "
+        "if name.split('.')[0] in {!r})))"
+    ).format(module, prefixes)
+    return python("-c", code).stdout.split()
+
+
+def test_main_imports_no_heavy_modules():
+    assert (
+        loaded(
+            "ifsql.main",
+            (
+                "sqlalchemy",
+                "lark",
+                "prompt_toolkit",
+                "pygments",
+                "tabulate",
+                "pkg_resources",
+            ),
+        )
+        == []
+    )
+
+
+def test_cmd_leaves_the_prompt_to_run():
+    assert loaded("ifsql.cmd", ("prompt_toolkit", "pygments", "tabulate")) == []
+
+
+def test_version():
+    assert python("-m", "ifsql", "--version").stdout.startswith("ifsql ")
@@ -0,0 +1,110 @@
+import pytest
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        # access_time is left out, scanning a directory updates it
+        "SELECT file_name, dirname, full_path, file_type, file_size, "
+        "modification_time, owner_id, depth FROM .",
+        "SELECT full_path FROM . WHERE file_size > 250 AND file_type = 'F'",
+        "SELECT file_name, depth FROM subdir2 WHERE depth <= 1",
+        "SELECT file_name FROM . WHERE dirname LIKE './subdir2%'",
+        "SELECT file_name AS name, file_size * 2 FROM . WHERE file_type = 'F'",
+        "SELECT count(*), sum(file_size), min(file_name), max(depth) FROM .",
+        "SELECT avg(file_size) AS average, total(file_size) FROM . "
+        "WHERE file_type = 'F'",
+        "SELECT count(*), sum(file_size) FROM . WHERE file_size > 10000",
+    ],
+)
+def test_streaming_matches_database(tree, database, parser, text):
+    import ifsql.analyse
+    import ifsql.stream
+
+    path_id_cache = {}
+    ifsql.analyse.walk(tree.root, database, path_id_cache)
+    result = database.query(parser.parse(text), path_id_cache)
+    expected = sorted(tuple(row) for row in result)
+
+    headers, rows = ifsql.stream.execute(tree.root, parser.parse(text))
+    assert headers == result.keys()
+    assert sorted(rows) == expected
+
+
+def test_streaming_select_star_headers(tree, parser):
+    import ifsql.database
+    import ifsql.stream
+
+    headers, rows = ifsql.stream.execute(tree.root, parser.parse("SELECT * FROM ."))
+    assert headers == ifsql.database.fields()
+    assert all(len(row) == len(headers) for row in rows)
+
+
+def test_streaming_stops_at_limit(tree, parser, monkeypatch):
+    import ifsql.analyse
+    import ifsql.stream
+
+    monkeypatch.setattr(ifsql.stream, "BATCH_SIZE", 1)
+    listed = []
+    scan_directory = ifsql.analyse.scan_directory
+
+    def counting_scan_directory(path, relpath, *args, **kwargs):
+        listed.append(relpath)
+        return scan_directory(path, relpath, *args, **kwargs)
+
+    monkeypatch.setattr(ifsql.analyse, "scan_directory", counting_scan_directory)
+
+    text = "SELECT file_name FROM . WHERE file_type = 'F' LIMIT 1"
+    headers, rows = ifsql.stream.execute(tree.root, parser.parse(text))
+    assert list(rows) == [("file1",)]
+    assert listed == ["."]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "SELECT file_name FROM . ORDER BY file_name",
+        "SELECT DISTINCT file_type FROM .",
+        "SELECT file_type, count(*) FROM . GROUP BY file_type",
+        "SELECT file_name, count(*) FROM .",
+        "SELECT count(DISTINCT file_type) FROM .",
+        # combined partial aggregates would be summed over the batches
+        "SELECT sum(file_size) / count(*) FROM .",
+        "SELECT max(file_size)+min(file_size) FROM .",
+        "SELECT count(*), 2 * sum(file_size) FROM .",
+        # columns the stream table doesn't have
+        "SELECT mtime_ns FROM .",
+        "SELECT file_name FROM . WHERE mtime_ns > 0",
+    ],
+)
+def test_not_streamable(parser, text):
+    import ifsql.stream
+
+    with pytest.raises(ifsql.stream.NotStreamable):
+        ifsql.stream.execute(".", parser.parse(text))
+
+
+def test_aggregate_calls():
+    import ifsql.stream
+
+    assert ifsql.stream._aggregate(" sum(file_size) ") == ("sum", "file_size")
+    assert ifsql.stream._aggregate("max(length(file_name))") == (
+        "max",
+        "length(file_name)",
+    )
+    assert ifsql.stream._aggregate("count(file_name = ')(')") == (
+        "count",
+        "file_name = ')('",
+    )
+    assert ifsql.stream._aggregate("sum(file_size) / count(*)") is None
+    assert ifsql.stream._aggregate("max(a)+min(b)") is None
+    assert ifsql.stream._aggregate("file_size") is None
+
+
+def test_streaming_unknown_from_path(fs, parser):
+    import ifsql.database
+    import ifsql.stream
+
+    headers, rows = ifsql.stream.execute(fs.root, parser.parse("SELECT * FROM nope"))
+    with pytest.raises(ifsql.database.DatabaseException):
+        list(rows)
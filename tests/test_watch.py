@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def file_names(database, parser, path_id_cache):
+    query = parser.parse("SELECT file_name FROM .")
+    with database.lock:
+        return sorted(r.file_name for r in database.query(query, path_id_cache))
+
+
+@pytest.fixture
+def watched(fs, database):
+    import ifsql.analyse
+    import ifsql.watch
+
+    fs.add_directory("subdir1")
+    fs.add_file(path="subdir1/file1", size=100)
+
+    path_id_cache = {}
+    ifsql.analyse.walk(fs.root, database, path_id_cache)
+    watcher = ifsql.watch.Watcher(fs.root, database, path_id_cache, 0.1)
+    yield watcher, path_id_cache
+    watcher.stop()
+
+
+def test_watch_applies_events(fs, database, parser, watched):
+    import os
+
+    watcher, path_id_cache = watched
+    watcher.start()
+    # let the watcher register its watches first
+    assert wait_for(lambda: watcher._watches or watcher.polling)
+    assert not watcher.polling
+
+    fs.add_directory("subdir1/subdir2")
+    fs.add_file(path="subdir1/subdir2/file2", size=200)
+    os.rename(
+        os.path.join(fs.root, "subdir1", "file1"),
+        os.path.join(fs.root, "file3"),
+    )
+
+    expected = [".", "file2", "file3", "subdir1", "subdir2"]
+    assert wait_for(lambda: file_names(database, parser, path_id_cache) == expected)
+    assert "subdir1/subdir2" in path_id_cache
+
+
+def test_watch_falls_back_to_polling(fs, database, parser, watched, monkeypatch):
+    import ifsql.watch
+
+    def add_watch(self, path, mask=ifsql.watch.WATCH_MASK):
+        raise ifsql.watch.WatchLimitReached("inotify watch limit reached")
+
+    monkeypatch.setattr(ifsql.watch.Inotify, "add_watch", add_watch)
+
+    watcher, path_id_cache = watched
+    watcher.start()
+    assert wait_for(lambda: watcher.polling)
+
+    time.sleep(0.05)
+    fs.add_file(path="subdir1/file2", size=200)
+
+    expected = [".", "file1", "file2", "subdir1"]
+    assert wait_for(lambda: file_names(database, parser, path_id_cache) == expected)